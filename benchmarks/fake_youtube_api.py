@@ -0,0 +1,403 @@
+"""
+A local stand-in for the parts of YouTube Data API that youtubewatched uses,
+videos.list and videoCategories.list, for load testing inserting and updating
+records without an API key or quota (see run_api_benchmarks.py).
+
+Video resources are made up from their IDs, the same ones every time. Some
+IDs are those of removed videos, which aren't returned, and some videos' view
+counts go up each time they're requested, which changes their ETags.
+Responses can be delayed, fail at random with backendError, or be refused
+with rateLimitExceeded (at random, or when requests come in faster than
+allowed) and with quotaExceeded once the quota is spent. Partial response
+masks (fields=) are applied, and the usual quota cost is counted: 1 unit
+per request, whatever its parts.
+
+The server describes itself at the same path as Google's discovery documents,
+so youtube.get_api_auth can be pointed at it by its base_url, or by setting
+YOUTUBEWATCHED_API_URL=http://127.0.0.1:8000/ before starting the app.
+GET /fake/stats returns the counts of requests served and refused so far.
+
+Usage: python benchmarks/fake_youtube_api.py --port 8000 --latency 0.1
+"""
+import gzip
+import hashlib
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter, deque
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlsplit
+
+import click
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from youtubewatched.topics import topics
+
+CHANNELS = 5000
+PUBLISHED_EPOCH = datetime(2010, 1, 1)
+categories = {'1': 'Film & Animation', '2': 'Autos & Vehicles',
+              '10': 'Music', '15': 'Pets & Animals', '17': 'Sports',
+              '20': 'Gaming', '22': 'People & Blogs', '24': 'Entertainment',
+              '25': 'News & Politics', '27': 'Education',
+              '28': 'Science & Technology'}
+topic_ids = sorted(topics)
+tag_words = ('music', 'live', 'review', 'tutorial', 'funny', 'game', 'news',
+             'vlog', 'cover', 'remix', 'how to', 'highlights')
+
+_field_name_re = re.compile(r'[^,()/]+')
+
+
+def parse_fields(fields: str, pos: int = 0) -> tuple:
+    """
+    Parses a partial response mask, ex. items(id,snippet(title,tags)) or
+    items/id, into a tree of dicts, where an empty dict selects everything
+    under its key. Returns the tree and the position it stopped at
+    """
+    tree = {}
+    while pos < len(fields) and fields[pos] != ')':
+        match = _field_name_re.match(fields, pos)
+        if not match:
+            raise ValueError(f'Invalid fields: {fields!r}')
+        node = tree.setdefault(match.group().strip(), {})
+        pos = match.end()
+        while pos < len(fields) and fields[pos] == '/':
+            match = _field_name_re.match(fields, pos + 1)
+            if not match:
+                raise ValueError(f'Invalid fields: {fields!r}')
+            node = node.setdefault(match.group().strip(), {})
+            pos = match.end()
+        if pos < len(fields) and fields[pos] == '(':
+            subtree, pos = parse_fields(fields, pos + 1)
+            if pos >= len(fields):
+                raise ValueError(f'Invalid fields: {fields!r}')
+            node.update(subtree)
+            pos += 1  # the closing parenthesis
+        if pos < len(fields) and fields[pos] == ',':
+            pos += 1
+    return tree, pos
+
+
+def apply_fields(obj, tree: dict):
+    if not tree:
+        return obj
+    if isinstance(obj, list):
+        return [apply_fields(value, tree) for value in obj]
+    if isinstance(obj, dict):
+        return {key: apply_fields(value, tree[key])
+                for key, value in obj.items() if key in tree}
+    return obj
+
+
+def _etag(obj) -> str:
+    return hashlib.md5(json.dumps(obj, sort_keys=True).encode()).hexdigest()
+
+
+def _api_error(code: int, reason: str, message: str) -> tuple:
+    return code, {'error': {'errors': [{'domain': 'youtube.api',
+                                        'reason': reason,
+                                        'message': message}],
+                            'code': code, 'message': message}}
+
+
+class FakeYouTubeApi:
+    """The responses of the server and the state behind them, apart from
+    HTTP. Safe to call from multiple threads"""
+
+    def __init__(self, latency: float = 0., jitter: float = 0.,
+                 error_rate: float = 0., rate_limit_rate: float = 0.,
+                 max_rps: float = None, quota: int = None,
+                 removed_rate: float = 0.1, change_rate: float = 0.1,
+                 key: str = None, seed: int = 1):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.max_rps = max_rps
+        self.quota = quota
+        self.removed_rate = removed_rate
+        self.change_rate = change_rate
+        self.key = key
+        self.seed = seed
+        self.stats = Counter()
+        self._times_requested = Counter()
+        self._recent_requests = deque()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def discovery_document(self, root_url: str) -> dict:
+        query = {'type': 'string', 'location': 'query'}
+        part = dict(query, required=True)
+        return {
+            'kind': 'discovery#restDescription',
+            'discoveryVersion': 'v1',
+            'id': 'youtube:v3', 'name': 'youtube', 'version': 'v3',
+            'protocol': 'rest', 'rootUrl': root_url,
+            'servicePath': 'youtube/v3/',
+            'baseUrl': root_url + 'youtube/v3/',
+            'batchPath': 'batch/youtube/v3',
+            'parameters': {'key': query, 'fields': query,
+                           'alt': dict(query, default='json'),
+                           'prettyPrint': dict(query, type='boolean')},
+            # without a response schema, the client returns the raw bytes
+            'schemas': {name: {'id': name, 'type': 'object'} for name in
+                        ('VideoListResponse', 'VideoCategoryListResponse')},
+            'resources': {
+                'videos': {'methods': {'list': {
+                    'id': 'youtube.videos.list', 'path': 'videos',
+                    'httpMethod': 'GET', 'parameterOrder': ['part'],
+                    'response': {'$ref': 'VideoListResponse'},
+                    'parameters': {'part': part, 'id': query,
+                                   'maxResults': dict(query,
+                                                      type='integer')}}}},
+                'videoCategories': {'methods': {'list': {
+                    'id': 'youtube.videoCategories.list',
+                    'path': 'videoCategories', 'httpMethod': 'GET',
+                    'parameterOrder': ['part'],
+                    'response': {'$ref': 'VideoCategoryListResponse'},
+                    'parameters': {'part': part, 'id': query,
+                                   'regionCode': query}}}}}}
+
+    def video(self, video_id: str, times_requested: int = 1) -> dict:
+        """
+        Returns all the parts of a video's resource, without its ETag, or None
+        if it's removed
+        """
+        rand = random.Random(f'{self.seed}:{video_id}')
+        if rand.random() < self.removed_rate:
+            return
+        views = rand.randrange(10 ** 7)
+        if rand.random() < self.change_rate:
+            views += times_requested
+        channel = rand.randrange(CHANNELS)
+        channel_id = 'UC' + hashlib.md5(
+            f'{self.seed}:{channel}'.encode()).hexdigest()[:22]
+        title = f'Video {video_id}'
+        description = ' '.join(rand.choice(tag_words)
+                               for _ in range(rand.randrange(50)))
+        published_at = PUBLISHED_EPOCH + timedelta(
+            seconds=rand.randrange(10 ** 8))
+        thumbnail = {'url': f'https://i.ytimg.com/vi/{video_id}/default.jpg',
+                     'width': 120, 'height': 90}
+        video = {
+            'kind': 'youtube#video', 'id': video_id,
+            'snippet': {
+                'publishedAt': published_at.isoformat() + '.000Z',
+                'channelId': channel_id, 'title': title,
+                'description': description,
+                'thumbnails': {size: thumbnail for size in
+                               ('default', 'medium', 'high', 'standard')},
+                'channelTitle': f'Channel {channel}',
+                'tags': rand.sample(tag_words, rand.randrange(6)),
+                'categoryId': rand.choice(list(categories)),
+                'liveBroadcastContent': 'none',
+                'defaultAudioLanguage': 'en',
+                'localized': {'title': title, 'description': description}},
+            'contentDetails': {
+                'duration': f'PT{rand.randrange(60)}M{rand.randrange(60)}S',
+                'dimension': '2d', 'definition': 'hd', 'caption': 'false',
+                'licensedContent': True, 'projection': 'rectangular'},
+            'statistics': {'viewCount': str(views),
+                           'likeCount': str(views // 50),
+                           'dislikeCount': str(views // 1000),
+                           'favoriteCount': '0',
+                           'commentCount': str(views // 200)},
+            'topicDetails': {
+                'relevantTopicIds': rand.sample(topic_ids, 2),
+                'topicCategories': ['https://en.wikipedia.org/wiki/Music']}}
+        if rand.random() < 0.02:
+            video['liveStreamingDetails'] = {
+                'actualStartTime': video['snippet']['publishedAt'],
+                'actualEndTime': video['snippet']['publishedAt']}
+        if not video['snippet']['tags']:
+            del video['snippet']['tags']
+        return video
+
+    def _refuse(self, params: dict, cost: int):
+        """Returns an error response if the request is to be refused"""
+        with self._lock:
+            if self.key and params.get('key') != self.key:
+                return _api_error(400, 'keyInvalid',
+                                  'Bad Request: API key not valid')
+            if self.quota is not None and self.stats['units'] >= self.quota:
+                return _api_error(403, 'quotaExceeded',
+                                  'The request cannot be completed because '
+                                  'you have exceeded your quota.')
+            now = time.monotonic()
+            while self._recent_requests and (
+                    now - self._recent_requests[0] > 1):
+                self._recent_requests.popleft()
+            if ((self.max_rps and
+                 len(self._recent_requests) >= self.max_rps) or
+                    self._random.random() < self.rate_limit_rate):
+                return _api_error(403, 'rateLimitExceeded',
+                                  'Rate limit exceeded')
+            self._recent_requests.append(now)
+            if self._random.random() < self.error_rate:
+                return _api_error(500, 'backendError', 'Backend Error')
+            self.stats['units'] += cost
+
+    def _list(self, kind: str, params: dict, get_items) -> tuple:
+        parts = [part.strip() for part in params.get('part', '').split(',')
+                 if part.strip()]
+        if not parts:
+            return _api_error(400, 'required', 'Required parameter: part')
+        if self.latency or self.jitter:
+            time.sleep(max(0., self.latency + self.jitter * (
+                2 * self._random.random() - 1)))
+        error = self._refuse(params, 1)
+        if error:
+            return error
+        items = []
+        for item in get_items():
+            item = {key: value for key, value in item.items()
+                    if key in ('kind', 'etag', 'id') or key in parts}
+            item['etag'] = _etag(item)
+            items.append(item)
+        response = {'kind': kind, 'etag': _etag(items),
+                    'pageInfo': {'totalResults': len(items),
+                                 'resultsPerPage': len(items)},
+                    'items': items}
+        if params.get('fields'):
+            response = apply_fields(response,
+                                    parse_fields(params['fields'])[0])
+        return 200, response
+
+    def list_videos(self, params: dict) -> tuple:
+        video_ids = [video_id for video_id in params.get('id', '').split(',')
+                     if video_id][:50]
+
+        def get_items():
+            with self._lock:
+                self._times_requested.update(video_ids)
+                times_requested = [self._times_requested[video_id]
+                                   for video_id in video_ids]
+            for video_id, times in zip(video_ids, times_requested):
+                video = self.video(video_id, times)
+                if video:
+                    yield video
+
+        status, response = self._list('youtube#videoListResponse', params,
+                                      get_items)
+        with self._lock:
+            self.stats['video_requests' if status == 200 else
+                       f'refused_{response["error"]["errors"][0]["reason"]}'
+                       ] += 1
+            if status == 200:
+                self.stats['videos_returned'] += len(response.get('items',
+                                                                  []))
+        return status, response
+
+    def list_categories(self, params: dict) -> tuple:
+        def get_items():
+            for category_id, title in categories.items():
+                yield {'kind': 'youtube#videoCategory', 'id': category_id,
+                       'snippet': {'channelId': 'UCBR8-60-B28hp2BmDPdntcQ',
+                                   'title': title, 'assignable': True}}
+
+        status, response = self._list('youtube#videoCategoryListResponse',
+                                      params, get_items)
+        with self._lock:
+            self.stats['category_requests'] += 1
+        return status, response
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive
+    api: FakeYouTubeApi = None
+    verbose = False
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        params = {key: values[-1] for key, values
+                  in parse_qs(url.query).items()}
+        if url.path == '/discovery/v1/apis/youtube/v3/rest':
+            host, port = self.server.server_address[:2]
+            status, response = 200, self.api.discovery_document(
+                f'http://{host}:{port}/')
+        elif url.path == '/youtube/v3/videos':
+            status, response = self.api.list_videos(params)
+        elif url.path == '/youtube/v3/videoCategories':
+            status, response = self.api.list_categories(params)
+        elif url.path == '/fake/stats':
+            with self.api._lock:
+                status, response = 200, dict(self.api.stats)
+        else:
+            status, response = _api_error(404, 'notFound', 'Not Found')
+        body = json.dumps(response).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=UTF-8')
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gzip.compress(body, compresslevel=1)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format_, *args):
+        if self.verbose:
+            super().log_message(format_, *args)
+
+
+class FakeYouTubeApiServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, api: FakeYouTubeApi, host: str = '127.0.0.1',
+                 port: int = 0, verbose=False):
+        handler = type('Handler', (_Handler,), {'api': api,
+                                                 'verbose': verbose})
+        super().__init__((host, port), handler)
+        self.api = api
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}/'
+
+
+@click.command()
+@click.option('--host', default='127.0.0.1', show_default=True)
+@click.option('-p', '--port', default=8000, show_default=True,
+              help='0 for any free one')
+@click.option('--latency', default=0., show_default=True,
+              help='Seconds every response is delayed by')
+@click.option('--jitter', default=0., show_default=True,
+              help='Seconds the delay varies by, either way')
+@click.option('--error-rate', default=0., show_default=True,
+              help='Share of requests failing with backendError')
+@click.option('--rate-limit-rate', default=0., show_default=True,
+              help='Share of requests refused with rateLimitExceeded')
+@click.option('--max-rps', type=float,
+              help='Requests per second over which they\'re refused with '
+                   'rateLimitExceeded')
+@click.option('--quota', type=int,
+              help='Units after which requests are refused with '
+                   'quotaExceeded')
+@click.option('--removed-rate', default=0.1, show_default=True,
+              help='Share of video IDs that belong to removed videos')
+@click.option('--change-rate', default=0.1, show_default=True,
+              help='Share of videos that change each time they\'re requested')
+@click.option('--key', help='The only API key accepted, any by default')
+@click.option('--seed', default=1, show_default=True)
+@click.option('-v', '--verbose', is_flag=True, help='Log every request')
+def main(host, port, verbose, **api_options):
+    server = FakeYouTubeApiServer(FakeYouTubeApi(**api_options), host, port,
+                                  verbose)
+    # the first line is read by run_api_benchmarks.py to find the port
+    click.echo(f'Serving on {server.url}')
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
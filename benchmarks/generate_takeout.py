@@ -0,0 +1,325 @@
+"""
+Generates synthetic Takeout watch history for benchmarking convert_takeout,
+as real Takeouts can't be shared.
+
+A single, made-up watch history is generated first and then exported as one
+or more Takeout directories, each one covering an overlapping stretch of it,
+same as Takeouts created some time apart do. Each export renders times in its
+own time zone, so overlapping stretches produce time-zone-shifted duplicates.
+Some videos get deleted at some point, turning into "Watched a video that has
+been removed" entries in exports made after that. There are also stories,
+YouTube Music visits, videos with their URL as the title, broken entries and
+unparseable times.
+
+The numbers that get_all_records should arrive at after deduplication are
+saved in expected.json, next to the exports.
+
+Times within 15 hours of the start of a month are avoided, and any two times
+differ in their minutes and seconds if they're within 49 hours (25 hours plus
+the largest possible shift between two time zones) of each other, so that the
+numbers hold for deduplication on local times as well (which is what's left
+to go on where time zones aren't known), not just on UTC times.
+
+Usage: python benchmarks/generate_takeout.py OUTPUT_DIR --entries 100000
+"""
+import json
+import os
+import random
+from array import array
+from datetime import datetime, timedelta
+
+import click
+
+EPOCH = datetime(1970, 1, 1)
+EXPORT_EPOCH = datetime(2019, 6, 1)
+# roughly how far back histories go, so that even the oldest export is named
+# takeout-2..., same as get_watch_history_files expects
+HISTORY_SECONDS = 12 * 365 * 24 * 3600
+MIN_SAME_KEY_DIFFERENCE = (25 + 24) * 3600
+MONTH_START_MARGIN = 15 * 3600
+
+html_head = ('<html><head><meta charset="UTF-8"><title>History</title>'
+             '</head><body><div class="mdl-grid">')
+html_tail = '</div></body></html>'
+html_entry = (
+    '<div class="outer-cell mdl-cell mdl-cell--12-col mdl-shadow--2dp">'
+    '<div class="mdl-grid"><div class="header-cell mdl-cell mdl-cell--12-col">'
+    '<p class="mdl-typography--title">{header}<br></p></div>'
+    '<div class="content-cell mdl-cell mdl-cell--6-col mdl-typography--body-1">'
+    '{body}<br>{time}</div><div class="content-cell mdl-cell mdl-cell--6-col '
+    'mdl-typography--body-1 mdl-typography--text-right"></div>'
+    '<div class="content-cell mdl-cell mdl-cell--12-col mdl-typography--caption">'
+    '<b>Products:</b><br>&emsp;{header}<br></div></div></div>')
+
+removed_text = 'Watched a video that has been removed'
+story_text = 'Watched story'
+music_text = 'Visited YouTube Music'
+
+# kinds of events
+VIDEO, URL_TITLE, REMOVED, STORY, MUSIC, BROKEN, BAD_TIME = range(7)
+kind_weights = {VIDEO: 0.89, URL_TITLE: 0.02, REMOVED: 0.05, STORY: 0.01,
+                MUSIC: 0.02, BROKEN: 0.005, BAD_TIME: 0.005}
+
+title_words = ('Let\'s Play', 'Review', 'Café', 'naïve', '日本語', 'Ελληνικά',
+               'tutorial', '&', '"quoted"', '<b>not bold</b>', 'Пример',
+               'São Paulo', 'episode', 'LIVE', 'ｆｕｌｌｗｉｄｔｈ', 'é')
+
+
+class WatchHistory:
+    """
+    A made-up watch history, newest events first, the way Takeout lists
+    them. Kept in arrays, as it can run into millions of events
+    """
+
+    def __init__(self, entries: int, seed: int):
+        rnd = random.Random(seed)
+        self.times = array('q')
+        self.videos = array('l')
+        self.kinds = array('b')
+        self.video_amount = max(entries // 3, 1)
+        # videos that get deleted at some point, with the time they were
+        self.deleted_at = {}
+
+        kinds, weights = zip(*kind_weights.items())
+        favorites = max(self.video_amount // 50, 1)
+        time = int((EXPORT_EPOCH - EPOCH).total_seconds())
+        max_gap = min(max(2 * HISTORY_SECONDS // entries - 60, 600), 20000)
+        last_seen = {}  # minute * 60 + second: time
+        seen_videos = set()
+        while len(self.times) < entries:
+            time -= rnd.randint(60, max_gap)
+            if (_utc(time).day == 1 or
+                    _utc(time + MONTH_START_MARGIN).day == 1):
+                continue
+            key = time % 3600
+            if key in last_seen and (
+                    last_seen[key] - time <= MIN_SAME_KEY_DIFFERENCE):
+                continue
+            last_seen[key] = time
+
+            kind = rnd.choices(kinds, weights)[0]
+            if rnd.random() < 0.6:
+                video = rnd.randrange(favorites)
+            else:
+                video = rnd.randrange(self.video_amount)
+            if video not in seen_videos:
+                # the first time a video is seen is the last time it's
+                # watched, since the history is generated backwards
+                seen_videos.add(video)
+                if rnd.random() < 0.02:
+                    self.deleted_at[video] = time + rnd.randint(
+                        0, 60 * 60 * 24 * 365)
+            self.times.append(time)
+            self.videos.append(video)
+            self.kinds.append(kind)
+
+    def __len__(self):
+        return len(self.times)
+
+    @staticmethod
+    def video_id(video: int) -> str:
+        return 'v%010d' % video
+
+    def title(self, video: int) -> str:
+        rnd = random.Random(video)
+        return ' '.join(rnd.choice(title_words)
+                        for _ in range(rnd.randint(1, 6))) + f' #{video}'
+
+    @staticmethod
+    def channel(video: int) -> tuple:
+        channel = video % 997
+        return f'UC{channel:022d}', f'Channel {channel} — ünïcode'
+
+
+def _utc(time: int) -> datetime:
+    return EPOCH + timedelta(seconds=time)
+
+
+def _escape(text: str) -> str:
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace(
+        '>', '&gt;').replace('"', '&quot;')
+
+
+def _format_time(time: datetime) -> str:
+    return (f'{time:%b} {time.day}, {time.year}, '
+            f'{(time.hour - 1) % 12 + 1}:{time:%M:%S %p}')
+
+
+def _html_entry(history: WatchHistory, ind: int, export_time: int,
+                offset: int, tz_name: str) -> tuple:
+    """Returns an entry's HTML and whether its video is listed as known"""
+    kind = history.kinds[ind]
+    video = history.videos[ind]
+    video_id = history.video_id(video)
+    url = f'https://www.youtube.com/watch?v={video_id}'
+    header = 'YouTube'
+    known = False
+    if kind == VIDEO and history.deleted_at.get(
+            video, export_time + 1) <= export_time:
+        kind = REMOVED
+    if kind in (VIDEO, BAD_TIME):
+        channel_id, channel_title = history.channel(video)
+        body = (f'Watched&nbsp;<a href="{url}&amp;t=5s">'
+                f'{_escape(history.title(video))}</a><br>'
+                f'<a href="https://www.youtube.com/channel/{channel_id}">'
+                f'{_escape(channel_title)}</a>')
+        known = kind == VIDEO
+    elif kind == URL_TITLE:
+        body = f'Watched&nbsp;<a href="{url}">{url}</a>'
+        known = True
+    elif kind == REMOVED:
+        body = removed_text
+    elif kind == STORY:
+        body = story_text
+    elif kind == MUSIC:
+        body = music_text
+        header = 'YouTube Music'
+    else:
+        body = 'Watched&nbsp;a video that is missing its link'
+    if kind == BAD_TIME:
+        time = 'Smarch 13, 2019, 25:61:00 PM'
+    else:
+        time = _format_time(_utc(history.times[ind] + offset))
+    return html_entry.format(header=header, body=body,
+                             time=f'{time} {tz_name}'), known
+
+
+def _json_entry(history: WatchHistory, ind: int, export_time: int) -> tuple:
+    """The watch-history.json counterpart of _html_entry"""
+    kind = history.kinds[ind]
+    video = history.videos[ind]
+    video_id = history.video_id(video)
+    url = f'https://www.youtube.com/watch?v={video_id}'
+    time = _utc(history.times[ind])
+    entry = {'header': 'YouTube', 'title': removed_text,
+             'time': f'{time:%Y-%m-%dT%H:%M:%S}.{ind % 1000:03d}Z',
+             'products': ['YouTube']}
+    known = False
+    if kind == VIDEO and history.deleted_at.get(
+            video, export_time + 1) <= export_time:
+        kind = REMOVED
+    if kind in (VIDEO, BAD_TIME):
+        channel_id, channel_title = history.channel(video)
+        entry['title'] = 'Watched ' + history.title(video)
+        entry['titleUrl'] = url
+        entry['subtitles'] = [{
+            'name': channel_title,
+            'url': f'https://www.youtube.com/channel/{channel_id}'}]
+        known = kind == VIDEO
+    elif kind == URL_TITLE:
+        entry['title'] = 'Watched ' + url
+        entry['titleUrl'] = url
+        known = True
+    elif kind == STORY:
+        entry['title'] = story_text
+    elif kind == MUSIC:
+        entry['header'] = 'YouTube Music'
+        entry['title'] = music_text
+    elif kind == BROKEN:
+        entry['title'] = 'Watched a video that is missing its link'
+    if kind == BAD_TIME:
+        entry['time'] = 'Smarch 13th'
+    return entry, known
+
+
+def generate_takeout(output_dir: str, entries: int, archives: int = 1,
+                     overlap: float = 0.3, json_archives: int = 0,
+                     seed: int = 1) -> dict:
+    """
+    Generates a watch history and exports it as Takeout directories.
+
+    :param output_dir: directory to create the takeout-* directories in
+    :param entries: the amount of events in the watch history; the exports
+    contain more entries than that, if they overlap
+    :param archives: the amount of Takeout directories to export it into
+    :param overlap: the share of each export's stretch of the history that's
+    also covered by the previous one
+    :param json_archives: export this many of the most recent ones as
+    watch-history.json instead. Their times are in UTC
+    :param seed: seed for the random number generator
+    :return: the contents of expected.json
+    """
+    history = WatchHistory(entries, seed)
+    rnd = random.Random(seed)
+    newest, oldest = history.times[0], history.times[-1]
+    span = (newest - oldest) / archives
+    known_videos = set()
+    has_music = False
+    rendered = 0
+    failed = 0
+    for archive in range(archives):
+        export_time = int(oldest + span * (archive + 1)) + 1
+        start_time = oldest + span * archive - span * overlap
+        offset_hours = 0 if archive == 0 else rnd.randint(-8, 3)
+        tz_name = f'UTC{offset_hours:+d}' if offset_hours else 'UTC'
+        export_name = 'takeout-{:%Y%m%dT%H%M%S}Z-001'.format(
+            _utc(export_time))
+        history_dir = os.path.join(output_dir, export_name, 'Takeout',
+                                   'YouTube', 'history')
+        os.makedirs(history_dir, exist_ok=True)
+        as_json = archive >= archives - json_archives
+        file_name = 'watch-history.json' if as_json else 'watch-history.html'
+
+        with open(os.path.join(history_dir, file_name), 'w',
+                  encoding='utf-8') as file:
+            file.write('[' if as_json else html_head)
+            first = True
+            for ind in range(len(history)):
+                if history.times[ind] > export_time:
+                    continue
+                if history.times[ind] < start_time:
+                    break
+                if as_json:
+                    entry, known = _json_entry(history, ind, export_time)
+                    file.write(('\n' if first else ',\n') + json.dumps(
+                        entry, ensure_ascii=False, indent=2))
+                else:
+                    entry, known = _html_entry(
+                        history, ind, export_time, offset_hours * 3600,
+                        tz_name)
+                    file.write(entry)
+                first = False
+                rendered += 1
+                kind = history.kinds[ind]
+                if known:
+                    known_videos.add(history.videos[ind])
+                has_music = has_music or kind == MUSIC
+                failed += kind in (BROKEN, BAD_TIME)
+            file.write('\n]' if as_json else html_tail)
+
+    broken = sum(kind in (BROKEN, BAD_TIME) for kind in history.kinds)
+    expected = {
+        'seed': seed,
+        'entries': entries,
+        'archives': archives,
+        'overlap': overlap,
+        'json_archives': json_archives,
+        'rendered_entries': rendered,
+        'failed_entries': failed,
+        'total_timestamps': len(history) - broken,
+        # plus one for youtube_music, same as get_all_records counts them
+        'total_videos': len(known_videos) + has_music}
+    with open(os.path.join(output_dir, 'expected.json'), 'w') as file:
+        json.dump(expected, file, indent=4)
+    return expected
+
+
+@click.command()
+@click.argument('output_dir', type=click.Path(file_okay=False))
+@click.option('-n', '--entries', default=10_000, show_default=True,
+              help='Amount of events in the generated watch history')
+@click.option('-a', '--archives', default=1, show_default=True,
+              help='Amount of overlapping Takeout directories to export')
+@click.option('--overlap', default=0.3, show_default=True,
+              help='Share of each export also covered by the previous one')
+@click.option('--json-archives', default=0, show_default=True,
+              help='Export this many of the latest ones as JSON')
+@click.option('--seed', default=1, show_default=True)
+def main(output_dir, entries, archives, overlap, json_archives, seed):
+    expected = generate_takeout(output_dir, entries, archives, overlap,
+                                json_archives, seed)
+    click.echo(json.dumps(expected, indent=4))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,198 @@
+"""
+Measures how fast insert_videos and update_videos get through videos' info
+from the API, using the fake one in fake_youtube_api.py (started in a
+subprocess with the given options), and writes the results to a JSON file so
+they can be compared between commits.
+
+For each size, a new DB is populated with that many made-up Takeout records,
+and then all of them are updated, same as populate_db and update_db do.
+Reported for each are API requests/s, videos/s and the time spent on the DB,
+i.e. everything other than waiting on the API's responses.
+
+Usage: python benchmarks/run_api_benchmarks.py -s 10000 --latency 0.1
+"""
+import json
+import logging
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+from urllib.request import urlopen
+
+import click
+
+from run_benchmarks import _get_commit, repo_dir
+
+sys.path.insert(0, repo_dir)
+from youtubewatched import write_to_sql, youtube
+from youtubewatched.config import DB_NAME
+from youtubewatched.takeout_records import TakeoutRecords
+from youtubewatched.utils.gen import datetime_to_epoch
+from youtubewatched.utils.sql import sqlite_connection
+
+fake_api_path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'fake_youtube_api.py')
+
+
+@contextmanager
+def fake_api(**options):
+    """Runs fake_youtube_api.py in a subprocess, yielding its URL"""
+    args = [sys.executable, fake_api_path, '--port', '0']
+    for key, value in options.items():
+        if value is not None:
+            args += ['--' + key.replace('_', '-'), str(value)]
+    process = subprocess.Popen(args, stdout=subprocess.PIPE)
+    try:
+        line = process.stdout.readline().decode()
+        if not line.startswith('Serving on '):
+            raise RuntimeError('The fake API failed to start')
+        yield line.split()[-1]
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def _get_stats(url: str) -> dict:
+    with urlopen(url + 'fake/stats') as response:
+        return json.loads(response.read().decode())
+
+
+def make_records(size: int, seed: int) -> TakeoutRecords:
+    """Makes up Takeout records for size videos, watched 1-3 times each"""
+    rand = random.Random(seed)
+    records = TakeoutRecords()
+    start = datetime_to_epoch(datetime(2015, 1, 1))
+    for ind in range(size):
+        video_id = f'v{ind:010d}'
+        for _ in range(rand.randint(1, 3)):
+            records.add(video_id, {'title': f'Video {video_id}'},
+                        start + rand.randrange(10 ** 8), 0)
+    records.finalize()
+    return records
+
+
+@contextmanager
+def _timing_api_waits(totals: Counter):
+    """
+    Adds up the time spent waiting on the results of
+    write_to_sql._iter_with_videos_info, i.e. on the API, in totals['wait'],
+    and counts them in totals['videos']
+    """
+    iter_with_videos_info = write_to_sql._iter_with_videos_info
+
+    def timed(*args, **kwargs):
+        results = iter_with_videos_info(*args, **kwargs)
+        while True:
+            start = time.perf_counter()
+            try:
+                result = next(results)
+            except StopIteration:
+                return
+            finally:
+                totals['wait'] += time.perf_counter() - start
+            totals['videos'] += 1
+            yield result
+
+    write_to_sql._iter_with_videos_info = timed
+    try:
+        yield
+    finally:
+        write_to_sql._iter_with_videos_info = iter_with_videos_info
+
+
+def _measure(url: str, size: int, run, phase: str) -> dict:
+    stats_before = _get_stats(url)
+    totals = Counter()
+    stopped_by = None
+    start = time.perf_counter()
+    with _timing_api_waits(totals):
+        try:
+            for _ in run():
+                pass
+        except youtube.ApiQuotaError as e:  # ex. with --quota
+            stopped_by = str(e)
+    seconds = time.perf_counter() - start
+    stats = _get_stats(url)
+    requests = (stats.get('video_requests', 0) -
+                stats_before.get('video_requests', 0))
+    refused = sum(value - stats_before.get(key, 0)
+                  for key, value in stats.items() if key.startswith('refused'))
+    result = {'phase': phase, 'size': size, 'videos': totals['videos'],
+              'seconds': seconds, 'api_requests': requests,
+              'refused_requests': refused,
+              'requests_per_second': requests / seconds,
+              'videos_per_second': totals['videos'] / seconds,
+              'db_seconds': seconds - totals['wait'],
+              'stopped_by': stopped_by}
+    click.echo(f'{size:>9} videos, {phase:<6}: {seconds:8.2f}s, '
+               f'{result["requests_per_second"]:7.1f} requests/s, '
+               f'{result["videos_per_second"]:8.0f} videos/s, '
+               f'DB {result["db_seconds"]:7.2f}s, {refused} refused' +
+               (f', stopped by: {stopped_by}' if stopped_by else ''))
+    return result
+
+
+def run_benchmarks(sizes: list, seed: int, api_options: dict) -> dict:
+    results = {'started_at': datetime.now().isoformat(timespec='seconds'),
+               'commit': _get_commit(),
+               'python': platform.python_version(),
+               'platform': platform.platform(),
+               'api_options': api_options,
+               'runs': []}
+    with fake_api(seed=seed, **api_options) as url, \
+            tempfile.TemporaryDirectory() as db_dir:
+        api_auth = youtube.get_api_auth('fake', base_url=url)
+        for size in sizes:
+            records = make_records(size, seed)
+            db_path = os.path.join(db_dir, f'{size}-{DB_NAME}')
+            conn = sqlite_connection(db_path, types=True)
+            write_to_sql.setup_tables(conn, api_auth)
+            results['runs'].append(_measure(
+                url, size, lambda: write_to_sql.insert_videos(
+                    conn, records, api_auth, 0), 'insert'))
+            conn.close()
+
+            conn = sqlite_connection(db_path)
+            # a negative cutoff and no budget for every video to be updated
+            results['runs'].append(_measure(
+                url, size, lambda: write_to_sql.update_videos(
+                    conn, api_auth, -1, 0, daily_budget=None), 'update'))
+            conn.close()
+    return results
+
+
+@click.command()
+@click.option('-s', '--size', 'sizes', multiple=True, type=int,
+              default=(1000, 10_000), show_default=True,
+              help='Amount of videos; can be repeated')
+@click.option('--latency', default=0.05, show_default=True,
+              help='Seconds every API response is delayed by')
+@click.option('--jitter', default=0.02, show_default=True)
+@click.option('--error-rate', default=0., show_default=True)
+@click.option('--rate-limit-rate', default=0., show_default=True)
+@click.option('--max-rps', type=float)
+@click.option('--quota', type=int)
+@click.option('--removed-rate', default=0.1, show_default=True)
+@click.option('--change-rate', default=0.1, show_default=True)
+@click.option('--seed', default=1, show_default=True)
+@click.option('-o', '--output', type=click.Path(dir_okay=False),
+              default='api_benchmark_results.json', show_default=True)
+@click.option('-v', '--verbose', is_flag=True,
+              help='Show the errors logged along the way')
+def main(sizes, seed, output, verbose, **api_options):
+    """See fake_youtube_api.py for the API's options"""
+    logging.basicConfig(level=logging.WARNING if verbose else logging.CRITICAL)
+    results = run_benchmarks(sizes, seed, api_options)
+    with open(output, 'w') as file:
+        json.dump(results, file, indent=4)
+    click.echo(f'Results written to {output}')
+
+
+if __name__ == '__main__':
+    main()
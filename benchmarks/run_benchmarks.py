@@ -0,0 +1,164 @@
+"""
+Measures get_all_records' throughput, peak memory and the correctness of its
+deduplication on synthetic Takeouts of different sizes (see
+generate_takeout.py), writing the results to a JSON file so they can be
+compared between commits.
+
+Each measurement runs in a fresh process, so that peak memory is that of a
+single run.
+
+Usage: python benchmarks/run_benchmarks.py -s 10000 -s 100000 -o results.json
+"""
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import click
+
+from generate_takeout import generate_takeout
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+modes = {
+    'default': {},
+    'streaming': {'streaming': True},
+    'parallel': {'streaming': True, 'processes': os.cpu_count() or 1}
+}
+
+
+def _peak_rss_mb(children=False) -> float:
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN if children
+                              else resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (2 ** 20 if sys.platform == 'darwin' else 2 ** 10)
+
+
+def measure(takeout_dir: str, mode: str) -> dict:
+    """Runs get_all_records on a directory in the current process"""
+    sys.path.insert(0, repo_dir)
+    from youtubewatched.convert_takeout import get_all_records
+
+    start = time.perf_counter()
+    *_, result = get_all_records(takeout_dir, verbose=False, **modes[mode])
+    seconds = time.perf_counter() - start
+    return {'seconds': seconds,
+            'peak_rss_mb': _peak_rss_mb(),
+            'peak_worker_rss_mb': _peak_rss_mb(children=True),
+            'total_timestamps': result['total_timestamps'],
+            'total_videos': result['total_videos'],
+            'failed_entries': len(result['failed_entries'])}
+
+
+def _measure_in_subprocess(takeout_dir: str, mode: str) -> dict:
+    output = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), '--measure-mode', mode,
+         takeout_dir], stdout=subprocess.PIPE, check=True,
+        cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+    return json.loads(output.decode().splitlines()[-1])
+
+
+def _get_takeout(data_dir: str, size: int, archives: int,
+                 json_archives: int, seed: int) -> tuple:
+    """Generates a synthetic Takeout, unless it's already been generated"""
+    takeout_dir = os.path.join(
+        data_dir, f'takeout-{size}-{archives}-{json_archives}-{seed}')
+    expected_path = os.path.join(takeout_dir, 'expected.json')
+    if os.path.exists(expected_path):
+        with open(expected_path) as file:
+            return takeout_dir, json.load(file)
+    click.echo(f'Generating {size} entries in {takeout_dir}...')
+    return takeout_dir, generate_takeout(
+        takeout_dir, size, archives, json_archives=json_archives, seed=seed)
+
+
+def _get_commit() -> str:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL, cwd=repo_dir,
+            check=True).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return
+
+
+def run_benchmarks(sizes: list, mode_names: list, data_dir: str,
+                   archives: int, json_archives: int, seed: int) -> dict:
+    results = {'started_at': datetime.now().isoformat(timespec='seconds'),
+               'commit': _get_commit(),
+               'python': platform.python_version(),
+               'platform': platform.platform(),
+               'cpu_count': os.cpu_count(),
+               'runs': []}
+    for size in sizes:
+        takeout_dir, expected = _get_takeout(data_dir, size, archives,
+                                             json_archives, seed)
+        for mode in mode_names:
+            run = _measure_in_subprocess(takeout_dir, mode)
+            run.update(
+                size=size, mode=mode, archives=archives,
+                json_archives=json_archives,
+                rendered_entries=expected['rendered_entries'],
+                entries_per_second=(expected['rendered_entries'] /
+                                    run['seconds']),
+                dedup_correct=all(
+                    run[key] == expected[key] for key in
+                    ('total_timestamps', 'total_videos', 'failed_entries')))
+            results['runs'].append(run)
+            click.echo(f'{size:>9} entries, {mode:<9}: '
+                       f'{run["seconds"]:8.2f}s, '
+                       f'{run["entries_per_second"]:9.0f} entries/s, '
+                       f'peak RSS {run["peak_rss_mb"] or 0:7.1f}MB, '
+                       f'dedup {"OK" if run["dedup_correct"] else "WRONG"}')
+    return results
+
+
+@click.command()
+@click.option('-s', '--size', 'sizes', multiple=True, type=int,
+              default=(10_000, 100_000, 1_000_000), show_default=True,
+              help='Amount of watch history events; can be repeated')
+@click.option('-m', '--mode', 'mode_names', multiple=True,
+              type=click.Choice(list(modes)), default=tuple(modes),
+              show_default=True, help='get_all_records options to run with')
+@click.option('-a', '--archives', default=3, show_default=True,
+              help='Amount of overlapping Takeout exports')
+@click.option('--json-archives', default=0, show_default=True,
+              help='Amount of exports in JSON rather than HTML')
+@click.option('--seed', default=1, show_default=True)
+@click.option('-d', '--data-dir', type=click.Path(file_okay=False),
+              help='Where to keep the generated Takeouts (reused between '
+                   'runs), a temporary directory by default')
+@click.option('-o', '--output', type=click.Path(dir_okay=False),
+              default='benchmark_results.json', show_default=True)
+@click.option('--measure-mode', hidden=True)
+@click.argument('measure_dir', required=False)
+def main(sizes, mode_names, archives, json_archives, seed, data_dir, output,
+         measure_mode, measure_dir):
+    if measure_mode:  # a single measurement, in a subprocess
+        click.echo(json.dumps(measure(measure_dir, measure_mode)))
+        return
+    if data_dir:
+        os.makedirs(data_dir, exist_ok=True)
+        results = run_benchmarks(sizes, mode_names, data_dir, archives,
+                                 json_archives, seed)
+    else:
+        with tempfile.TemporaryDirectory() as data_dir:
+            results = run_benchmarks(sizes, mode_names, data_dir, archives,
+                                     json_archives, seed)
+    with open(output, 'w') as file:
+        json.dump(results, file, indent=4)
+    click.echo(f'Results written to {output}')
+    if not all(run['dedup_correct'] for run in results['runs']):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'benchmarks'))
+from fake_youtube_api import FakeYouTubeApi, FakeYouTubeApiServer
+from generate_takeout import generate_takeout
+
+
+@pytest.fixture
+def new_york_time(monkeypatch):
+    """Sets the local time zone to one with DST"""
+    if not hasattr(time, 'tzset'):
+        pytest.skip('time zones can only be changed on Unix')
+    monkeypatch.setenv('TZ', 'America/New_York')
+    time.tzset()
+    yield
+    monkeypatch.undo()
+    time.tzset()
+
+
+@pytest.fixture(scope='session')
+def make_takeout(tmp_path_factory):
+    """
+    Returns a function generating a synthetic Takeout (see
+    benchmarks/generate_takeout.py) with the given arguments, which returns
+    its directory and expected.json
+    """
+    takeouts = {}
+
+    def make(entries: int, archives: int = 1, **kwargs) -> tuple:
+        key = (entries, archives, *sorted(kwargs.items()))
+        if key not in takeouts:
+            takeout_dir = str(tmp_path_factory.mktemp('takeout'))
+            takeouts[key] = takeout_dir, generate_takeout(
+                takeout_dir, entries, archives, **kwargs)
+        return takeouts[key]
+
+    return make
+
+
+@pytest.fixture
+def fake_api():
+    """
+    Serves a FakeYouTubeApi (see benchmarks/fake_youtube_api.py) from a
+    thread, yielding it along with a client for it
+    """
+    from youtubewatched.youtube import get_api_auth
+
+    api = FakeYouTubeApi()
+    server = FakeYouTubeApiServer(api)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield api, get_api_auth('fake', base_url=server.url)
+    finally:
+        server.shutdown()
+        server.server_close()
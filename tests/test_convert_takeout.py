@@ -0,0 +1,382 @@
+import codecs
+import glob
+import io
+import json
+import logging
+import os
+import random
+import shutil
+from datetime import datetime
+
+import pytest
+from click.testing import CliRunner
+
+from youtubewatched import convert_takeout
+from youtubewatched.__main__ import launch
+from youtubewatched.convert_takeout import (
+    SeenEntries, _entry_fingerprints, _fingerprinted_stream_entries,
+    _iter_worker_args, _json_records, _read_pruned_content, _regex_entries,
+    _soup_entries, _with_parsed_times, ambiguous_time_zones, get_all_records,
+    iter_json_array, month_abbrs, parse_time_zone, parse_watched_at_times,
+    prune_watch_history_file, time_zone_offsets, watched_at_format)
+from youtubewatched.utils.gen import datetime_to_epoch
+
+json_item = {
+    'header': 'YouTube',
+    'title': 'Watched Some video',
+    'titleUrl': 'https://www.youtube.com/watch?v=abcdefghijk',
+    'subtitles': [{'name': 'Some channel',
+                   'url': 'https://www.youtube.com/channel/UC123'}],
+    'time': '2019-01-05T22:11:12.345Z'
+}
+
+
+def _html_paths(takeout_dir: str) -> list:
+    return sorted(glob.glob(os.path.join(
+        takeout_dir, '*', 'Takeout', 'YouTube', 'history', '*.html')))
+
+
+def _rss() -> int:
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def test_iter_json_array():
+    text = '[1, {"a": [2, 3]}, "four"]'
+    for chunk_size in (1, 3, 2 ** 20):
+        assert list(iter_json_array(io.StringIO(text), chunk_size)) == [
+            1, {'a': [2, 3]}, 'four']
+
+
+def test_iter_json_array_leading_whitespace():
+    text = ' ' * 10 + '\n\t [1, 2]'
+    assert list(iter_json_array(io.StringIO(text), chunk_size=4)) == [1, 2]
+
+
+@pytest.mark.parametrize('text', ['', '   ', '{"a": 1}', '[1, 2'])
+def test_iter_json_array_invalid(text):
+    with pytest.raises(ValueError):
+        list(iter_json_array(io.StringIO(text), chunk_size=4))
+
+
+def test_json_records_with_bom(tmp_path):
+    path = tmp_path / 'watch-history.json'
+    path.write_bytes(codecs.BOM_UTF8 +
+                     json.dumps([json_item, json_item]).encode('utf-8'))
+    records = [record for _, record in _json_records(str(path))]
+    assert len(records) == 2
+    video_id, values, *_ = records[0]
+    assert video_id == 'abcdefghijk'
+    assert values == {'title': 'Some video', 'channel_id': 'UC123',
+                      'channel_title': 'Some channel'}
+
+
+@pytest.mark.parametrize('zone, offset', [
+    ('EDT', -4 * 3600), ('ACST', 9 * 3600 + 1800), ('GMT+3', 3 * 3600),
+    ('GMT-03:30', -(3 * 3600 + 1800)), ('UTC+0545', 5 * 3600 + 45 * 60)])
+def test_parse_time_zone(zone, offset):
+    assert parse_time_zone(zone) == offset
+
+
+@pytest.mark.parametrize('zone', sorted(ambiguous_time_zones))
+def test_parse_ambiguous_time_zone(zone):
+    assert parse_time_zone(zone) is None
+
+
+def _strptime_epoch(watched_at: str):
+    try:
+        return datetime_to_epoch(datetime.strptime(
+            watched_at[:watched_at.rfind(' ')], watched_at_format))
+    except ValueError:
+        return
+
+
+def test_parse_watched_at_times_matches_strptime():
+    zones = [*time_zone_offsets, *ambiguous_time_zones, 'GMT+03:00',
+             'UTC-0930', 'XYZ']
+    rand = random.Random(1)
+    times = []
+    for _ in range(5000):
+        times.append(f'{rand.choice(month_abbrs)} {rand.randint(1, 31)}, '
+                     f'{rand.randint(1990, 2030)}, {rand.randint(1, 12)}:'
+                     f'{rand.randint(0, 59):02}:{rand.randint(0, 59):02} '
+                     f'{rand.choice("AP")}M {rand.choice(zones)}')
+    times += [
+        # leap days, midnight and noon
+        'Feb 29, 2020, 12:00:00 AM EST', 'Feb 29, 2019, 12:00:00 PM EST',
+        'Dec 31, 1999, 11:59:59 PM UTC', 'Jan 1, 2000, 12:00:01 AM NZDT',
+        # out of range fields, and times that only strptime can make out
+        'Apr 31, 2019, 1:00:00 PM PDT', 'Jun 1, 2019, 13:00:00 PM PDT',
+        'Jun 1, 2019, 0:00:00 AM PDT', 'Jun 1, 2019, 1:60:00 AM PDT',
+        'Jun 01, 2019, 01:02:03 AM PDT', 'Jun 1, 2019, 1:2:3 AM PDT',
+        'June 1, 2019, 1:02:03 AM PDT', 'Jun 1, 2019, 1:02:03 am PDT',
+        'Jun 1, 2019, 1:02:03 AM', 'Jun 1, 2019,  1:02:03 AM PDT',
+        'not a time at all', '']
+    expected = [_strptime_epoch(watched_at) for watched_at in times]
+    assert parse_watched_at_times(times) == expected
+    assert None in expected
+    # a single one, and one per call
+    assert parse_watched_at_times(times[:1]) == expected[:1]
+    assert parse_watched_at_times([]) == []
+
+
+@pytest.mark.parametrize('zone', sorted(time_zone_offsets) +
+                         sorted(ambiguous_time_zones))
+def test_parsed_times_time_zones(zone):
+    watched_at = f'May 31, 2019, 10:45:38 PM {zone}'
+    record = ('abcdefghijk', {}, watched_at)
+    (_, parsed), = _with_parsed_times([(None, 'text', record)])
+    offset = time_zone_offsets.get(zone)
+    assert parsed == ('abcdefghijk', {}, _strptime_epoch(watched_at),
+                      None if offset is None else int(offset * 3600))
+
+
+def test_watermark_cuts_files_short(make_takeout):
+    takeout_dir, expected = make_takeout(500)
+    *_, result = get_all_records(takeout_dir, verbose=False)
+    assert result['total_timestamps'] == expected['total_timestamps']
+    assert len(result['parsed_files']) == 1
+
+    *_, result = get_all_records(takeout_dir, verbose=False,
+                                 watermark=datetime(2019, 5, 20))
+    assert 0 < result['total_timestamps'] < expected['total_timestamps']
+    # the older entries haven't been ingested, so the file shouldn't be
+    # recorded as ingested either
+    assert not result['failed_files']
+    assert not result['parsed_files']
+
+
+# entries with fluff, multi-byte characters, and combining ones that could
+# be split off from what they combine with by a chunk boundary
+unicode_entry = (
+    '<div class="outer-cell mdl-cell mdl-cell--12-col mdl-shadow--2dp">'
+    '<div class="mdl-grid"><div class="header-cell mdl-cell mdl-cell--12-col">'
+    '<p class="mdl-typography--title">YouTube<br></p></div>'
+    '<div class="content-cell mdl-cell mdl-cell--6-col mdl-typography--body-1">'
+    'Watched <a href="https://www.youtube.com/watch?v=abcdefghijk">'
+    'Cafe\u0301 \u00e9t\u00e9 \U0001F600 \uFB01 &amp; a\u0308\u0301</a>'
+    '<br>Jan 5, 2019, 10:11:12 PM EST</div>'
+    '<div class="content-cell mdl-cell mdl-cell--6-col '
+    'mdl-typography--body-1 mdl-typography--text-right"></div>'
+    '<div class="content-cell mdl-cell mdl-cell--12-col mdl-typography'
+    '--caption"><b>Products:</b><br>&emsp;YouTube<br></div></div></div>')
+
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 3, 7, 64, 1000, 2 ** 20])
+def test_prune_matches_in_memory(make_takeout, tmp_path, chunk_size):
+    takeout_dir, _ = make_takeout(300)
+    generated, = _html_paths(takeout_dir)
+    with open(generated, encoding='utf-8') as watch_file:
+        contents = [watch_file.read()]
+    contents.append(
+        '<html><head></head><body><div class="mdl-grid">' +
+        unicode_entry * 20 + '</div></body></html>')
+    for ind, content in enumerate(contents):
+        path = str(tmp_path / f'{ind}.html')
+        with open(path, 'w', encoding='utf-8') as watch_file:
+            watch_file.write(content)
+        expected = _read_pruned_content(path)
+        assert prune_watch_history_file(path, chunk_size)
+        with open(path, encoding='utf-8') as watch_file:
+            assert watch_file.read() == expected
+        # already pruned
+        assert not prune_watch_history_file(path, chunk_size)
+        assert _read_pruned_content(path) == expected
+
+
+def test_prune_without_body(tmp_path):
+    path = str(tmp_path / 'watch-history.html')
+    with open(path, 'w', encoding='utf-8') as watch_file:
+        watch_file.write('<html><head></head></html>')
+    assert not prune_watch_history_file(path)
+    with open(path, encoding='utf-8') as watch_file:
+        assert watch_file.read() == '<html><head></head></html>'
+
+
+@pytest.mark.parametrize('pruned', [False, True])
+def test_stream_entries_match_soup(make_takeout, tmp_path, monkeypatch,
+                                   pruned):
+    takeout_dir, _ = make_takeout(3000, 3)
+    # small enough for the parser to be replaced many times per file
+    monkeypatch.setattr(convert_takeout, 'parser_input_limit', 2 ** 12)
+    for path in _html_paths(takeout_dir):
+        if pruned:
+            path = shutil.copy(path, str(tmp_path / 'watch-history.html'))
+            prune_watch_history_file(path)
+        expected = list(_soup_entries(_read_pruned_content(path)))
+        assert len(expected) > 500
+        for seen in (None, SeenEntries()):
+            entries = [entry for _, entry in
+                       _fingerprinted_stream_entries(path, seen=seen)]
+            assert entries == expected
+
+
+@pytest.mark.skipif(not os.path.exists('/proc/self/statm'),
+                    reason='needs /proc to measure memory')
+def test_stream_entries_memory(make_takeout):
+    takeout_dir, _ = make_takeout(40000)
+    path, = _html_paths(takeout_dir)
+    size = os.path.getsize(path)  # about 30MB
+    rss = []
+    for ind, _ in enumerate(_fingerprinted_stream_entries(path)):
+        if not ind % 1000:
+            rss.append(_rss())
+    assert ind == 39999
+    # against the peak of the first quarter, by which the buffers have all
+    # been allocated
+    growth = max(rss[10:]) - max(rss[:10])
+    assert growth < size / 4
+
+
+def _records_summary(result: dict) -> tuple:
+    return (sorted(result['failed_entries']),
+            [path for path, *_ in result['parsed_files']],
+            {video_id: (record['timestamps'], record.get('title'))
+             for video_id, record in result['videos'].items()})
+
+
+@pytest.mark.parametrize('streaming', [False, True])
+def test_parallel_matches_sequential(make_takeout, tmp_path, streaming):
+    takeout_dir, expected = make_takeout(2000, 2)
+    takeout_dir = shutil.copytree(takeout_dir, str(tmp_path / 'takeout'))
+    # an identical newer export, whose entries are all known by then; its
+    # failed ones still get listed again, same as in sequence
+    newest = sorted(glob.glob(os.path.join(takeout_dir, 'takeout-*')))[-1]
+    shutil.copytree(newest, os.path.join(
+        takeout_dir, 'takeout-20200101T000000Z-001'))
+    *_, sequential = get_all_records(takeout_dir, verbose=False,
+                                     streaming=streaming)
+    *_, parallel = get_all_records(takeout_dir, verbose=False,
+                                   streaming=streaming, processes=2)
+    assert sequential['total_timestamps'] == expected['total_timestamps']
+    assert len(sequential['failed_entries']) > expected['failed_entries']
+    assert _records_summary(parallel) == _records_summary(sequential)
+
+
+@pytest.mark.parametrize('streaming', [False, True])
+def test_worker_args_known_entries(make_takeout, tmp_path, streaming):
+    takeout_dir, _ = make_takeout(2000, 2)
+    paths = _html_paths(takeout_dir)
+    paths.append(shutil.copy(paths[-1], str(tmp_path / 'watch-history.html')))
+    known_lists = [None] * 3
+    args = list(_iter_worker_args([(path, None) for path in paths],
+                                  streaming, False, None, known_lists))
+    assert all(arg[-1] is known for arg, known in zip(args, known_lists))
+    fingerprints = _entry_fingerprints(paths[-1], streaming)
+    assert len(fingerprints) > 500
+    assert len(known_lists[0]) == 0
+    # the exports are in different time zones, so they share no entries
+    assert len(known_lists[1]) == 0
+    assert known_lists[2].tolist() == fingerprints.tolist()
+
+
+def _cached_run(takeout_dir: str, cache_dir: str, caplog, **kwargs):
+    """Returns the records and the paths of the files loaded from the cache"""
+    caplog.clear()
+    with caplog.at_level(logging.INFO, logger=convert_takeout.__name__):
+        *_, result = get_all_records(takeout_dir, verbose=False,
+                                     cache_dir=cache_dir, **kwargs)
+    prefix = 'Loaded previously parsed records of '
+    return result, [record.getMessage()[len(prefix):]
+                    for record in caplog.records
+                    if record.getMessage().startswith(prefix)]
+
+
+@pytest.mark.parametrize('processes', [1, 2])
+def test_cache_matches_parsing(make_takeout, tmp_path, caplog, processes):
+    takeout_dir, _ = make_takeout(2000, 2)
+    takeout_dir = shutil.copytree(takeout_dir, str(tmp_path / 'takeout'))
+    newest = sorted(glob.glob(os.path.join(takeout_dir, 'takeout-*')))[-1]
+    shutil.copytree(newest, os.path.join(
+        takeout_dir, 'takeout-20200101T000000Z-001'))
+    paths = _html_paths(takeout_dir)
+    *_, expected = get_all_records(takeout_dir, verbose=False)
+
+    result, loaded = _cached_run(takeout_dir, str(tmp_path), caplog,
+                                 processes=processes)
+    assert not loaded
+    assert _records_summary(result) == _records_summary(expected)
+    result, loaded = _cached_run(takeout_dir, str(tmp_path), caplog,
+                                 processes=processes)
+    assert loaded == paths
+    assert _records_summary(result) == _records_summary(expected)
+    assert result['parsed_files'] == expected['parsed_files']
+
+
+def test_cache_staleness(make_takeout, tmp_path, caplog):
+    takeout_dir, _ = make_takeout(2000, 3)
+    takeout_dir = shutil.copytree(takeout_dir, str(tmp_path / 'takeout'))
+    paths = _html_paths(takeout_dir)
+    _cached_run(takeout_dir, str(tmp_path), caplog)
+
+    # the files after a changed one skipped the entries that were in it, so
+    # they're parsed again too
+    with open(paths[1], 'a') as watch_file:
+        watch_file.write('\n')
+    *_, expected = get_all_records(takeout_dir, verbose=False)
+    result, loaded = _cached_run(takeout_dir, str(tmp_path), caplog)
+    assert loaded == paths[:1]
+    assert _records_summary(result) == _records_summary(expected)
+    result, loaded = _cached_run(takeout_dir, str(tmp_path), caplog)
+    assert loaded == paths
+    # replaced, rather than added to
+    assert len(glob.glob(str(tmp_path / 'parsed_takeout' / '*.bin'))) == 3
+
+    # a touched file is hashed again, and still loaded if it's the same
+    os.utime(paths[2], (0, 0))
+    result, loaded = _cached_run(takeout_dir, str(tmp_path), caplog)
+    assert loaded == paths
+    # a file whose cache file is unreadable is parsed again
+    with open(str(tmp_path / 'parsed_takeout' / 'index.json')) as index_file:
+        cache_file_name = json.load(index_file)[paths[0]][3]
+    with open(str(tmp_path / 'parsed_takeout' / cache_file_name),
+              'r+b') as cache_file:
+        cache_file.truncate(100)
+    result, loaded = _cached_run(takeout_dir, str(tmp_path), caplog)
+    assert loaded == paths[1:]
+    assert _records_summary(result) == _records_summary(expected)
+
+
+@pytest.mark.parametrize('body', [
+    'Watched <a href="https://www.youtube.com/watch?v=abcdefghijk">'
+    'Some &amp; video</a><br><a href="https://www.youtube.com/channel/UC1">'
+    'Some channel</a><br>Jan 5, 2019, 10:11:12 PM EST',
+    'Watched <a href="https://www.youtube.com/watch?v=abcdefghijk">'
+    '\u00a0 spaced  \t out </a><br>Jan 5, 2019, 10:11:12 PM EST',
+    'Watched a video that has been removed<br>Jan 5, 2019, 10:11:12 PM EST',
+    'Watched <a href="https://www.youtube.com/watch?v=abcdefghijk">'
+    '&eacute;t&eacute; &#x1F600; &bogus;</a><br>Jan 5, 2019, 10:11:12 PM EST',
+    'Watched <b>bold</b> <a href="https://www.youtube.com/watch?v='
+    'abcdefghijk">video</a><br>Jan 5, 2019, 10:11:12 PM EST',
+])
+def test_regex_entries_match_soup(body):
+    content = ('<div class="awesome_class">' + body + '</div>') * 2
+    assert list(_regex_entries(content)) == list(_soup_entries(content))
+
+
+def test_regex_entries_match_soup_nested_divs():
+    content = ('<div class="awesome_class">Watched <div>a</div> video</div>'
+               '<div class="awesome_class">Watched<br>Jan 5, 2019</div>')
+    assert list(_regex_entries(content)) == list(_soup_entries(content))
+
+
+def test_regex_entries_match_soup_takeout(make_takeout):
+    takeout_dir, _ = make_takeout(3000, 3)
+    for path in _html_paths(takeout_dir):
+        content = _read_pruned_content(path)
+        expected = list(_soup_entries(content))
+        assert len(expected) > 500
+        assert list(_regex_entries(content)) == expected
+
+
+def test_compare_extractors_command(make_takeout, monkeypatch):
+    takeout_dir, _ = make_takeout(500)
+    result = CliRunner().invoke(launch, ['--compare-extractors', takeout_dir])
+    assert result.exit_code == 0
+    assert ': 0 mismatching entries' in result.output
+
+    monkeypatch.setattr(convert_takeout, '_regex_entry',
+                        lambda body: ('', None, None, None, None))
+    result = CliRunner().invoke(launch, ['--compare-extractors', takeout_dir])
+    assert result.exit_code == 1
+    assert ': 0 mismatching entries' not in result.output
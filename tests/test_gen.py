@@ -0,0 +1,222 @@
+import bisect
+import random
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import pytest
+
+from youtubewatched.config import MAX_TIME_DIFFERENCE
+from youtubewatched.utils import gen
+from youtubewatched.utils.gen import (TimestampIndex, TokenBucket, WatchTimes,
+                                      datetime_to_epoch, epoch_to_datetime,
+                                      guess_utc_epoch,
+                                      remove_known_timestamps)
+
+
+# the sorted-list helpers TimestampIndex and WatchTimes replaced, as they were
+def _are_different_timestamps(ts1: datetime, ts2: datetime) -> bool:
+    if ts1.replace(day=1, hour=0) == ts2.replace(day=1, hour=0):
+        return False
+    return True
+
+
+def _remove_timestamps_from_one_list_from_another(filter_, filteree):
+    for timestamp in filter_:
+        start = bisect.bisect_left(filteree,
+                                   timestamp - MAX_TIME_DIFFERENCE)
+        end = bisect.bisect_right(filteree,
+                                  timestamp + MAX_TIME_DIFFERENCE)
+        if start != end:
+            for potential_duplicate in range(start, end):
+                if not _are_different_timestamps(
+                        timestamp, filteree[potential_duplicate]):
+                    filteree.pop(potential_duplicate)
+                    break
+
+
+def _timestamp_is_unique_in_list(candidate, timestamps, insert=False):
+    start = bisect.bisect_left(timestamps,
+                               candidate - MAX_TIME_DIFFERENCE)
+    end = bisect.bisect_right(timestamps,
+                              candidate + MAX_TIME_DIFFERENCE)
+    if start == end and start == 0:  # no similar records found
+        if insert:
+            bisect.insort_left(timestamps, candidate)
+    else:
+        for incumbent in range(start, end):
+            if not _are_different_timestamps(candidate,
+                                             timestamps[incumbent]):
+                return False
+        else:
+            if insert:
+                bisect.insort_left(timestamps, candidate)
+    return True
+
+
+def _timestamps(bases: list, amount: int, seed: int = 1) -> list:
+    """
+    Timestamps whole hours away from the bases, up to a bit over
+    MAX_TIME_DIFFERENCE either way, so that many of them are duplicates,
+    some by exactly MAX_TIME_DIFFERENCE, and a few a second further off
+    """
+    rand = random.Random(seed)
+    hours = int(MAX_TIME_DIFFERENCE.total_seconds()) // 3600
+    timestamps = []
+    for _ in range(amount):
+        timestamp = rand.choice(bases) + timedelta(
+            hours=rand.randint(-hours - 2, hours + 2))
+        if rand.random() < 0.1:
+            timestamp += timedelta(seconds=rand.choice((-1, 1)))
+        timestamps.append(timestamp)
+    return timestamps
+
+
+# month boundaries, where timestamps 25h apart can differ by month
+bases = [datetime(2019, 1, 31, 23, 15, 42), datetime(2019, 2, 1, 0, 15, 42),
+         datetime(2019, 6, 15, 12, 0, 0), datetime(2019, 12, 31, 23, 59, 59)]
+# around the DST transitions in America/New_York
+dst_bases = [datetime(2019, 3, 10, 2, 30, 0), datetime(2019, 11, 3, 1, 30, 0)]
+
+
+def test_timestamp_index_edges():
+    index = TimestampIndex([bases[2]])
+    assert bases[2] + MAX_TIME_DIFFERENCE in index
+    assert bases[2] - MAX_TIME_DIFFERENCE in index
+    assert bases[2] + MAX_TIME_DIFFERENCE + timedelta(hours=1) not in index
+    assert bases[2] + timedelta(seconds=1) not in index
+    # an hour apart, but in different months
+    assert TimestampIndex([bases[0]]).find(bases[1]) is None
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_timestamp_index_matches_bisect(seed):
+    timestamps = _timestamps(bases + dst_bases, 2000, seed)
+    expected = []
+    index = TimestampIndex()
+    for timestamp in timestamps:
+        assert (timestamp in index) == (
+            not _timestamp_is_unique_in_list(timestamp, expected))
+        assert index.add(timestamp) == _timestamp_is_unique_in_list(
+            timestamp, expected, insert=True)
+    assert len(index) == len(expected) < len(timestamps)
+    assert index.sorted() == expected
+
+    # added in order, the duplicate removed is the earliest, same as before
+    index = TimestampIndex(expected)
+    for timestamp in _timestamps(bases + dst_bases, 500, seed + 100):
+        removed = index.remove_duplicate(timestamp)
+        before = len(expected)
+        _remove_timestamps_from_one_list_from_another([timestamp], expected)
+        assert (removed is not None) == (len(expected) < before)
+        assert index.sorted() == expected
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_watch_times_guessed_matches_bisect(new_york_time, seed):
+    # with every UTC time guessed, only local times are compared, as before.
+    # The local times that don't exist when DST starts are guessed to be an
+    # hour later, which they're duplicates of either way
+    expected = []
+    watch_times = WatchTimes()
+    for local in _timestamps(dst_bases + bases, 2000, seed):
+        utc = guess_utc_epoch(datetime_to_epoch(local))
+        assert watch_times.add(local, utc, True) == (
+            _timestamp_is_unique_in_list(local, expected, insert=True))
+    assert len(watch_times) == len(expected)
+    assert sorted(local for local, _, _ in watch_times) == expected
+
+
+def test_watch_times_known_zones(new_york_time):
+    watch_times = WatchTimes()
+    # the same local time, an hour apart, as DST ends
+    local = datetime(2019, 11, 3, 1, 30)
+    edt_utc = datetime_to_epoch(local) + 4 * 3600
+    assert watch_times.add(local, edt_utc, False)
+    assert watch_times.add(local, edt_utc + 3600, False)
+    assert not watch_times.add(local + timedelta(hours=5), edt_utc, False)
+    # a guessed one is matched on local times, same as before
+    assert watch_times.find(local + timedelta(hours=25), 0, True) in (
+        edt_utc, edt_utc + 3600)
+    assert watch_times.find(local + timedelta(hours=26), 0, True) is None
+    assert watch_times.remove_duplicate(local, 0, True) is not None
+    assert len(watch_times) == 1
+
+    # known ones are matched to guessed ones on local times too
+    watch_times = WatchTimes()
+    guessed_utc = guess_utc_epoch(datetime_to_epoch(local))
+    assert watch_times.add(local, guessed_utc, True)
+    assert not watch_times.add(local - timedelta(hours=3), 1, False)
+    assert watch_times.add(local - timedelta(hours=3, seconds=1), 2, False)
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_remove_known_timestamps_matches_loop(seed):
+    # clustered, so that known timestamps compete for the same unknown ones
+    unknown = _timestamps(bases + dst_bases, 1000, seed)
+    known = _timestamps(bases + dst_bases, 300, seed + 100)
+    # each known timestamp, in order, removes its earliest duplicate
+    expected = sorted(unknown)
+    _remove_timestamps_from_one_list_from_another(sorted(known), expected)
+    assert len(unknown) - len(known) <= len(expected) < len(unknown)
+
+    unknown_epochs = [datetime_to_epoch(timestamp) for timestamp in unknown]
+    known_epochs = [datetime_to_epoch(timestamp) for timestamp in known]
+    remaining = remove_known_timestamps(unknown_epochs, known_epochs)
+    assert [epoch_to_datetime(epoch) for epoch in remaining.tolist()] == (
+        expected)
+    # the order they're passed in doesn't matter
+    random.Random(seed).shuffle(known_epochs)
+    assert remove_known_timestamps(
+        unknown_epochs[::-1], known_epochs).tolist() == remaining.tolist()
+
+
+def test_remove_known_timestamps_empty():
+    assert remove_known_timestamps([3, 1, 2], []).tolist() == [1, 2, 3]
+    assert remove_known_timestamps([], [1]).tolist() == []
+
+
+@pytest.fixture
+def fake_clock(monkeypatch):
+    """Replaces the time TokenBucket goes by with one that only moves on
+    when it sleeps, returning the list of the seconds slept"""
+    now = [0.]
+    sleeps = []
+
+    def sleep(seconds: float):
+        sleeps.append(seconds)
+        now[0] += seconds
+
+    monkeypatch.setattr(gen, 'time', SimpleNamespace(
+        monotonic=lambda: now[0], sleep=sleep))
+    return sleeps
+
+
+def test_token_bucket_rate(fake_clock):
+    limiter = TokenBucket(10)
+    for _ in range(10):  # a full bucket's worth at once
+        limiter.acquire()
+    assert not fake_clock
+    for _ in range(10):
+        limiter.acquire()
+    assert fake_clock == pytest.approx([0.1] * 10)
+    assert limiter.acquired == 20
+
+
+def test_token_bucket_back_off_and_recovery(fake_clock):
+    limiter = TokenBucket(10, min_rate=0.5)
+    limiter.back_off()
+    assert limiter.rate == 5
+    # the tokens left are dropped, so the next request waits at the new rate
+    limiter.acquire()
+    assert fake_clock == pytest.approx([0.2])
+    for _ in range(10):
+        limiter.back_off()
+    assert limiter.rate == 0.5
+    # each request brings the rate back up by a twentieth of the initial one
+    for ind in range(1, 20):
+        limiter.acquire()
+        assert limiter.rate == pytest.approx(min(10, 0.5 + ind * 0.5))
+    limiter.acquire()
+    assert limiter.rate == 10
+    assert sum(fake_clock) < 10
+
@@ -0,0 +1,56 @@
+from datetime import datetime
+
+from youtubewatched.takeout_records import TakeoutRecords
+from youtubewatched.utils.gen import datetime_to_epoch
+
+# 2019-01-05 10:11:12 local time in New York (UTC-5)
+watched_at = datetime_to_epoch(datetime(2019, 1, 5, 10, 11, 12))
+est = -5 * 3600
+
+
+def _make_records(*timestamps) -> TakeoutRecords:
+    records = TakeoutRecords()
+    records.add('unknown', {})
+    for video_id, epoch, utc_offset in timestamps:
+        records.add(video_id, {}, epoch, utc_offset)
+    records.finalize()
+    return records
+
+
+def test_same_utc_time():
+    records = _make_records(('v', watched_at, est),
+                            ('v', watched_at + 3600, est + 3600))
+    assert len(records['v']['timestamps']) == 1
+
+
+def test_different_utc_times():
+    records = _make_records(('v', watched_at, est),
+                            ('v', watched_at + 3600, est))
+    assert len(records['v']['timestamps']) == 2
+
+
+def test_ambiguous_zone_duplicate():
+    # the same watch in an archive rendered in an ambiguous zone, ex. CST
+    # (UTC-6 in the US, but UTC+8 in China), in either order
+    explicit = ('v', watched_at, est)
+    ambiguous = ('v', watched_at - 3600, None)
+    for timestamps in ((explicit, ambiguous), (ambiguous, explicit)):
+        records = _make_records(*timestamps)
+        assert len(records['v']['timestamps']) == 1
+
+
+def test_ambiguous_zone_different_times():
+    records = _make_records(('v', watched_at, est),
+                            ('v', watched_at - 3600 + 60, None))
+    assert len(records['v']['timestamps']) == 2
+
+
+def test_ambiguous_zone_unknown_duplicate():
+    records = _make_records(('unknown', watched_at - 3600, None),
+                            ('v', watched_at, est),
+                            ('unknown', watched_at + 60, est))
+    assert records['unknown']['timestamps'] == [
+        datetime(2019, 1, 5, 10, 12, 12)]
+    records = _make_records(('unknown', watched_at, est),
+                            ('v', watched_at - 3600, None))
+    assert records['unknown']['timestamps'] == []
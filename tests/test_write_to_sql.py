@@ -0,0 +1,349 @@
+import sqlite3
+from datetime import datetime, timedelta
+from typing import Union
+
+import pytest
+
+from youtubewatched import write_to_sql, youtube
+from youtubewatched.config import video_keys_and_columns
+from youtubewatched.takeout_records import TakeoutRecords
+from youtubewatched.utils.gen import TokenBucket
+from youtubewatched.utils.sql import sqlite_connection
+from youtubewatched.write_to_sql import add_utc_timestamps
+
+
+def test_add_utc_timestamps_keeps_dst_collisions(new_york_time):
+    conn = sqlite3.connect(':memory:')
+    conn.execute('''CREATE TABLE videos_timestamps (
+                    video_id text, watched_at timestamp,
+                    unique(video_id, watched_at))''')
+    # 2:30 doesn't exist on the day DST starts, so it's guessed to be 3:30
+    watched_at = ['2019-03-10 02:30:00', '2019-03-10 03:30:00',
+                  '2019-07-01 12:00:00']
+    conn.executemany('INSERT INTO videos_timestamps VALUES (?, ?)',
+                     [('v', value) for value in watched_at])
+    add_utc_timestamps(conn)
+    rows = conn.execute('''SELECT watched_at, watched_at_utc
+                           FROM videos_timestamps''').fetchall()
+    assert sorted(value for value, _ in rows) == watched_at
+    assert len({utc for _, utc in rows}) == 3
+    assert dict(rows)['2019-07-01 12:00:00'] == 1561996800
+
+
+@pytest.fixture
+def fake_api_db(fake_api, tmp_path):
+    """A DB with 200 videos inserted from the fake API, and a connection"""
+    api, api_auth = fake_api
+    records = TakeoutRecords()
+    for ind in range(200):
+        records.add(f'v{ind:010d}', {'title': 'Some video'},
+                    1500000000 + ind * 1000, 0)
+    records.finalize()
+    conn = sqlite_connection(str(tmp_path / 'yt.sqlite'), types=True)
+    write_to_sql.setup_tables(conn, api_auth)
+    for _ in write_to_sql.insert_videos(conn, records, api_auth, 0):
+        pass
+    conn.close()
+    # as update_db opens it
+    conn = sqlite_connection(str(tmp_path / 'yt.sqlite'))
+    yield api, api_auth, conn
+    conn.close()
+
+
+def test_update_videos_skips_unchanged_etags(fake_api_db, monkeypatch):
+    api, api_auth, conn = fake_api_db
+    active = {video_id for video_id, in conn.execute(
+        "SELECT id FROM videos WHERE status = 'active'")}
+    # the ones whose view counts go up each time they're requested
+    changing = {video_id for video_id in active
+                if api.video(video_id, 1) != api.video(video_id, 2)}
+    assert changing and len(changing) < len(active)
+    conn.execute("UPDATE videos SET last_updated = '2000-01-01 00:00:00'")
+    conn.commit()
+    etags = dict(conn.execute('SELECT id, etag FROM videos'))
+    assert all(etags[video_id] for video_id in active)
+
+    wrangled, touched = [], []
+    wrangle_video_record = write_to_sql.wrangle_video_record
+    touch_video = write_to_sql.touch_video
+    monkeypatch.setattr(write_to_sql, 'wrangle_video_record', lambda info: (
+        wrangled.append(info['id']) or wrangle_video_record(info)))
+    monkeypatch.setattr(write_to_sql, 'touch_video', lambda conn, video_id,
+                        verbose: touched.append(video_id) or
+                        touch_video(conn, video_id, verbose))
+    for _ in write_to_sql.update_videos(conn, api_auth, 0, 0,
+                                        daily_budget=None):
+        pass
+    assert set(wrangled) == changing
+    assert set(touched) == active - changing
+    stale = conn.execute("""SELECT count(*) FROM videos
+                            WHERE last_updated < '2001-01-01'""").fetchone()
+    assert stale == (0,)
+    new_etags = dict(conn.execute('SELECT id, etag FROM videos'))
+    assert {video_id for video_id in active
+            if new_etags[video_id] != etags[video_id]} == changing
+
+
+def test_iter_with_videos_info(fake_api):
+    api, api_auth = fake_api
+    video_ids = [f'v{ind:010d}' for ind in range(120)]
+    removed = {video_id for video_id in video_ids
+               if api.video(video_id) is None}
+    assert removed
+    results = list(write_to_sql._iter_with_videos_info(
+        video_ids, api_auth, limiter=TokenBucket(1000)))
+    assert [video_id for video_id, _ in results] == video_ids
+    for video_id, info in results:
+        if video_id in removed:
+            assert info is None
+        else:
+            assert info['id'] == video_id
+            assert info['snippet']['title'] == f'Video {video_id}'
+    # 50 at a time
+    assert api.stats['video_requests'] == 3
+    assert api.stats['videos_returned'] == len(video_ids) - len(removed)
+
+
+def test_iter_with_videos_info_needs_info(fake_api):
+    api, api_auth = fake_api
+    video_ids = [f'v{ind:010d}' for ind in range(120)]
+    needed = set(video_ids[::3])
+    results = list(write_to_sql._iter_with_videos_info(
+        video_ids, api_auth, needs_info=needed.__contains__,
+        limiter=TokenBucket(1000)))
+    assert [video_id for video_id, _ in results] == video_ids
+    assert {video_id for video_id, info in results if info} == {
+        video_id for video_id in needed if api.video(video_id)}
+    assert api._times_requested.keys() == needed
+
+
+def test_iter_with_videos_info_failing(fake_api, monkeypatch):
+    api, api_auth = fake_api
+    api.error_rate = 1
+    monkeypatch.setattr(write_to_sql.time, 'sleep', lambda seconds: None)
+    video_ids = [f'v{ind:010d}' for ind in range(60)]
+    results = list(write_to_sql._iter_with_videos_info(
+        video_ids, api_auth, limiter=TokenBucket(1000)))
+    assert results == [(video_id, False) for video_id in video_ids]
+    # each batch attempted 5 times
+    assert api.stats['refused_backendError'] == 10
+
+
+def test_fetch_videos_info_backs_off(monkeypatch):
+    responses = [youtube.ApiRateLimitError(), youtube.ApiRateLimitError(),
+                 {'abcdefghijk': {'id': 'abcdefghijk'}}]
+
+    def get_videos_info(video_ids, api_auth):
+        response = responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    monkeypatch.setattr(youtube, 'get_videos_info', get_videos_info)
+    limiter = TokenBucket(100)
+    assert write_to_sql._fetch_videos_info(
+        ['abcdefghijk'], None, limiter) == {
+        'abcdefghijk': {'id': 'abcdefghijk'}}
+    assert limiter.acquired == 3
+    assert limiter.rate < 100
+
+    # it gives up after 5 attempts
+    responses = [youtube.ApiRateLimitError()] * 5
+    with pytest.raises(youtube.ApiRateLimitError):
+        write_to_sql._fetch_videos_info(['abcdefghijk'], None, limiter)
+    assert not responses
+
+
+@pytest.fixture
+def due_videos_db():
+    """
+    A DB with videos last updated on various days and watched various
+    amounts of times, along with the order they're due to be updated in
+    """
+    conn = sqlite3.connect(':memory:')
+    for table in ('videos', 'videos_timestamps', 'api_quota_usage'):
+        conn.execute('CREATE TABLE ' + write_to_sql.TABLE_SCHEMAS[table])
+    now = datetime.utcnow().replace(microsecond=0)
+    # (ID, title, status, days since last updated, times watched)
+    videos = [('recent', 'A', 'active', 0, 9),
+              ('deleted', 'B', 'deleted', 30, 9),
+              ('unknown', 'unknown', 'active', 30, 9),
+              ('music', 'YouTube Music', 'active', 30, 9),
+              ('b_old_once', 'C', 'active', 30, 1),
+              ('a_old_twice', 'D', 'inactive', 30, 2),
+              ('c_old_twice', 'E', 'active', 30, 2),
+              ('oldest', 'F', 'active', 60, 0),
+              ('older', 'G', 'active', 40, 5)]
+    for video_id, title, status, days, times_watched in videos:
+        conn.execute('''INSERT INTO videos (id, title, status, last_updated)
+                        VALUES (?, ?, ?, ?)''', (
+            video_id, title, status, str(now - timedelta(days=days))))
+        conn.executemany('''INSERT INTO videos_timestamps
+                            (video_id, watched_at) VALUES (?, ?)''',
+                         [(video_id, str(now - timedelta(days=ind)))
+                          for ind in range(times_watched)])
+    yield conn, ['oldest', 'older', 'a_old_twice', 'c_old_twice',
+                 'b_old_once']
+    conn.close()
+
+
+def test_get_videos_due(due_videos_db):
+    conn, expected = due_videos_db
+    assert write_to_sql.get_videos_due(conn) == expected
+    assert write_to_sql.get_videos_due(conn, 45 * 86400) == ['oldest']
+    assert write_to_sql.get_videos_due(conn, 90 * 86400) == []
+
+
+def test_get_update_schedule(due_videos_db, monkeypatch):
+    conn, _ = due_videos_db
+    # 2 videos per request, to keep the numbers small
+    monkeypatch.setattr(youtube, 'MAX_IDS_PER_REQUEST', 2)
+    schedule = write_to_sql.get_update_schedule(conn, daily_budget=1)
+    assert schedule == {'records_due': 5, 'quota_used_today': 0,
+                        'daily_budget': 1, 'days_to_refresh': 2}
+    assert write_to_sql.get_update_schedule(
+        conn, daily_budget=3)['days_to_refresh'] == 0
+    write_to_sql.add_quota_used(conn, 2)
+    schedule = write_to_sql.get_update_schedule(conn, daily_budget=3)
+    assert schedule['quota_used_today'] == 2
+    assert schedule['days_to_refresh'] == 1
+    write_to_sql.add_quota_used(conn, 5)
+    assert write_to_sql.get_update_schedule(
+        conn, daily_budget=3)['days_to_refresh'] == 1
+    assert write_to_sql.get_update_schedule(
+        conn, daily_budget=0)['days_to_refresh'] is None
+
+
+def test_update_videos_budget(fake_api_db):
+    api, api_auth, conn = fake_api_db
+    conn.execute("UPDATE videos SET last_updated = '2000-01-01 00:00:00'")
+    conn.execute("""UPDATE videos SET last_updated = '1999-01-01 00:00:00'
+                    WHERE id >= 'v0000000150'""")
+    conn.commit()
+    due = write_to_sql.get_videos_due(conn, 0)
+    assert due[:3] == ['v0000000150', 'v0000000151', 'v0000000152']
+    used = write_to_sql.get_quota_used(conn)
+    requests = api.stats['video_requests']
+
+    # only the first 100 fit in 2 requests, and the rest are due first next
+    for _ in write_to_sql.update_videos(conn, api_auth, 0, 0,
+                                        daily_budget=used + 2):
+        pass
+    assert api.stats['video_requests'] - requests == 2
+    assert write_to_sql.get_quota_used(conn) == used + 2
+    assert write_to_sql.get_videos_due(conn, 86400) == due[100:]
+    # nothing left of the budget
+    for _ in write_to_sql.update_videos(conn, api_auth, 0, 0,
+                                        daily_budget=used + 2):
+        pass
+    assert api.stats['video_requests'] - requests == 2
+
+
+# the generic extraction wrangle_video_record replaced, as it was
+def _get_final_key_paths(
+        obj: Union[dict, list, tuple], cur_path: str = '',
+        append_values: bool = False,
+        paths: list = None, black_list: list = None,
+        final_keys_only: bool = False):
+    if paths is None:
+        paths = []
+
+    if isinstance(obj, (dict, list, tuple)):
+        if isinstance(obj, dict):
+            for key in obj:
+                new_path = cur_path + f'[\'{key}\']'
+                if isinstance(obj[key], dict):
+                    if black_list is not None and key in black_list:
+                        continue
+                    _get_final_key_paths(
+                        obj[key], new_path, append_values, paths, black_list,
+                        final_keys_only)
+                elif isinstance(obj[key], (list, tuple)):
+                    _get_final_key_paths(
+                        obj[key], new_path, append_values, paths, black_list,
+                        final_keys_only)
+                else:
+                    if final_keys_only:
+                        last_bracket = new_path.rfind('[\'')
+                        new_path = new_path[
+                                   last_bracket+2:new_path.rfind('\'')]
+                    if append_values:
+                        to_append = [new_path, obj[key]]
+                    else:
+                        to_append = new_path
+                    paths.append(to_append)
+        else:
+            key_added = False
+            for i in range(len(obj)):
+                if isinstance(obj[i], (dict, tuple, list)):
+                    _get_final_key_paths(
+                        obj[i], cur_path + f'[{i}]', append_values,
+                        paths, black_list, final_keys_only)
+                else:
+                    if not key_added:
+                        if final_keys_only:
+                            last_bracket = cur_path.rfind('[\'')
+                            cur_path = cur_path[
+                                       last_bracket+2:cur_path.rfind('\'')]
+                        if append_values:
+                            to_append = [cur_path, obj]
+                        else:
+                            to_append = cur_path
+                        paths.append(to_append)
+                        key_added = True
+
+    return paths
+
+
+def _baseline_wrangle_video_record(json_obj: dict):
+    entry_dict = {}
+    for key, value in _get_final_key_paths(
+            json_obj, '', True, black_list=['localized', 'thumbnails'],
+            final_keys_only=True):
+        if key in video_keys_and_columns:
+            key = write_to_sql._video_columns[key]
+            if key == 'relevant_topic_ids':
+                value = list(set(value))
+            elif key == 'duration':
+                value = write_to_sql.convert_duration(value)
+            elif key == 'published_at':
+                value = value.replace('T', ' ')
+            elif key == 'actual_start_time':
+                key = 'stream'
+                value = 'true'
+            elif key in ['view_count', 'dislike_count', 'like_count',
+                         'comment_count']:
+                value = int(value)
+            entry_dict[key] = value
+    return entry_dict
+
+
+def _sorted_topics(record: dict) -> dict:
+    if 'relevant_topic_ids' in record:
+        record['relevant_topic_ids'].sort()
+    return record
+
+
+def test_wrangle_video_record_matches_key_paths(fake_api):
+    api, api_auth = fake_api
+    video_ids = [f'v{ind:010d}' for ind in range(500)]
+    items = {}
+    for start in range(0, len(video_ids), youtube.MAX_IDS_PER_REQUEST):
+        items.update(youtube.get_videos_info(
+            video_ids[start:start + youtube.MAX_IDS_PER_REQUEST], api_auth))
+    # fetched with VIDEO_FIELDS, the way update_videos gets them
+    assert any('liveStreamingDetails' in item for item in items.values())
+    assert any('tags' not in item['snippet'] for item in items.values())
+    for item in items.values():
+        record = write_to_sql.wrangle_video_record(item)
+        assert _sorted_topics(record) == _sorted_topics(
+            _baseline_wrangle_video_record(item))
+        assert 'stream' in record or 'liveStreamingDetails' not in item
+        assert {'id', 'title', 'duration', 'view_count'} <= set(record)
+    # the whole of each part, the way they were requested before
+    for video_id in video_ids:
+        item = api.video(video_id)
+        if item is not None:
+            assert _sorted_topics(
+                write_to_sql.wrangle_video_record(item)) == _sorted_topics(
+                _baseline_wrangle_video_record(item))
@@ -1,3 +1,5 @@
+import sys
+
 import click
 
 from youtubewatched.config import PORT
@@ -8,11 +10,37 @@ from youtubewatched.config import PORT
               help='Enable debugging mode (Flask)')
 @click.option('-p', '--port', default=PORT,
               help=f'Server port (default: {PORT})')
-def launch(debug, port):
+@click.option('--compare-extractors', 'takeout_path',
+              type=click.Path(exists=True),
+              help='Check that the fast and the Beautiful Soup '
+                   'watch-history.html parsers agree on the files in this '
+                   'Takeout directory, instead of starting the server')
+def launch(debug, port, takeout_path):
+    if takeout_path:
+        compare_extractors(takeout_path)
+        return
     # import is here as the --help command takes way too long otherwise
     from youtubewatched.dash_layout import dash_app
     dash_app.run_server(port=port, debug=debug)
 
 
+def compare_extractors(takeout_path: str):
+    """
+    Runs compare_entry_extractors on each watch-history.html file and exits
+    with a non-zero status if any of them has mismatching entries
+    """
+    from youtubewatched.convert_takeout import (
+        compare_entry_extractors, get_watch_history_files)
+    mismatched_files = 0
+    for path in get_watch_history_files(takeout_path):
+        if not path.endswith('.html'):
+            continue
+        mismatches = compare_entry_extractors(path)
+        click.echo(f'{path}: {len(mismatches)} mismatching entries')
+        mismatched_files += bool(mismatches)
+    if mismatched_files:
+        sys.exit(1)
+
+
 if __name__ == '__main__':
     launch()
@@ -1,3 +1,4 @@
+import os
 from datetime import timedelta
 
 PORT = 5000
@@ -20,15 +21,59 @@ video_keys_and_columns = (
     'actualStartTime'
 )
 
+# how many requests to the YouTube API to have in flight at once, and how many
+# to start per second at most; the latter is lowered whenever the API reports
+# its rate limit being exceeded, see utils.gen.TokenBucket
+API_FETCHERS = 4
+API_REQUESTS_PER_SECOND = 10
+# seconds to wait on a response from the API before retrying
+API_REQUEST_TIMEOUT = 30
+# where the document describing the API is kept after being downloaded once,
+# see youtube.get_discovery_document
+API_DISCOVERY_CACHE_DIR = os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or
+    os.path.join(os.path.expanduser('~'), '.cache'), 'youtubewatched')
+
+# another server to send the API requests to instead of Google's, ex. the fake
+# API in benchmarks/fake_youtube_api.py
+API_BASE_URL = os.environ.get('YOUTUBEWATCHED_API_URL')
+
+# quota units a videos().list request costs, however many IDs and parts it
+# asks for, and how many of them update_videos may spend per day, counting
+# those spent by inserting. The quota is reset at midnight Pacific Time
+API_UNITS_PER_VIDEOS_REQUEST = 1
+API_DAILY_UPDATE_BUDGET = 10000
+
 video_parts_to_get = ','.join([
-    "contentDetails",  # 2
-    "id",  # 0
-    "snippet",  # 2
-    "statistics",  # 2
-    "topicDetails",  # 2
-    "liveStreamingDetails"  # 2
+    "contentDetails",
+    "id",
+    "snippet",
+    "statistics",
+    "topicDetails",
+    "liveStreamingDetails"
 ])
 
+# the part of the API's video resources each of video_keys_and_columns is in,
+# None for the top level. Only those are requested, see youtube.VIDEO_FIELDS
+video_keys_parts = {
+    'id': None,
+    'publishedAt': 'snippet',
+    'channelId': 'snippet',
+    'title': 'snippet',
+    'description': 'snippet',
+    'channelTitle': 'snippet',
+    'tags': 'snippet',
+    'categoryId': 'snippet',
+    'defaultAudioLanguage': 'snippet',
+    'duration': 'contentDetails',
+    'viewCount': 'statistics',
+    'likeCount': 'statistics',
+    'dislikeCount': 'statistics',
+    'commentCount': 'statistics',
+    'relevantTopicIds': 'topicDetails',
+    'actualStartTime': 'liveStreamingDetails'
+}
+
 '''YouTube Takeout seems to return timestamps in local time,
 but without a concrete timezone.
 In case archives were downloaded in different parts of the world, the same 
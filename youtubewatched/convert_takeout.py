@@ -1,17 +1,36 @@
-import itertools
+import codecs
+import hashlib
+import html
+import json
 import logging
+import mmap
 import os
 import re
+import struct
+import sys
+import tempfile
+import time
 import unicodedata
 
-from datetime import datetime
+from datetime import datetime, timezone
+from collections import deque, namedtuple
+from functools import lru_cache
+from itertools import chain, zip_longest
+from multiprocessing import get_context, TimeoutError as PoolTimeoutError
 from os.path import join
 from typing import Union
 
+import numpy as np
 from bs4 import BeautifulSoup as BSoup
+from lxml import etree
 
-from youtubewatched.utils.gen import (
-    timestamp_is_unique_in_list, remove_timestamps_from_one_list_from_another)
+from youtubewatched.config import MAX_TIME_DIFFERENCE
+from youtubewatched.takeout_records import (
+    TakeoutRecords, write_section, read_section)
+from youtubewatched.utils.archive import (
+    ReadCounter, is_archive, split_archive_path, find_archive_members,
+    open_binary, open_text, get_size_and_mtime, get_uncompressed_size)
+from youtubewatched.utils.gen import datetime_to_epoch
 
 logger = logging.getLogger(__name__)
 
@@ -47,6 +66,7 @@ as divs with the same class also wrap every video entry individually.
 
 watch_url_re = re.compile(r'watch\?v=')
 channel_url_re = re.compile(r'youtube\.com/channel')
+json_separators_re = re.compile(r'[\s,]*')
 dt_re = re.compile(
     r'[a-zA-Z]{3} \d{1,2}, \d{4}, \d{1,2}:\d{1,2}:\d{1,2} [APM]{2} ')
 
@@ -60,22 +80,42 @@ def extract_video_id_from_url(url):
     return video_id
 
 
+watch_history_extensions = ('.html', '.json')
+
+
+def _is_watch_history_member(name: str) -> bool:
+    dir_name, file_name = os.path.split(name)
+    return (dir_name.endswith('/history') and
+            file_name.startswith('watch-history') and
+            file_name.endswith(watch_history_extensions))
+
+
 def get_watch_history_files(takeout_path: str = '.'):
     """
-    Locates watch-history.html files in a given path.
+    Locates watch-history.html (or watch-history.json) files in a given path.
 
     Only works if the provided path points to any of the following:
      - a single file itself, ex.
      <root dir>/Takeout/YouTube/history/watch-history.html
+     - a single Takeout .zip/.tgz archive
      - a directory with watch-history file(s)
-     - a directory with directories of extracted Takeout archives
+     - a directory with directories of extracted Takeout archives and/or the
+     archives themselves
+
+    Files inside archives are returned as paths going through the archive, ex.
+    <root dir>/takeout-20181120T163352Z-001.zip/Takeout/YouTube/history/
+    watch-history.html, and are read without being extracted.
 
     The search will become confined to one of these types after the first
     match, i.e. if a watch-history file is found in the directory that was
     passed, it'll continue looking for those within the same directory, but not
     in Takeout directories.
-    Processing will be slightly faster if the files are ordered chronologically.
+    Processing is slightly faster if the files are ordered chronologically, so
+    they're returned sorted by modification time, or, for Takeout directories,
+    by the archive creation time in their names.
     """
+    if is_archive(takeout_path):
+        return find_archive_members(takeout_path, _is_watch_history_member)
     if os.path.isfile(takeout_path):
         if 'watch-history' in takeout_path:
             return [takeout_path]
@@ -85,19 +125,30 @@ def get_watch_history_files(takeout_path: str = '.'):
     dir_contents = os.listdir(takeout_path)
     watch_histories = []
     for path in dir_contents:
-        if path.startswith('watch-history') and path.endswith('.html'):
+        if path.startswith('watch-history') and path.endswith(
+                watch_history_extensions):
             watch_histories.append(os.path.join(takeout_path, path))
 
     if watch_histories:
+        watch_histories.sort(key=os.path.getmtime)
         return watch_histories  # assumes a directory with a single
         # watch-history file or with multiple ones (with something appended to
         # the end of their file names)
-    for path in dir_contents:
-        if path.startswith('takeout-2') and path[-5:-3] == 'Z-':
-            full_path = os.path.join(takeout_path, path, 'Takeout', 'YouTube',
-                                     'history', 'watch-history.html')
-            if os.path.exists(full_path):
-                watch_histories.append(os.path.join(takeout_path, full_path))
+    for path in sorted(dir_contents):
+        if path.startswith('takeout-2') and is_archive(
+                os.path.join(takeout_path, path)):
+            # multi-part archives only have watch history in one of the parts
+            watch_histories.extend(find_archive_members(
+                os.path.join(takeout_path, path), _is_watch_history_member))
+        elif path.startswith('takeout-2') and path[-5:-3] == 'Z-':
+            history_dir = os.path.join(takeout_path, path, 'Takeout',
+                                       'YouTube', 'history')
+            for extension in watch_history_extensions:
+                full_path = os.path.join(history_dir,
+                                         'watch-history' + extension)
+                if os.path.exists(full_path):
+                    watch_histories.append(full_path)
+                    break
             else:
                 logger.warning(f'Expected watch-history.html in {path}, '
                                f'found none')
@@ -105,10 +156,12 @@ def get_watch_history_files(takeout_path: str = '.'):
     return watch_histories
 
 
+# what each entry starts with in an unpruned file
+entry_cell_start = ('<div class="outer-cell mdl-cell mdl-cell--12-col '
+                    'mdl-shadow--2dp">')
 fluff = [  # the order should not be changed
     ('<div class="mdl-grid">', ''),
-    ('<div class="outer-cell mdl-cell mdl-cell--12-col '
-     'mdl-shadow--2dp">', ''),
+    (entry_cell_start, ''),
     ('<div class="header-cell mdl-cell mdl-cell--12-col">'
      '<p class="mdl-typography--title">YouTube<br></p></div>', ''),
     ('"content-cell mdl-cell mdl-cell--6-col mdl-typography--body-1"',
@@ -123,144 +176,1228 @@ fluff = [  # the order should not be changed
 ]
 done_ = '<span id="Done">'
 
+ascii_spaces = '\x20\x0a\x09\x0c\x0d'
+entry_classes = (
+    'awesome_class',
+    'content-cell mdl-cell mdl-cell--6-col mdl-typography--body-1')
+
+entry_div_start = '<div class="awesome_class">'
+entry_div_re = re.compile(entry_div_start + r'(.*?)</div>', re.S)
+entry_tag_re = re.compile(r'<a href="([^"<>]*)">([^<>]*)</a>|<br>')
+# text, links with nothing but text inside them, and line breaks
+entry_body_re = re.compile(r'(?:[^<>]+|<a href="[^"<>]*">[^<>]*</a>|<br>)*')
+# characters and entities that lxml may not treat the same as html.unescape
+unsafe_text_re = re.compile(
+    r'[\x00-\x08\x0b-\x1f\x7f]|&(?!(?:amp|lt|gt|quot|nbsp|#\d{1,5});)')
+
 removed_string = 'Watched a video that has been removed'
 story_string = 'Watched story'
 
 
-def get_all_records(takeout_path: str = '.',
-                    dump_json_to_dir: str = None, prune_html=False,
-                    verbose=True) -> Union[dict, bool]:
+def _release_element(element):
+    """Frees an already processed element and its preceding siblings"""
+    element.clear()
+    parent = element.getparent()
+    if parent is not None:
+        while element.getprevious() is not None:
+            del parent[0]
+
+
+def _normalized_chunks(file, chunk_size: int = 2 ** 20):
+    """
+    Reads a text file in chunks, NFKD-normalizing each one. A chunk's trailing
+    characters are held back until the next one, in case they combine with
+    what follows
     """
-    Accumulates records from all found watch-history.html files and returns
-    them in a dict.
+    return _normalize_chunks(iter(lambda: file.read(chunk_size), ''))
 
-    :param takeout_path: directory containing Takeout directories or
-    watch-history.html files, or a path to one of those files directly
-    :param dump_json_to_dir: saves the dict with accumulated records to a
-    json file
-    :param prune_html: prunes HTML that doesn't allow or slows down the
-    processing of files with Beautiful Soup
-    :param verbose:
-    :return:
+
+def _normalize_chunks(chunks):
+    """NFKD-normalizes an iterable of text chunks, see _normalized_chunks"""
+    leftover = ''
+    for chunk in chunks:
+        chunk = leftover + chunk
+        cut = len(chunk) - 1
+        while cut > 0 and unicodedata.combining(chunk[cut]):
+            cut -= 1
+        leftover = chunk[cut:]
+        yield unicodedata.normalize('NFKD', chunk[:cut])
+    if leftover:
+        yield unicodedata.normalize('NFKD', leftover)
+
+
+def _fingerprint(text: str) -> int:
+    """
+    Hashes an entry's raw HTML into a 64-bit int, the same in every process,
+    unlike hash, see SeenEntries
     """
+    return int.from_bytes(hashlib.blake2b(
+        text.encode(), digest_size=8).digest(), 'little', signed=True)
 
-    watch_files = get_watch_history_files(takeout_path)
-    if not watch_files:
-        logger.warning('Found no watch-history files.')
-        return {}
 
-    occ_dict = {'videos': {'unknown': {'timestamps': []}},
-                'failed_entries': [],
-                'failed_files': []}
+class SeenEntries:
+    """
+    Fingerprints (hashes of the raw HTML) of the entries of the files parsed so
+    far, so that entries of later files that are already known can be skipped
+    before any of the costly parts of parsing them.
 
-    failed_entries = 0
+    A Takeout holds the entire history up to when it was exported, so nearly
+    all of it is usually in the next one too, down to the byte, unless they're
+    in different time zones. Only entries seen in previous files are skipped,
+    as a file's own duplicates are deduplicated the usual way, and only ones
+    that were parsed successfully are remembered, so failed ones still get
+    listed as such. Their entry texts are kept under failed, by fingerprint.
 
-    def add_failed_parse_entry_to_list(div_text):
-        nonlocal failed_entries
-        occ_dict['failed_entries'].append(div_text)
-        failed_entries += 1
+    If known is passed, those fingerprints are treated as having been seen in
+    previous files, see _parse_watch_history_files. Once a file has ended, its
+    own fingerprints and failed entries are left under file_fingerprints and
+    file_failed, see ParsedFileCache
+    """
 
-    watch_files_amount = len(watch_files)
-    for ind, watch_file_path in enumerate(watch_files):
-        yield ind, watch_files_amount
-        try:
-            with open(watch_file_path, 'r', encoding='utf-8') as watch_file:
-                content = unicodedata.normalize('NFKD', watch_file.read())
-                original_content = content
-        except UnicodeDecodeError:
-            occ_dict['failed_files'].append(watch_file_path)
-            logger.error(f'Failed to decode {watch_file_path}')
+    __slots__ = ('_previous', '_current', 'skipped', 'failed',
+                 'file_fingerprints', 'file_failed')
+
+    def __init__(self, known=()):
+        self._previous = set(known)
+        self._current = set()
+        self.skipped = 0  # by the current file
+        self.failed = {}  # by the current file
+        self.file_fingerprints = set()
+        self.file_failed = {}
+
+    def is_known(self, fingerprint: int) -> bool:
+        return fingerprint in self._previous
+
+    def add(self, fingerprint: int):
+        self._current.add(fingerprint)
+
+    def add_known(self, fingerprints):
+        """Makes the entries of a file that wasn't parsed with this known"""
+        self._previous.update(fingerprints)
+
+    def end_file(self) -> int:
+        """Makes the current file's entries known to the next ones and
+        returns how many of its own were skipped"""
+        self._previous |= self._current
+        self.file_fingerprints, self._current = self._current, set()
+        self.file_failed, self.failed = self.failed, {}
+        skipped, self.skipped = self.skipped, 0
+        return skipped
+
+
+def _split_entry_spans(chunks, marker: str, hold_back: int = 100):
+    """
+    Re-splits text chunks into (is_entry, text) tuples, where text is either a
+    whole entry, from one marker up to the next one, or a part of what comes
+    before the first one or after the last one. The last hold_back characters
+    before the first marker is found are held back until the next chunk, so
+    that neither it nor anything else as long gets split
+    """
+    buffer = ''
+    in_entries = False
+    for chunk in chunks:
+        buffer += chunk
+        if not in_entries:
+            start = buffer.find(marker)
+            if start == -1:
+                if len(buffer) > hold_back:
+                    yield False, buffer[:-hold_back]
+                    buffer = buffer[-hold_back:]
+                continue
+            if start:
+                yield False, buffer[:start]
+            buffer = buffer[start:]
+            in_entries = True
+        start = 0
+        while True:
+            end = buffer.find(marker, start + 1)
+            if end == -1:
+                break
+            yield True, buffer[start:end]
+            start = end
+        buffer = buffer[start:]
+    if buffer:
+        yield False, buffer
+
+
+def _fingerprinted_stream_entries(watch_file_path: str,
+                                  counter: ReadCounter = None,
+                                  seen: SeenEntries = None):
+    """
+    Incrementally parses a watch-history.html file, pruned or not, and yields
+    its entries one at a time, in the same form as _soup_entries does, as
+    (fingerprint, entry) tuples. Only the entry that's currently being
+    processed is kept in memory, no matter the size of the file. If counter
+    is passed, the bytes read from the file are reported to it.
+
+    The file is fed to the parser an entry at a time. If seen is passed, the
+    entries it already knows of aren't fed at all, with None yielded in place
+    of them. Otherwise, fingerprints are always None.
+
+    lxml's HTML parser holds on to all of the input it's been fed, so it's
+    replaced with a new one at the start of the next entry once it's been fed
+    parser_input_limit characters
+    """
+    parser = _new_entry_parser()
+    fed = 0  # characters fed to the current parser
+    # fingerprints of the entries that have been fed, in order
+    fingerprints = deque()
+    with open_text(watch_file_path, counter=counter) as watch_file:
+        pruned, pieces = _entry_spans(watch_file)
+        for is_entry, piece in pieces:
+            if seen is not None:
+                fingerprint, entries = _span_fingerprint(is_entry, piece)
+                if fingerprint is not None and seen.is_known(fingerprint):
+                    seen.skipped += 1
+                    yield fingerprint, None
+                    continue
+                fingerprints.extend([fingerprint] * entries)
+            if not pruned:
+                # the same newlines the fluff pruning surrounds tags with, so
+                # that entries' text comes out the same as with Beautiful Soup
+                piece = piece.replace('<', '\n<').replace('>', '>\n')
+            if is_entry and fed > parser_input_limit:
+                parser.close()
+                yield from _parsed_entries(parser, fingerprints)
+                parser = _new_entry_parser()
+                fed = 0
+            parser.feed(piece)
+            fed += len(piece)
+            yield from _parsed_entries(parser, fingerprints)
+    parser.close()
+    yield from _parsed_entries(parser, fingerprints)
+
+
+def _entry_spans(watch_file) -> tuple:
+    """
+    Splits a watch-history.html file into its entries, see _split_entry_spans,
+    returning whether it's been pruned and the (is_entry, text) tuples
+    """
+    chunks = _normalized_chunks(watch_file)
+    first_chunk = next(chunks, '')
+    pruned = first_chunk.startswith(done_)
+    chunks = chain([first_chunk], chunks)
+    return pruned, _split_entry_spans(
+        chunks, entry_div_start if pruned else entry_cell_start)
+
+
+def _span_fingerprint(is_entry: bool, span: str) -> tuple:
+    """
+    Returns the fingerprint of a span returned by _entry_spans, which is None
+    unless it's exactly one entry, and the amount of entries in it
+    """
+    entries = sum(span.count(f'class="{class_}"') for class_ in entry_classes)
+    if is_entry and entries == 1:
+        return _fingerprint(span), entries
+    return None, entries
+
+
+# see _fingerprinted_stream_entries
+parser_input_limit = 2 ** 20
+
+
+def _new_entry_parser():
+    return etree.HTMLPullParser(events=('end',), tag='div')
+
+
+def _parsed_entries(parser, fingerprints: deque):
+    """
+    Yields (fingerprint, entry) tuples for the entries the parser has got
+    through, taking their fingerprints from the start of fingerprints
+    """
+    for entry in _entries_from_events(parser.read_events()):
+        yield fingerprints.popleft() if fingerprints else None, entry
+
+
+def _entries_from_events(events):
+    for _, div in events:
+        class_ = div.get('class')
+        if class_ in entry_classes:
+            all_text = ''.join(
+                _soup_like_string(text) for text in div.itertext()).strip()
+            url = channel = None
+            for a in div.iter('a'):
+                href = a.get('href', '')
+                if url is None and watch_url_re.search(href):
+                    url = a
+                elif channel is None and channel_url_re.search(href):
+                    channel = a
+            yield (all_text,
+                   None if url is None else url.get('href'),
+                   None if url is None else _stripped_text(url),
+                   None if channel is None else channel.get('href'),
+                   None if channel is None else _stripped_text(channel))
+            _release_element(div)
+        elif class_ and class_.startswith('outer-cell'):
+            _release_element(div)
+
+
+def _soup_like_string(text: str) -> str:
+    """Collapses whitespace-only strings the same way Beautiful Soup does"""
+    if text.strip(ascii_spaces):
+        return text
+    return '\n' if '\n' in text else ' '
+
+
+def _stripped_text(element) -> str:
+    return ''.join(piece.strip() for piece in element.itertext())
+
+
+def _soup_entry(div) -> tuple:
+    all_text = div.get_text().strip()
+    url = div.find(href=watch_url_re)
+    channel = div.find(href=channel_url_re)
+    return (all_text,
+            None if url is None else url['href'],
+            None if url is None else url.get_text(strip=True),
+            None if channel is None else channel['href'],
+            None if channel is None else channel.get_text(strip=True))
+
+
+def _soup_entries(content: str):
+    """
+    Parses the whole of (pruned) watch-history.html content with Beautiful
+    Soup and yields a tuple of the following for each entry:
+    (all_text, video_url, video_title, channel_url, channel_title)
+    """
+    soup = BSoup(content, 'lxml')
+    for div in soup.find_all('div', class_='awesome_class'):
+        yield _soup_entry(div)
+
+
+def _regex_entry(body: str):
+    """
+    Extracts the same tuple _soup_entry does from the inside of an entry's
+    div, if it only consists of text, links and line breaks, which is what
+    nearly all of them look like after pruning. Returns None otherwise
+    """
+    if not entry_body_re.fullmatch(body) or unsafe_text_re.search(body):
+        return
+    texts = []
+    url = video_title = channel_url = channel_title = None
+    pos = 0
+    for match in entry_tag_re.finditer(body):
+        texts.append(body[pos:match.start()])
+        href, link_text = match.groups()
+        if href is not None:
+            texts.append(link_text)
+            href = html.unescape(href)
+            if url is None and watch_url_re.search(href):
+                url = href
+                video_title = html.unescape(link_text).strip()
+            if channel_url is None and channel_url_re.search(href):
+                channel_url = href
+                channel_title = html.unescape(link_text).strip()
+        pos = match.end()
+    texts.append(body[pos:])
+    all_text = ''.join(_soup_like_string(html.unescape(text))
+                       for text in texts if text).strip()
+    return all_text, url, video_title, channel_url, channel_title
+
+
+def _regex_entries(content: str):
+    """
+    A faster take on _soup_entries which pulls entries out of pruned content
+    with regular expressions instead of building a tree of the whole of it.
+    Entries that don't look as expected are parsed with Beautiful Soup one at
+    a time, as is the whole file if any entry has other divs inside it
+    """
+    for _, entry in _fingerprinted_regex_entries(content):
+        yield entry
+
+
+def _fingerprinted_regex_entries(content: str, seen: SeenEntries = None):
+    """
+    Does what _regex_entries does, yielding (fingerprint, entry) tuples, same
+    as _fingerprinted_stream_entries
+    """
+    bodies = _entry_bodies(content)
+    if bodies is None:
+        logger.debug('Unexpected entry structure, parsing the whole file '
+                     'with Beautiful Soup')
+        for entry in _soup_entries(content):
+            yield None, entry
+        return
+    for body in bodies:
+        fingerprint = None
+        if seen is not None:
+            fingerprint = _fingerprint(body)
+            if seen.is_known(fingerprint):
+                seen.skipped += 1
+                yield fingerprint, None
+                continue
+        entry = _regex_entry(body)
+        if entry is None:
+            entry = _soup_entry(BSoup(
+                entry_div_start + body + '</div>', 'lxml').div)
+        yield fingerprint, entry
+
+
+def _entry_bodies(content: str):
+    """
+    Returns the insides of the entries' divs in pruned content, or None if
+    any of them has other divs inside it
+    """
+    bodies = entry_div_re.findall(content)
+    if (len(bodies) == content.count('awesome_class') and
+            not any('<div' in body for body in bodies)):
+        return bodies
+
+
+def compare_entry_extractors(watch_file_path: str) -> list:
+    """
+    Runs both the regex and the Beautiful Soup extractors on a
+    watch-history.html file and logs any entries they disagree on.
+
+    :return: a list of (entry index, regex entry, Beautiful Soup entry)
+    tuples, with one of the entries being None if the amounts differ
+    """
+    content = _read_pruned_content(watch_file_path)
+    mismatches = []
+    for ind, (regex_entry, soup_entry) in enumerate(
+            zip_longest(_regex_entries(content), _soup_entries(content))):
+        if regex_entry != soup_entry:
+            mismatches.append((ind, regex_entry, soup_entry))
+            logger.warning(f'Entry #{ind} differs:\n'
+                           f'regex: {regex_entry}\n'
+                           f'Beautiful Soup: {soup_entry}')
+    logger.info(f'Found {len(mismatches)} mismatching entries in '
+                f'{watch_file_path}')
+    return mismatches
+
+
+fluff_pieces_re = re.compile('|'.join(
+    re.escape(piece) for piece, _ in fluff if len(piece) > 1))
+fluff_replacements = dict(fluff)
+longest_fluff_piece = max(len(piece) for piece, _ in fluff)
+
+
+def _prune_chunks(chunks):
+    """
+    Applies the fluff replacements to NFKD-normalized chunks of the contents
+    of a file's <body>, in a single pass, with the same result as replacing
+    them one after another in the whole of it. The last 6 characters,
+    normally the closing tag of the outermost div, are dropped.
+
+    Any piece of fluff that could straddle the end of a chunk is held back
+    until the next one
+    """
+    leftover = ''
+    for chunk, final in _with_final_flag(chunks):
+        buffer = leftover + chunk
+        if final:
+            buffer = buffer[:-6]
+            safe_end = len(buffer)
+        else:
+            safe_end = len(buffer) - longest_fluff_piece + 1
+        pruned = []
+        pos = 0
+        for match in fluff_pieces_re.finditer(buffer):
+            if match.start() >= safe_end:
+                break
+            pruned.append(buffer[pos:match.start()])
+            pruned.append(fluff_replacements[match.group()])
+            pos = match.end()
+        end = max(pos, safe_end)
+        pruned.append(buffer[pos:end])
+        leftover = buffer[end:]
+        yield ''.join(pruned).replace('<', '\n<').replace('>', '>\n')
+
+
+def _with_final_flag(iterable):
+    """Yields (item, is_last_item) tuples"""
+    iterator = iter(iterable)
+    try:
+        item = next(iterator)
+    except StopIteration:
+        return
+    for next_item in iterator:
+        yield item, False
+        item = next_item
+    yield item, True
+
+
+def prune_watch_history_file(watch_file_path: str,
+                             chunk_size: int = 2 ** 20) -> bool:
+    """
+    Rewrites a watch-history.html file without the HTML that doesn't allow or
+    slows down its processing (see fluff), unless that's already been done.
+
+    The file is memory-mapped and pruned a chunk at a time, so memory usage
+    stays around a few chunks no matter its size. The result is written to a
+    temporary file that then replaces the original one, so it's never left
+    half-written.
+
+    :return: True if the file was rewritten
+    """
+    with open(watch_file_path, 'rb') as watch_file:
+        if watch_file.read(len(done_)) == done_.encode():
+            return False
+        with mmap.mmap(watch_file.fileno(), 0,
+                       access=mmap.ACCESS_READ) as content:
+            start = content.find(b'<body>')
+            end = content.find(b'</body>')
+            if start == -1 or end == -1:
+                logger.warning(f'Not pruning {watch_file_path}, '
+                               f'could not find its <body>')
+                return False
+            decoder = codecs.getincrementaldecoder('utf-8')()
+            chunks = (decoder.decode(content[pos:min(pos + chunk_size, end)],
+                                     final=pos + chunk_size >= end)
+                      for pos in range(start + 6, end, chunk_size))
+
+            temp_fd, temp_path = tempfile.mkstemp(
+                suffix='.tmp', prefix=os.path.basename(watch_file_path),
+                dir=os.path.dirname(watch_file_path))
+            try:
+                with open(temp_fd, 'w', encoding='utf-8') as new_file:
+                    new_file.write(done_ + '\n')
+                    for chunk in _prune_chunks(_normalize_chunks(chunks)):
+                        new_file.write(chunk)
+            except BaseException:
+                os.remove(temp_path)
+                raise
+    os.replace(temp_path, watch_file_path)
+    logger.info(f'Rewrote {watch_file_path} (trimmed junk HTML).')
+    return True
+
+
+def _read_pruned_content(watch_file_path: str, counter: ReadCounter = None):
+    with open_text(watch_file_path, counter=counter) as watch_file:
+        content = unicodedata.normalize('NFKD', watch_file.read())
+    if not content.startswith(done_):  # cleans out all the junk for faster
+        # BSoup parsing, in addition to fixing an out-of-place-tag which
+        # stops BSoup from parsing more than a couple dozen records
+        content = content[content.find('<body>')+6:
+                          content.find('</body>')-6]
+        for piece in fluff:
+            content = content.replace(piece[0], piece[1])
+        content = done_ + '\n' + content
+    return content
+
+
+def _entry_to_record(entry: tuple):
+    """
+    Turns a parsed entry into a (video_id, values, watched_at) tuple, with
+    watched_at still being a string. Returns None if the entry has no
+    recognizable video link
+    """
+    all_text, url, video_title, channel_url, channel_title = entry
+    values = {}
+    video_id = 'unknown'
+    watched_at = all_text.splitlines()[-1].strip()
+
+    if (all_text.startswith(removed_string) or
+            all_text.startswith(story_string)):
+        pass
+    elif all_text.startswith('Visited YouTube Music'):
+        video_id = 'youtube_music'
+    else:
+        if url is None:
+            return
+        video_id = extract_video_id_from_url(url)
+        if url != video_title and video_title != 'Deleted video':
+            # Some videos have the url as the title.
+            # They're usually not available through YT or its API
+            values['title'] = video_title
+            if channel_url is not None:
+                values['channel_id'] = channel_url[
+                                       channel_url.rfind('/') + 1:]
+                values['channel_title'] = channel_title
+
+    return video_id, values, watched_at
+
+
+watched_at_format = '%b %d, %Y, %I:%M:%S %p'
+month_abbrs = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+               'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+# watched_at_format as it appears in nearly all entries, followed by a time
+# zone; anything else is left for strptime, see parse_watched_at_times
+watched_at_re = re.compile(
+    r'^(?:(' + '|'.join(month_abbrs) + r') ([0-9]{1,2}), ([0-9]{4}), '
+    r'([0-9]{1,2}):([0-9]{1,2}):([0-9]{1,2}) ([AP])M [^ ]*|.*)$', re.M)
+_sorted_month_abbrs = np.array(sorted(month_abbrs), dtype='S')
+_sorted_month_numbers = np.array(
+    [month_abbrs.index(month) + 1 for month in sorted(month_abbrs)])
+
+
+# offsets from UTC, in hours, of the time zone abbreviations that times in
+# Takeout end with. Ambiguous ones are left out, see ambiguous_time_zones
+time_zone_offsets = {
+    'UTC': 0, 'GMT': 0, 'WET': 0, 'WEST': 1, 'CET': 1, 'CEST': 2,
+    'EET': 2, 'EEST': 3, 'MSK': 3, 'WAT': 1, 'CAT': 2, 'SAST': 2, 'EAT': 3,
+    'PKT': 5, 'ICT': 7, 'WIB': 7, 'HKT': 8, 'SGT': 8, 'PHT': 8, 'AWST': 8,
+    'JST': 9, 'KST': 9, 'ACST': 9.5, 'ACDT': 10.5, 'AEST': 10, 'AEDT': 11,
+    'NZST': 12, 'NZDT': 13, 'HST': -10, 'HDT': -9, 'AKST': -9, 'AKDT': -8,
+    'PST': -8, 'PDT': -7, 'MST': -7, 'MDT': -6, 'EST': -5, 'EDT': -4,
+    'ADT': -3, 'NST': -3.5, 'NDT': -2.5, 'BRT': -3, 'ART': -3}
+# abbreviations used by more than one time zone, ex. CST (US Central or
+# China), IST (India or Ireland), BST (British Summer or Bangladesh) or CDT
+# (US Central Daylight or Cuba Daylight), whose offsets are left unknown
+ambiguous_time_zones = {'CST', 'IST', 'BST', 'CDT'}
+# zones without an abbreviation, ex. GMT+3, GMT-03:30, UTC+05:45
+time_zone_offset_re = re.compile(
+    r'^(?:GMT|UTC)([+-])([0-9]{1,2})(?::?([0-9]{2}))?$')
+
+
+@lru_cache(maxsize=None)
+def parse_time_zone(zone: str):
+    """
+    Returns the offset from UTC in seconds of a time zone as it appears at the
+    end of entries' times, ex. 'EDT' or 'GMT+03:00', or None if it's
+    ambiguous or isn't recognized, in which case the times are assumed to be
+    in this machine's time zone
+    """
+    if zone in ambiguous_time_zones:
+        return
+    hours = time_zone_offsets.get(zone)
+    if hours is not None:
+        return int(hours * 3600)
+    match = time_zone_offset_re.match(zone)
+    if match:
+        sign, hours, minutes = match.groups()
+        offset = int(hours) * 3600 + int(minutes or 0) * 60
+        return -offset if sign == '-' else offset
+    logger.warning(f'Unrecognized time zone {zone!r}, assuming it\'s the '
+                   f'same as this machine\'s')
+
+
+def _parse_watched_at_time(watched_at: str):
+    try:
+        return datetime_to_epoch(datetime.strptime(
+            watched_at[:watched_at.rfind(' ')], watched_at_format))
+    except ValueError:
+        return
+
+
+def parse_watched_at_times(times: list) -> list:
+    """
+    Converts a batch of entries' times, ex. 'May 31, 2019, 10:45:38 PM EDT',
+    to epoch seconds (the time zone is ignored and the time treated as UTC,
+    same as datetime_to_epoch does), with None for the ones that can't be
+    parsed.
+
+    Rather than calling strptime for each, the fields are extracted by a
+    single regex run over all of them and assembled into epochs with numpy.
+    Times that don't match the regex exactly, or whose fields are out of
+    range, are passed to strptime individually, so the results are the same
+    as if all of them were
+    """
+    if not times:
+        return []
+    fields = watched_at_re.findall('\n'.join(times))
+    if len(fields) != len(times):  # line breaks in times, shouldn't happen
+        return [_parse_watched_at_time(watched_at) for watched_at in times]
+    # only matched times' fields are captured, and those are all ASCII
+    fields = np.array(fields, dtype='S')
+    matched = fields[:, 0] != b''
+    fields[~matched, 1:6] = b'0'
+    month = _sorted_month_numbers[
+        np.searchsorted(_sorted_month_abbrs, fields[:, 0])]
+    day, year, hour, minute, second = fields[:, 1:6].astype(np.int64).T
+    month_start = ((year - 1970) * 12 + month - 1).astype('datetime64[M]')
+    days = month_start.astype('datetime64[D]')
+    days_in_month = ((month_start + 1).astype('datetime64[D]') -
+                     days).astype(np.int64)
+    valid = (matched & (year > 0) & (day > 0) & (day <= days_in_month) &
+             (hour > 0) & (hour <= 12) & (minute < 60) & (second < 60))
+    hour = hour % 12 + np.where(fields[:, 6] == b'P', 12, 0)
+    epochs = (days.astype(np.int64) + day - 1) * 86400
+    epochs += hour * 3600 + minute * 60 + second
+    return [epoch if is_valid else _parse_watched_at_time(watched_at)
+            for epoch, is_valid, watched_at in zip(
+                epochs.tolist(), valid.tolist(), times)]
+
+
+def _html_records(watch_file_path: str, streaming: bool,
+                  batch_size: int = 10000, counter: ReadCounter = None,
+                  seen: SeenEntries = None):
+    """
+    Yields an (entry_text, record) tuple for each entry in a watch-history.html
+    file, where record is a (video_id, values, watched_at, utc_offset) tuple or
+    None if the entry couldn't be parsed. watched_at is the local time in epoch
+    seconds, utc_offset is in seconds and None if the time zone is unknown.
+
+    Entries are processed in batches of batch_size, so their times can be
+    parsed together. The bytes read are reported to counter, if it's passed.
+
+    If seen is passed, entries already seen in previous files are skipped,
+    with (None, None) yielded in place of them, and the ones that get parsed
+    successfully are added to it
+    """
+    if streaming:
+        entries = _fingerprinted_stream_entries(watch_file_path, counter,
+                                                seen)
+    else:
+        entries = _fingerprinted_regex_entries(
+            _read_pruned_content(watch_file_path, counter), seen)
+    batch = []
+    for fingerprint, entry in entries:
+        if entry is None:
+            batch.append((fingerprint, None, None))
+        else:
+            batch.append((fingerprint, entry[0], _entry_to_record(entry)))
+        if len(batch) == batch_size:
+            yield from _with_parsed_times(batch, seen)
+            batch = []
+    yield from _with_parsed_times(batch, seen)
+
+
+def _with_parsed_times(batch: list, seen: SeenEntries = None):
+    epochs = iter(parse_watched_at_times(
+        [record[2] for _, _, record in batch if record is not None]))
+    for fingerprint, entry_text, record in batch:
+        if record is not None:
+            epoch = next(epochs)
+            if epoch is not None:
+                watched_at = record[2]
+                record = (*record[:2], epoch, parse_time_zone(
+                    watched_at[watched_at.rfind(' ') + 1:]))
+            else:
+                record = None
+        if seen is not None and fingerprint is not None:
+            if record is not None:
+                seen.add(fingerprint)
+            elif entry_text is not None:  # rather than skipped
+                seen.failed[fingerprint] = entry_text
+        yield entry_text, record
+
+
+def iter_json_array(file, chunk_size: int = 2 ** 20):
+    """
+    Decodes a JSON array from a text file incrementally, yielding its elements
+    one at a time, instead of loading the whole of it at once like json.load
+    """
+    decoder = json.JSONDecoder()
+    buffer = ''
+    while not buffer:
+        chunk = file.read(chunk_size)
+        if not chunk:
+            break
+        buffer = chunk.lstrip()
+    if not buffer.startswith('['):
+        raise ValueError('Expected a JSON array')
+    pos = 1
+    eof = False
+    while True:
+        pos = json_separators_re.match(buffer, pos).end()
+        if pos == len(buffer) or buffer[pos] != ']':
+            try:
+                obj, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                # most likely an element cut off by the end of the chunk
+                if eof:
+                    raise
+                obj = end = None
+            if end is not None and end < len(buffer):
+                yield obj
+                pos = end
+                continue
+        else:
+            return
+        if eof:
+            raise ValueError('Unterminated JSON array')
+        chunk = file.read(chunk_size)
+        eof = not chunk
+        buffer = buffer[pos:] + chunk
+        pos = 0
+
+
+def _iso_time_to_local(iso_time: str) -> tuple:
+    """
+    Converts Takeout's UTC ISO 8601 time, ex. 2019-01-05T22:11:12.345Z, to a
+    naive local time like the ones in watch-history.html, in epoch seconds,
+    returning it along with the local time zone's offset from UTC in seconds
+    """
+    local = datetime(
+        int(iso_time[:4]), int(iso_time[5:7]), int(iso_time[8:10]),
+        int(iso_time[11:13]), int(iso_time[14:16]), int(iso_time[17:19]),
+        tzinfo=timezone.utc).astimezone()
+    return (datetime_to_epoch(local.replace(tzinfo=None)),
+            int(local.utcoffset().total_seconds()))
+
+
+def _json_item_to_record(item: dict):
+    """
+    The watch-history.json counterpart of _entry_to_record, except the time
+    is returned parsed, same as by _html_records, with the UTC offset always
+    known
+    """
+    title = unicodedata.normalize('NFKD', item.get('title', ''))
+    url = item.get('titleUrl')
+    values = {}
+    video_id = 'unknown'
+
+    if title.startswith(removed_string) or title.startswith(story_string):
+        pass
+    elif title.startswith('Visited YouTube Music'):
+        video_id = 'youtube_music'
+    else:
+        if url is None or not watch_url_re.search(url):
+            return
+        video_id = extract_video_id_from_url(url)
+        video_title = title[title.find(' ') + 1:]  # cuts off "Watched "
+        if url != video_title and video_title != 'Deleted video':
+            values['title'] = video_title
+            for channel in item.get('subtitles', []):
+                channel_url = channel.get('url', '')
+                if channel_url_re.search(channel_url):
+                    values['channel_id'] = channel_url[
+                                           channel_url.rfind('/') + 1:]
+                    values['channel_title'] = unicodedata.normalize(
+                        'NFKD', channel['name'])
+                    break
+
+    return (video_id, values, *_iso_time_to_local(item['time']))
+
+
+def _json_records(watch_file_path: str, counter: ReadCounter = None):
+    """The watch-history.json counterpart of _html_records"""
+    with open_text(watch_file_path, encoding='utf-8-sig',
+                   counter=counter) as watch_file:
+        for item in iter_json_array(watch_file):
+            try:
+                record = _json_item_to_record(item)
+            except (KeyError, ValueError, TypeError, AttributeError):
+                record = None
+            yield json.dumps(item, ensure_ascii=False), record
+
+
+def get_file_fingerprint(path: str, with_hash=True) -> tuple:
+    """
+    Returns a file's (size, mtime, hash) tuple, used for telling whether it has
+    already been ingested. The hash is None if with_hash is False
+    """
+    size, mtime = get_size_and_mtime(path)
+    if not with_hash:
+        return size, mtime, None
+    content_hash = hashlib.sha256()
+    with open_binary(path) as file:
+        for chunk in iter(lambda: file.read(2 ** 20), b''):
+            content_hash.update(chunk)
+    return size, mtime, content_hash.hexdigest()
+
+
+def _split_off_ingested_files(watch_files: list, ingested_files: dict):
+    """
+    Separates files that are already recorded as ingested, i.e. have the same
+    size and mtime at the same path, or the same contents anywhere else, from
+    the ones that need to be parsed.
+
+    :param watch_files: paths to watch-history files
+    :param ingested_files: {path: (size, mtime, hash)} of ingested files
+    :return: a list of (path, fingerprint) tuples for files that should be
+    parsed, and a list of paths of the ones that should be skipped
+    """
+    ingested_hashes = {fingerprint[2]
+                       for fingerprint in ingested_files.values()}
+    to_parse, skipped = [], []
+    for path in watch_files:
+        size, mtime, _ = get_file_fingerprint(path, with_hash=False)
+        ingested = ingested_files.get(path)
+        if ingested and ingested[:2] == (size, mtime):
+            skipped.append(path)
             continue
-        if not content.startswith(done_):  # cleans out all the junk for faster
-            # BSoup parsing, in addition to fixing an out-of-place-tag which
-            # stops BSoup from parsing more than a couple dozen records
-            content = content[content.find('<body>')+6:
-                              content.find('</body>')-6]
-            for piece in fluff:
-                content = content.replace(piece[0], piece[1])
-            content = done_ + '\n' + content
-        if content != original_content and prune_html:
-            with open(watch_file_path, 'w') as new_file:
-                new_file.write(content)
-            logger.info('Rewrote', watch_file_path, '(trimmed junk HTML).')
-
-        soup = BSoup(content, 'lxml')
-        divs = soup.find_all('div', class_='awesome_class')
-
-        if len(divs) == 0:
+        fingerprint = get_file_fingerprint(path)
+        if fingerprint[2] in ingested_hashes:
+            skipped.append(path)
+        else:
+            to_parse.append((path, fingerprint))
+    return to_parse, skipped
+
+
+cache_dir_name = 'parsed_takeout'
+cache_magic = b'YTWATCHED-TAKEOUT-3'
+
+
+class ParsedFileCache:
+    """
+    Saves each watch-history file's parsed results to a binary file, so that
+    a file that gets parsed again, ex. after a run that didn't finish
+    ingesting it, is loaded instead. They're looked up by the SHA-256 of the
+    file's contents (see get_file_fingerprint). index.json maps paths to the
+    (size, mtime, hash, cache key) their files had when saved, so that
+    unchanged files are looked up without hashing them, while ones whose
+    size or mtime changed are hashed again, same as for the ingested files.
+
+    The entries of an HTML file that were in the files before it are skipped
+    (see SeenEntries), so its results depend on those files. Their hashes,
+    in order, are part of the cache key, so results are only loaded if the
+    same files were parsed before it. A cache file whose header doesn't match
+    what it's looked up with is stale and ignored
+    """
+
+    def __init__(self, cache_dir: str):
+        self.dir = join(cache_dir, cache_dir_name)
+        self.index_path = join(self.dir, 'index.json')
+        os.makedirs(self.dir, exist_ok=True)
+        try:
+            with open(self.index_path, 'r') as index_file:
+                self.index = json.load(index_file)
+        except (FileNotFoundError, ValueError):
+            self.index = {}
+
+    def _cache_path(self, content_hash: str, depends_on: list) -> str:
+        cache_key = hashlib.sha256('\n'.join(
+            [content_hash, *depends_on]).encode('utf-8')).hexdigest()
+        return join(self.dir, cache_key + '.bin')
+
+    def get_hash(self, path: str, fingerprint: tuple = None):
+        """
+        Returns the hash of a file's contents, if it's passed in its
+        fingerprint or a file was saved at the same path, hashing it again if
+        its mtime has changed since. Returns None otherwise, as files are
+        hashed as they're parsed anyway
+        """
+        if fingerprint is not None:
+            return fingerprint[2]
+        indexed = self.index.get(path)
+        if not indexed:
+            return
+        size, mtime = get_size_and_mtime(path)
+        if size != indexed[0]:
+            return
+        if mtime == indexed[1]:
+            return indexed[2]
+        return get_file_fingerprint(path)[2]
+
+    def load(self, path: str, content_hash: str, depends_on: list):
+        """
+        Returns a file's (occ_dict, parsed fingerprints, {fingerprint: entry
+        text} of the failed entries), if it was saved after the files with
+        the hashes in depends_on, or None
+        """
+        cache_path = self._cache_path(content_hash, depends_on)
+        try:
+            with open(cache_path, 'rb') as cache_file:
+                if cache_file.read(len(cache_magic)) != cache_magic:
+                    return
+                header = json.loads(read_section(cache_file).decode('utf-8'))
+                if (header['hash'] != content_hash or
+                        header['size'] != get_size_and_mtime(path)[0] or
+                        header['byteorder'] != sys.byteorder or
+                        header['depends_on'] != depends_on):
+                    return
+                fingerprints = np.frombuffer(read_section(cache_file),
+                                             dtype=np.int64)
+                records = TakeoutRecords.load(cache_file)
+        except FileNotFoundError:
+            return
+        except (ValueError, KeyError, struct.error) as e:
+            logger.warning(f'Ignoring unreadable cache file {cache_path}: '
+                           f'{e!r}')
+            return
+        occ_dict = {'videos': records,
+                    'failed_entries': header['failed_entries'],
+                    'failed_files': [],
+                    'parsed_files': [(path, *get_size_and_mtime(path),
+                                      content_hash)]}
+        failed = {int(fingerprint): entry_text
+                  for fingerprint, entry_text in header['failed']}
+        logger.info(f'Loaded previously parsed records of {path}')
+        return occ_dict, fingerprints, failed
+
+    def save(self, occ_dict: dict, fingerprints, failed: dict,
+             depends_on: list):
+        """
+        Saves a single file's occ_dict, as returned by load, if the file was
+        parsed in full, along with the fingerprints of its parsed entries and
+        the hashes of the files it depends on
+        """
+        if not occ_dict['parsed_files']:
+            return
+        path, size, mtime, content_hash = occ_dict['parsed_files'][0]
+        header = {'hash': content_hash,
+                  'size': size,
+                  'byteorder': sys.byteorder,
+                  'depends_on': depends_on,
+                  'failed_entries': occ_dict['failed_entries'],
+                  'failed': list(failed.items())}
+        cache_path = self._cache_path(content_hash, depends_on)
+        temp_path = cache_path + '.tmp'
+        with open(temp_path, 'wb') as cache_file:
+            cache_file.write(cache_magic)
+            write_section(cache_file, json.dumps(header).encode('utf-8'))
+            write_section(cache_file, np.array(
+                list(fingerprints), dtype=np.int64).tobytes())
+            occ_dict['videos'].dump(cache_file)
+        os.replace(temp_path, cache_path)
+        replaced = self.index.get(path)
+        self.index[path] = [size, mtime, content_hash,
+                            os.path.basename(cache_path)]
+        if replaced and replaced[3] not in {
+                indexed[3] for indexed in self.index.values()}:
+            try:
+                os.remove(join(self.dir, replaced[3]))
+            except FileNotFoundError:
+                pass
+        with open(self.index_path, 'w') as index_file:
+            json.dump(self.index, index_file)
+
+
+def _new_occ_dict() -> dict:
+    records = TakeoutRecords()
+    records.add('unknown', {})
+    return {'videos': records,
+            'failed_entries': [],
+            'failed_files': [],
+            'parsed_files': []}
+
+
+def _parse_watch_history_file(occ_dict: dict, watch_file_path: str,
+                              streaming: bool, prune_html: bool,
+                              stop_at: int = None, report_every: int = 1000,
+                              seen: SeenEntries = None,
+                              fingerprint: tuple = None):
+    """
+    Adds the records from a single watch-history file to occ_dict, yielding
+    (bytes read, entries processed) tuples every report_every entries, and
+    once more when done. If the whole file is parsed successfully, it's
+    listed under occ_dict's 'parsed_files' along with its fingerprint (see
+    get_file_fingerprint), which is hashed from the same reads as the ones
+    parsed, unless it's passed already and the file doesn't get pruned (see
+    prune_html in get_all_records).
+
+    Files list entries newest first, so if stop_at (epoch seconds) is passed,
+    the rest of the file is skipped once an entry older than that is reached.
+    The file then isn't listed under 'parsed_files', as the entries past that
+    point haven't been ingested.
+
+    If seen is passed, the HTML entries that were already seen in the files
+    parsed with it before are skipped, see SeenEntries
+    """
+    is_json = watch_file_path.endswith('.json')
+    counter = ReadCounter()
+    entries = 0
+    stopped = False
+    try:
+        if (prune_html and not is_json and
+                split_archive_path(watch_file_path) is None and
+                prune_watch_history_file(watch_file_path)):
+            fingerprint = None  # it's that of the file from before pruning
+        if fingerprint is None:
+            counter.content_hash = hashlib.sha256()
+        if is_json:
+            records = _json_records(watch_file_path, counter)
+        else:
+            records = _html_records(watch_file_path, streaming,
+                                    counter=counter, seen=seen)
+        for entry_text, record in records:
+            entries += 1
+            if not entries % report_every:
+                yield counter.bytes_read, entries
+            if record is None:
+                if entry_text is not None:  # rather than skipped
+                    occ_dict['failed_entries'].append(entry_text)
+                continue
+            if stop_at is not None and record[2] < stop_at:
+                records.close()
+                stopped = True
+                logger.info(f'Reached already ingested entries in '
+                            f'{watch_file_path}, skipping the rest')
+                break
+            occ_dict['videos'].add(*record)
+    except UnicodeDecodeError:
+        occ_dict['failed_files'].append(watch_file_path)
+        logger.error(f'Failed to decode {watch_file_path}')
+    except ValueError as e:
+        occ_dict['failed_files'].append(watch_file_path)
+        logger.error(f'Failed to decode {watch_file_path}: {e}')
+    else:
+        if not entries:
             occ_dict['failed_files'].append(watch_file_path)
             logger.error(f'Could not find any records in {watch_file_path}.'
                          f'\nThe file is either corrupt or its format is '
                          f'different from the expected.')
+    if not stopped and watch_file_path not in occ_dict['failed_files']:
+        if fingerprint is None:
+            fingerprint = (*get_size_and_mtime(watch_file_path),
+                           counter.content_hash.hexdigest())
+        occ_dict['parsed_files'].append((watch_file_path, *fingerprint))
+    if seen is not None:
+        skipped = seen.end_file()
+        if skipped:
+            logger.info(f'Skipped {skipped} entries in {watch_file_path} '
+                        f'that were already in the previous files')
+    yield counter.bytes_read, entries
+
+
+# (bytes read, entries processed) by each worker's current file, indexed
+# by file: [bytes_0, entries_0, bytes_1, entries_1, ...]
+_worker_progress = None
+
+
+def _init_worker(progress):
+    global _worker_progress
+    _worker_progress = progress
+
+
+def _parse_watch_history_file_in_worker(args: tuple) -> tuple:
+    """
+    Parses a single watch-history file in a worker process, skipping the
+    entries whose fingerprints are in known (see SeenEntries), and returns its
+    records, minus the dedup index which is only needed while adding them,
+    along with the {fingerprint: entry text} of the entries that failed and
+    the fingerprints of the ones that were parsed
+    """
+    ind, path, streaming, prune_html, stop_at, fingerprint, known = args
+    occ_dict = _new_occ_dict()
+    seen = None if known is None else SeenEntries(known.tolist())
+    for bytes_read, entries in _parse_watch_history_file(
+            occ_dict, path, streaming, prune_html, stop_at, seen=seen,
+            fingerprint=fingerprint):
+        _worker_progress[ind * 2] = bytes_read
+        _worker_progress[ind * 2 + 1] = entries
+    occ_dict['videos'].drop_dedup_index()
+    if seen is None:
+        return occ_dict, {}, set()
+    return occ_dict, seen.file_failed, seen.file_fingerprints
+
+
+def _entry_fingerprints(watch_file_path: str, streaming: bool):
+    """
+    Returns the fingerprints of the entries of a watch-history.html file that
+    would get skipped if they were known, in order, as a numpy array, without
+    parsing them
+    """
+    try:
+        if streaming:
+            with open_text(watch_file_path) as watch_file:
+                _, spans = _entry_spans(watch_file)
+                fingerprints = [_span_fingerprint(*span)[0] for span in spans]
+            fingerprints = [fingerprint for fingerprint in fingerprints
+                            if fingerprint is not None]
+        else:
+            fingerprints = [_fingerprint(body) for body in _entry_bodies(
+                _read_pruned_content(watch_file_path)) or ()]
+    except ValueError:  # the file fails to parse the same way in the worker
+        fingerprints = []
+    return np.array(fingerprints, dtype=np.int64)
+
+
+def _iter_worker_args(watch_files: list, streaming: bool, prune_html: bool,
+                      stop_at: int, known_lists: list, cached: dict = None):
+    """
+    Yields the arguments of _parse_watch_history_file_in_worker for each file,
+    fingerprinting each watch-history.html file's entries first, so that the
+    ones in the files before it are passed to it as known. Those are also put
+    in known_lists, by file.
+
+    Files are pruned here, if prune_html is True, so that they're
+    fingerprinted the same as they're parsed. The ones in cached, by index,
+    as loaded by ParsedFileCache, are skipped, and only make their entries
+    known to the ones after them
+    """
+    previous = np.array([], dtype=np.int64)  # sorted, unique
+    for ind, (path, fingerprint) in enumerate(watch_files):
+        known = None
+        if cached and ind in cached:
+            _, fingerprints, failed = cached[ind]
+            previous = np.union1d(previous, np.concatenate([
+                fingerprints, np.array(list(failed), dtype=np.int64)]))
             continue
-        for div in divs:
-            default_values = {'timestamps': []}
-            video_id = 'unknown'
-            all_text = div.get_text().strip()
-            watched_at = all_text.splitlines()[-1].strip()
-
-            if (all_text.startswith(removed_string) or
-                    all_text.startswith(story_string)):
-                pass
-            elif all_text.startswith('Visited YouTube Music'):
-                video_id = 'youtube_music'
-            else:
-                url = div.find(href=watch_url_re)
-                if url is None:
-                    add_failed_parse_entry_to_list(all_text)
-                    continue
-                video_id = extract_video_id_from_url(url['href'])
-                video_title = url.get_text(strip=True)
-                if (url['href'] != video_title and 
-                        video_title != 'Deleted video'):
-                    # Some videos have the url as the title.
-                    # They're usually not available through YT or its API
-                    default_values['title'] = video_title
-                    try:
-                        channel = div.find(href=channel_url_re)
-                        channel_url = channel['href']
-                        channel_id = channel_url[channel_url.rfind('/') + 1:]
-                        channel_title = channel.get_text(strip=True)
-                        default_values['channel_id'] = channel_id
-                        default_values['channel_title'] = channel_title
-                    except TypeError:
-                        pass
+        if not path.endswith('.json'):
+            if (prune_html and split_archive_path(path) is None and
+                    prune_watch_history_file(path)):
+                fingerprint = None
+            fingerprints = _entry_fingerprints(path, streaming)
+            known = fingerprints[np.isin(fingerprints, previous)]
+            previous = np.union1d(previous, fingerprints)
+        known_lists[ind] = known
+        yield ind, path, streaming, prune_html, stop_at, fingerprint, known
 
-            try:
-                watched_at = datetime.strptime(
-                    watched_at[:watched_at.rfind(' ')],
-                    '%b %d, %Y, %I:%M:%S %p')
-            except ValueError:
-                add_failed_parse_entry_to_list(all_text)
-                continue
 
-            occ_dict['videos'].setdefault(video_id, default_values)
-            default_keys = list(default_values.keys())
-            default_keys.remove('timestamps')
-            for key in default_keys:
-                # checks if the newer record has some data that the one
-                # that's already set doesn't. Sets it if so
-                if not occ_dict['videos'][video_id].get(key, None):
-                    occ_dict['videos'][video_id][key] = default_values[key]
-
-            cur_timestamps = occ_dict['videos'][video_id]['timestamps']
-            timestamp_is_unique_in_list(watched_at, cur_timestamps, insert=True)
-
-    all_known_timestamps_ids = list(occ_dict['videos'].keys())
-    all_known_timestamps_ids.remove('unknown')
-    all_known_timestamps_lists = [i for i in
-                                  [occ_dict['videos'][v_id]['timestamps']
-                                   for v_id in all_known_timestamps_ids]]
-    all_known_timestamps = list(itertools.chain.from_iterable(
-        all_known_timestamps_lists))
-    unk_timestamps = occ_dict['videos']['unknown']['timestamps']
-    unk_timestamps = sorted(
-        list(set(unk_timestamps).difference(all_known_timestamps)))
-    occ_dict['videos']['unknown']['timestamps'] = unk_timestamps
-    remove_timestamps_from_one_list_from_another(all_known_timestamps,
-                                                 unk_timestamps)
+def _merge_partial_result(occ_dict: dict, partial: dict):
+    """
+    Merges a single file's worth of records into occ_dict the same way they'd
+    have been added if the file was parsed directly into it
+    """
+    occ_dict['videos'].merge(partial['videos'])
+    occ_dict['failed_entries'].extend(partial['failed_entries'])
+    occ_dict['failed_files'].extend(partial['failed_files'])
+    occ_dict['parsed_files'].extend(partial['parsed_files'])
+
+
+def get_all_records(takeout_path: str = '.',
+                    dump_json_to_dir: str = None, prune_html=False,
+                    verbose=True, streaming=False,
+                    processes: int = 1, ingested_files: dict = None,
+                    force_reingest=False, fails_dir: str = None,
+                    progress_interval: float = 0.5,
+                    watermark: datetime = None,
+                    cache_dir: str = None) -> Union[dict, bool]:
+    """
+    Accumulates records from all found watch-history.html/json files and
+    returns them in a dict.
+
+    Takeouts overlap almost entirely, as each one has the whole history up to
+    when it was exported, so entries of watch-history.html files that are
+    identical to ones in the files parsed before them are skipped before they
+    get parsed, see SeenEntries.
+
+    :param takeout_path: directory containing Takeout directories or
+    watch-history.html/json files, or a path to one of those files directly
+    :param dump_json_to_dir: saves the accumulated records to a JSON lines
+    file, one video per line, along with the entries and files that failed
+    to parse
+    :param prune_html: prunes HTML that doesn't allow or slows down the
+    processing of files with Beautiful Soup (files inside archives are left
+    as they are)
+    :param verbose:
+    :param streaming: parse files incrementally, one entry at a time, instead
+    of reading the whole of each into memory first. Keeps memory usage flat
+    regardless of file size
+    :param processes: parse multiple files in up to this many worker processes
+    at once. Their results are merged in the same order the files would've
+    been processed in otherwise. Each watch-history.html file's entries are
+    fingerprinted first, which is much quicker than parsing them, so that the
+    ones that were in the files before it get skipped by its worker, same as
+    if the files were parsed one after another
+    :param ingested_files: {path: (size, mtime, hash)} of the files that have
+    already been ingested (see write_to_sql.get_ingested_files). Unchanged
+    ones are skipped and listed under 'skipped_files'. Those that get parsed
+    in full are listed with their fingerprints under 'parsed_files', to be
+    recorded once their records are in the DB
+    :param force_reingest: parse all the files, even if already ingested
+    :param fails_dir: dumps the entries and files that failed to parse to
+    this directory, if dump_json_to_dir isn't passed
+    :param progress_interval: TakeoutProgress tuples with the amount of bytes
+    and entries parsed so far are yielded as each file is started and at
+    most this often (in seconds) in between
+    :param watermark: the newest timestamp that's already been ingested.
+    Since files list entries newest first, each one is only parsed up to the
+    entries that are older than it by more than MAX_TIME_DIFFERENCE (as
+    files may be in different time zones), which makes adding a new Takeout
+    take time proportional to what's been watched since the last one. Should
+    only be passed if the older files have been ingested already. Files that
+    get cut short aren't listed under 'parsed_files', so they're parsed again
+    by the next run, in full if it's without a watermark
+    :param cache_dir: saves each file's parsed results to a subdirectory of
+    this directory, or loads them from it instead of parsing the file, if
+    it's unchanged and so are the files before it, see ParsedFileCache. Not
+    used along with a watermark
+    :return:
+    """
+
+    watch_files, skipped_files = get_files_to_parse(
+        takeout_path, ingested_files, force_reingest)
+    if not watch_files and not skipped_files:
+        logger.warning('Found no watch-history files.')
+        return {}
+    stop_at = _get_stop_at(watermark)
+
+    cache = ParsedFileCache(cache_dir) if cache_dir else None
+    occ_dict = yield from _parse_watch_history_files(
+        watch_files, streaming, prune_html, processes, progress_interval,
+        stop_at, cache)
+    # removes unknown timestamps that turned out to belong to known videos
+    occ_dict['videos'].finalize()
+
+    occ_dict['skipped_files'] = skipped_files
+    failed_entries = len(occ_dict['failed_entries'])
 
-    total_timestamps = len(all_known_timestamps + unk_timestamps)
+    total_timestamps = occ_dict['videos'].total_timestamps()
+    unk_timestamps = occ_dict['videos']['unknown']['timestamps']
     total_videos = len(occ_dict["videos"]) - 1  # minus one for 'unknown' key
 
     occ_dict['total_timestamps'] = total_timestamps
@@ -276,21 +1413,289 @@ def get_all_records(takeout_path: str = '.',
         Total unknown videos: {len(unk_timestamps)})
         Unique videos with ids: {total_videos}''')
     if dump_json_to_dir:
-        import json
-        with open(
-                join(dump_json_to_dir, 'parsed_watch_history.json'),
-                'w') as all_records_file:
-            json.dump(occ_dict['videos'], all_records_file, indent=4,
-                      default=lambda o: str(o))  # for dt objects
-            if failed_entries or occ_dict['failed_files']:
-                fails = {'failed_files': occ_dict['failed_files'],
-                         'failed_entries': occ_dict['failed_entries']}
-                parse_fails_path = join(dump_json_to_dir, 'parse_fails.json')
-                with open(parse_fails_path, 'w') as parse_fails_file:
-                    json.dump(fails, parse_fails_file, indent=4)
-                    logger.warning(f'Dumped failed parse data '
-                                   f'in {parse_fails_path}')
-            if verbose:
-                logger.info(f'Dumped JSON to {dump_json_to_dir}')
+        dump_records_to_json_lines(
+            join(dump_json_to_dir, 'parsed_watch_history.jsonl'),
+            occ_dict['videos'])
+        if verbose:
+            logger.info(f'Dumped JSON to {dump_json_to_dir}')
+    fails_dir = dump_json_to_dir or fails_dir
+    if fails_dir:
+        dump_parse_fails(fails_dir, occ_dict['failed_files'],
+                         occ_dict['failed_entries'])
 
     yield occ_dict
+
+
+def _get_stop_at(watermark: datetime = None):
+    """Returns the epoch to stop parsing files at, see get_all_records"""
+    if watermark is not None:
+        return datetime_to_epoch(watermark - MAX_TIME_DIFFERENCE)
+
+
+def get_files_to_parse(takeout_path: str, ingested_files: dict = None,
+                       force_reingest=False) -> tuple:
+    """
+    Finds the watch-history files under takeout_path and separates the ones
+    that have already been ingested (see get_all_records' ingested_files)
+
+    :return: a list of (path, fingerprint) tuples for the files that should
+    be parsed, with fingerprint being None unless it had to be computed, and
+    a list of the paths of the ones that should be skipped
+    """
+    watch_files = get_watch_history_files(takeout_path)
+    if not (ingested_files and not force_reingest):
+        return [(path, None) for path in watch_files], []
+    watch_files, skipped_files = _split_off_ingested_files(
+        watch_files, ingested_files)
+    if skipped_files:
+        logger.info(f'Skipping {len(skipped_files)} '
+                    f'already ingested file(s)')
+    return watch_files, skipped_files
+
+
+def dump_parse_fails(fails_dir: str, failed_files: list,
+                     failed_entries: list):
+    """Saves the files and entries that failed to parse, if there are any"""
+    if failed_entries or failed_files:
+        fails = {'failed_files': failed_files,
+                 'failed_entries': failed_entries}
+        parse_fails_path = join(fails_dir, 'parse_fails.json')
+        with open(parse_fails_path, 'w') as parse_fails_file:
+            json.dump(fails, parse_fails_file, indent=4)
+            logger.warning(f'Dumped failed parse data '
+                           f'in {parse_fails_path}')
+
+
+# parsing progress, as yielded by get_all_records. bytes_total and eta (seconds
+# left, going by the rate bytes have been read at so far) are None if the size
+# of any of the files is unknown, see get_uncompressed_size
+TakeoutProgress = namedtuple('TakeoutProgress', [
+    'file_ind', 'files', 'bytes_read', 'bytes_total', 'entries',
+    'entries_per_second', 'eta'])
+
+
+class _ProgressTracker:
+    """
+    Turns the amounts of bytes read and entries processed into
+    TakeoutProgress, at most once every interval seconds
+    """
+
+    def __init__(self, watch_files: list, interval: float):
+        self.files = len(watch_files)
+        self.sizes = [get_uncompressed_size(path) for path in watch_files]
+        self.bytes_total = None if None in self.sizes else sum(self.sizes)
+        self.interval = interval
+        self.started_at = self.last_report = time.monotonic()
+
+    def report(self, file_ind: int, bytes_read: int, entries: int,
+               force=False):
+        """
+        Returns a TakeoutProgress, or None if the last one was returned less
+        than interval seconds ago and force is False
+        """
+        now = time.monotonic()
+        if not force and now - self.last_report < self.interval:
+            return
+        self.last_report = now
+        elapsed = now - self.started_at
+        eta = None
+        if self.bytes_total is not None and bytes_read:
+            eta = (self.bytes_total - bytes_read) * elapsed / bytes_read
+        return TakeoutProgress(
+            file_ind, self.files, bytes_read, self.bytes_total, entries,
+            entries / elapsed if elapsed else 0., eta)
+
+
+def _parse_watch_history_files(watch_files: list, streaming: bool,
+                               prune_html: bool, processes: int,
+                               progress_interval: float, stop_at: int = None,
+                               cache: ParsedFileCache = None):
+    """
+    Parses the files, (path, fingerprint) tuples as returned by
+    get_files_to_parse, into a single occ_dict, which it returns, yielding
+    TakeoutProgress as each file is started and every progress_interval
+    seconds in between.
+
+    If cache is passed, the files that were parsed before are loaded from it
+    instead, and the rest are saved to it, unless stop_at is passed, as they
+    only get parsed in part then
+    """
+    occ_dict = _new_occ_dict()
+    watch_files_amount = len(watch_files)
+    tracker = _ProgressTracker([path for path, _ in watch_files],
+                               progress_interval)
+    if stop_at is not None:
+        cache = None
+    # the hashes of the files' contents, where known, and the results of the
+    # ones that are loaded from the cache, by index
+    hashes = [None] * watch_files_amount
+    cached = {}
+
+    def depends_on(ind: int) -> list:
+        """The hashes of the files whose entries a file skips, see
+        ParsedFileCache"""
+        if watch_files[ind][0].endswith('.json'):
+            return []
+        return [hashes[before] for before in range(ind)
+                if not watch_files[before][0].endswith('.json')]
+
+    def save(ind: int, partial: dict, fingerprints, failed: dict):
+        """Saves a file that was parsed, rather than loaded, to the cache"""
+        hashes[ind] = (partial['parsed_files'][0][3]
+                       if partial['parsed_files'] else None)
+        if cache is not None and ind not in cached:
+            dependencies = depends_on(ind)
+            if None not in dependencies:
+                cache.save(partial, fingerprints, failed, dependencies)
+
+    if cache is not None:
+        for ind, (path, fingerprint) in enumerate(watch_files):
+            hashes[ind] = cache.get_hash(path, fingerprint)
+            dependencies = depends_on(ind)
+            if hashes[ind] is not None and None not in dependencies:
+                loaded = cache.load(path, hashes[ind], dependencies)
+                if loaded is not None:
+                    cached[ind] = loaded
+
+    if processes > 1 and watch_files_amount - len(cached) > 1:
+        ctx = get_context('spawn')
+        worker_progress = ctx.RawArray('q', watch_files_amount * 2)
+        known_lists = [None] * watch_files_amount
+        # {fingerprint: entry text} of the entries that failed to parse
+        failed = {}
+        # spawned rather than forked as this usually runs in a server thread
+        with ctx.Pool(min(processes, watch_files_amount - len(cached)),
+                      initializer=_init_worker,
+                      initargs=(worker_progress,)) as pool:
+            # the pool consumes the arguments in a thread of its own, so
+            # files get fingerprinted while the ones before them are parsed
+            partial_results = pool.imap(
+                _parse_watch_history_file_in_worker,
+                _iter_worker_args(watch_files, streaming, prune_html,
+                                  stop_at, known_lists, cached))
+            for ind in range(watch_files_amount):
+                force = True
+                while ind not in cached:
+                    progress = tracker.report(
+                        ind, sum(worker_progress[::2]),
+                        sum(worker_progress[1::2]), force)
+                    if progress:
+                        yield progress
+                    force = False
+                    try:
+                        partial, partial_failed, fingerprints = (
+                            partial_results.next(progress_interval))
+                        break
+                    except PoolTimeoutError:
+                        continue
+                if ind in cached:
+                    partial, fingerprints, partial_failed = cached[ind]
+                # known entries that failed in the files before would've
+                # been parsed again, and failed again, if parsed in sequence
+                if known_lists[ind] is not None:
+                    for fingerprint in known_lists[ind].tolist():
+                        if fingerprint in failed:
+                            partial['failed_entries'].append(
+                                failed[fingerprint])
+                save(ind, partial, fingerprints, partial_failed)
+                _merge_partial_result(occ_dict, partial)
+                failed.update(partial_failed)
+    else:
+        bytes_done = entries_done = 0  # by the files already parsed
+        seen = SeenEntries()
+        for ind, (watch_file_path, fingerprint) in enumerate(watch_files):
+            yield tracker.report(ind, bytes_done, entries_done, force=True)
+            bytes_read = entries = 0
+            if ind in cached:
+                partial, fingerprints, _ = cached[ind]
+                seen.add_known(fingerprints.tolist())
+            else:
+                partial = _new_occ_dict()
+                for bytes_read, entries in _parse_watch_history_file(
+                        partial, watch_file_path, streaming, prune_html,
+                        stop_at, seen=seen, fingerprint=fingerprint):
+                    progress = tracker.report(ind, bytes_done + bytes_read,
+                                              entries_done + entries)
+                    if progress:
+                        yield progress
+                save(ind, partial, seen.file_fingerprints, seen.file_failed)
+            _merge_partial_result(occ_dict, partial)
+            size = tracker.sizes[ind]
+            bytes_done += bytes_read if size is None else size
+            entries_done += entries
+    return occ_dict
+
+
+def iter_record_batches(watch_files: list, streaming=True, prune_html=False,
+                        batch_size: int = 5000,
+                        progress_interval: float = 0.5,
+                        watermark: datetime = None):
+    """
+    Parses watch-history files one at a time and yields their records in
+    batches as they go, instead of accumulating all of them first like
+    get_all_records does. TakeoutProgress is yielded along the way, same as
+    with get_all_records.
+
+    Each batch is a dict with the (finalized) records of roughly batch_size
+    entries under 'videos', and 'failed_entries', 'failed_files' and
+    'parsed_files' like in get_all_records' results; a file is listed under
+    'parsed_files' in the batch with its last records, if it was parsed
+    successfully and in full. Timestamps are only deduplicated within a
+    batch, the rest is up to whatever stores them, see
+    write_to_sql.insert_videos
+
+    :param watch_files: (path, fingerprint) tuples, see get_files_to_parse
+    :param streaming: see get_all_records
+    :param prune_html: see get_all_records
+    :param batch_size:
+    :param progress_interval: see get_all_records
+    :param watermark: see get_all_records
+    """
+    stop_at = _get_stop_at(watermark)
+    tracker = _ProgressTracker([path for path, _ in watch_files],
+                               progress_interval)
+    bytes_done = entries_done = 0
+    seen = SeenEntries()
+    for ind, (path, fingerprint) in enumerate(watch_files):
+        yield tracker.report(ind, bytes_done, entries_done, force=True)
+        occ_dict = _new_occ_dict()
+        bytes_read = entries = batch_start = 0
+        for bytes_read, entries in _parse_watch_history_file(
+                occ_dict, path, streaming, prune_html, stop_at, seen=seen,
+                fingerprint=fingerprint):
+            progress = tracker.report(ind, bytes_done + bytes_read,
+                                      entries_done + entries)
+            if progress:
+                yield progress
+            if entries - batch_start >= batch_size:
+                yield _take_batch(occ_dict)
+                batch_start = entries
+        yield _take_batch(occ_dict)
+        size = tracker.sizes[ind]
+        bytes_done += bytes_read if size is None else size
+        entries_done += entries
+
+
+def _take_batch(occ_dict: dict) -> dict:
+    """
+    Returns the records accumulated in occ_dict so far, finalized, and empties
+    it, so that records parsed afterwards go into a new batch
+    """
+    batch = dict(occ_dict)
+    batch['videos'].finalize()
+    occ_dict.clear()
+    occ_dict.update(_new_occ_dict())
+    return batch
+
+
+def dump_records_to_json_lines(path: str, records: TakeoutRecords):
+    """
+    Writes records to a file with one JSON object per line, ex.
+    {"video_id": "...", "timestamps": ["2019-01-05 17:11:12", ...], ...}
+    """
+    with open(path, 'w', encoding='utf-8') as json_lines_file:
+        for video_id, record in records.items():
+            record['timestamps'] = [str(timestamp)
+                                    for timestamp in record['timestamps']]
+            json_lines_file.write(json.dumps(
+                {'video_id': video_id, **record}, ensure_ascii=False) + '\n')
@@ -13,10 +13,14 @@ from flask import (Response, Blueprint, request, redirect, make_response,
 from youtubewatched import write_to_sql
 from youtubewatched import youtube
 from youtubewatched.config import DB_NAME
-from youtubewatched.convert_takeout import get_all_records
+from youtubewatched.convert_takeout import (get_all_records,
+                                            get_files_to_parse,
+                                            iter_record_batches,
+                                            dump_parse_fails)
 from youtubewatched.utils.app import (get_project_dir_path_from_cookie,
                                       flash_err, strong)
-from youtubewatched.utils.gen import load_file, logging_config
+from youtubewatched.utils.gen import (load_file, logging_config,
+                                     iter_in_thread)
 from youtubewatched.utils.sql import (sqlite_connection, db_has_records,
                                       execute_query)
 
@@ -187,8 +191,14 @@ def start_db_process():
         takeout_dir = os.path.expanduser(takeout_path.strip())
         if os.path.exists(takeout_dir):
             resp.set_cookie(takeout_dir_cookie, takeout_dir, max_age=31_536_000)
-        args = (takeout_dir, project_path, logging_verbosity)
-        target = populate_db
+        force_reingest = request.form.get('force-reingest') == 'true'
+        newer_only = request.form.get('newer-only') == 'true'
+        args = (takeout_dir, project_path, logging_verbosity, force_reingest,
+                newer_only)
+        if request.form.get('pipelined') == 'true':
+            target = populate_db_pipelined
+        else:
+            target = populate_db
     else:
         cutoff_time = request.form.get('update-cutoff')
         cutoff_denomination = request.form.get('update-cutoff-denomination')
@@ -223,27 +233,72 @@ def _show_front_end_data(fe_data: dict, conn):
     add_sse_event(json.dumps(fe_data), 'stats')
 
 
-def populate_db(takeout_path: str, project_path: str, logging_verbosity: int):
+def _show_parse_fails(failed_files: list, failed_entries: list):
+    if failed_entries:
+        add_sse_event(f'Couldn\'t parse {len(failed_entries)} '
+                      f'entries; dumped to parse_fails.json '
+                      f'in project directory', 'warnings')
+    if failed_files:
+        add_sse_event('The following files could not be '
+                      'processed:', 'warnings')
+        for ff in failed_files:
+            add_sse_event(ff, 'warnings')
+
+
+def populate_db(takeout_path: str, project_path: str, logging_verbosity: int,
+                force_reingest=False, newer_only=False):
+    """
+    Parses Takeout and inserts the records into the DB. With newer_only, only
+    the entries newer than the ones already in it are parsed, see
+    get_all_records' watermark
+    """
 
     if DBProcessState.exit_thread_check():
         return
 
     progress.clear()
 
+    db_path = join(project_path, DB_NAME)
+    ingested_files = {}
+    watermark = None
+    if os.path.exists(db_path):
+        conn = sqlite_connection(db_path)
+        if not force_reingest:
+            ingested_files = write_to_sql.get_ingested_files(conn)
+        if newer_only:
+            watermark = write_to_sql.get_newest_timestamp(conn)
+        conn.close()
+
     DBProcessState.percent = '0'
     DBProcessState.stage = 'Processing watch-history.html file(s)...'
     add_sse_event(DBProcessState.stage, 'stage')
     records = {}
+    parsed_files = []
     try:
-        for f in get_all_records(takeout_path, project_path):
+        for f in get_all_records(takeout_path, streaming=True,
+                                 processes=os.cpu_count(),
+                                 ingested_files=ingested_files,
+                                 force_reingest=force_reingest,
+                                 fails_dir=project_path,
+                                 watermark=watermark,
+                                 cache_dir=project_path):
             if DBProcessState.exit_thread_check():
                 return
             if isinstance(f, tuple):
-                DBProcessState.percent = f'{f[0]} {f[1]}'
-                add_sse_event(DBProcessState.percent, 'takeout_progress')
+                _show_takeout_progress(f)
             else:
                 try:
                     records = f['videos']
+                    skipped_files = f['skipped_files']
+                    if skipped_files:
+                        add_sse_event(f'Skipped {len(skipped_files)} '
+                                      f'already added file(s)', 'info')
+                    _show_parse_fails(f['failed_files'], f['failed_entries'])
+                    if not f['total_timestamps'] and (
+                            skipped_files or watermark is not None):
+                        add_sse_event('Found nothing new to add', 'info')
+                        add_sse_event(event='stop')
+                        return
                     if len(records) == 1:  # 1 because of the empty unknown rec
                         add_sse_event('No records found in the provided '
                                       'watch-history.html file(s). '
@@ -254,18 +309,7 @@ def populate_db(takeout_path: str, project_path: str, logging_verbosity: int):
                                   f'{takeout_path!r}', 'errors')
                     return
 
-                failed_entries = f['failed_entries']
-                if failed_entries:
-                    add_sse_event(f'Couldn\'t parse {len(failed_entries)} ' 
-                                  f'entries; dumped to parse_fails.json '
-                                  f'in project directory', 'warnings')
-                failed_files = f['failed_files']
-                if failed_files:
-                    add_sse_event('The following files could not be '
-                                  'processed:', 'warnings')
-                    for ff in failed_files:
-                        add_sse_event(ff, 'warnings')
-
+                parsed_files = f['parsed_files']
                 total_ts = f['total_timestamps']
                 total_v = f['total_videos']
                 add_sse_event(f'Videos / timestamps found: '
@@ -279,7 +323,6 @@ def populate_db(takeout_path: str, project_path: str, logging_verbosity: int):
     if DBProcessState.exit_thread_check():
         return
 
-    db_path = join(project_path, DB_NAME)
     conn = sqlite_connection(db_path, types=True)
     front_end_data = {'updated': 0}
     try:
@@ -308,6 +351,9 @@ def populate_db(takeout_path: str, project_path: str, logging_verbosity: int):
             DBProcessState.percent = str(record[0])
             add_sse_event(f'{DBProcessState.percent} {record[1]}')
             front_end_data['updated'] = record[2]
+        else:
+            write_to_sql.add_ingested_files(conn, parsed_files,
+                                            logging_verbosity >= 2)
 
         _show_front_end_data(front_end_data, conn)
         if DBProcessState.stage:
@@ -334,6 +380,118 @@ def populate_db(takeout_path: str, project_path: str, logging_verbosity: int):
     conn.close()
 
 
+def populate_db_pipelined(takeout_path: str, project_path: str,
+                          logging_verbosity: int, force_reingest=False,
+                          newer_only=False, batch_size: int = 2000,
+                          max_queued: int = 8):
+    """
+    Same as populate_db, except records are inserted while the files are
+    still being parsed. They're parsed in a separate thread and passed here
+    in batches through a queue of up to max_queued items, so only a few
+    batches' worth of them are in memory at a time and the first ones get to
+    the DB within seconds. Timestamps from different batches and files are
+    deduplicated against the ones in the DB
+    """
+    if DBProcessState.exit_thread_check():
+        return
+
+    progress.clear()
+    DBProcessState.percent = '0'
+    DBProcessState.stage = 'Processing watch-history file(s)...'
+    add_sse_event(DBProcessState.stage, 'stage')
+
+    db_path = join(project_path, DB_NAME)
+    conn = sqlite_connection(db_path, types=True)
+    front_end_data = {'updated': 0}
+    failed_files, failed_entries = [], []
+    try:
+        api_auth = youtube.get_api_auth(
+            load_file(join(project_path, 'api_key')).strip())
+        write_to_sql.setup_tables(conn, api_auth)
+        front_end_data['at_start'] = execute_query(
+            conn, 'SELECT count(*) from videos')[0][0]
+        watch_files, skipped_files = get_files_to_parse(
+            takeout_path, write_to_sql.get_ingested_files(conn),
+            force_reingest)
+        if skipped_files:
+            add_sse_event(f'Skipped {len(skipped_files)} '
+                          f'already added file(s)', 'info')
+        if not watch_files:
+            if skipped_files:
+                add_sse_event('Found nothing new to add', 'info')
+                add_sse_event(event='stop')
+            else:
+                add_sse_event(f'No watch-history.html files found in '
+                              f'{takeout_path!r}', 'errors')
+            return
+
+        watermark = None
+        if newer_only:
+            watermark = write_to_sql.get_newest_timestamp(conn)
+        insert_state = write_to_sql.get_insert_state(conn)
+        for batch in iter_in_thread(
+                iter_record_batches(watch_files, batch_size=batch_size,
+                                    watermark=watermark),
+                max_queued):
+            if DBProcessState.exit_thread_check():
+                break
+            if isinstance(batch, tuple):
+                _show_takeout_progress(batch)
+                continue
+
+            failed_entries.extend(batch['failed_entries'])
+            for ff in batch['failed_files']:
+                add_sse_event(f'Could not process {ff}', 'warnings')
+            failed_files.extend(batch['failed_files'])
+            updated_before = front_end_data['updated']
+            stopped = False
+            for record in write_to_sql.insert_videos(
+                    conn, batch['videos'], api_auth, logging_verbosity,
+                    insert_state):
+                if DBProcessState.exit_thread_check():
+                    stopped = True
+                    break
+                front_end_data['updated'] = updated_before + record[2]
+            if stopped:
+                break
+            write_to_sql.add_ingested_files(conn, batch['parsed_files'],
+                                            logging_verbosity >= 2)
+
+        dump_parse_fails(project_path, failed_files, failed_entries)
+        if failed_entries:
+            add_sse_event(f'Couldn\'t parse {len(failed_entries)} '
+                          f'entries; dumped to parse_fails.json '
+                          f'in project directory', 'warnings')
+        _show_front_end_data(front_end_data, conn)
+    except youtube.ApiKeyError:
+        add_sse_event('Missing or invalid API key', 'errors')
+        raise
+    except youtube.ApiQuotaError:
+        add_sse_event('API quota/rate limit exceeded, see '
+                      '<a href="https://console.developers.google.com/apis/'
+                      'api/youtube.googleapis.com/overview" target="_blank">'
+                      'here</a>', 'errors')
+        raise
+    except (sqlite3.OperationalError, sqlite3.DatabaseError) as e:
+        add_sse_event(f'Fatal database error - {e!r}', 'errors')
+        raise
+    except FileNotFoundError:
+        add_sse_event('Invalid/non-existent path for watch-history.html '
+                      'files or database', 'errors')
+        raise
+    finally:
+        conn.close()
+
+
+def _show_takeout_progress(takeout_progress: tuple):
+    # "file_ind files bytes_read bytes_total entries entries_per_second eta",
+    # with - for unknown values
+    DBProcessState.percent = ' '.join(
+        '-' if value is None else str(round(value))
+        for value in takeout_progress)
+    add_sse_event(DBProcessState.percent, 'takeout_progress')
+
+
 def update_db(project_path: str, cutoff: int, logging_verbosity: int):
     import sqlite3
 
@@ -365,6 +523,7 @@ def update_db(project_path: str, cutoff: int, logging_verbosity: int):
             front_end_data['newly_active'] = record[4]
             front_end_data['deleted'] = record[5]
 
+        front_end_data.update(write_to_sql.get_update_schedule(conn, cutoff))
         _show_front_end_data(front_end_data, conn)
     except youtube.ApiKeyError:
         add_sse_event(f'{flash_err} Missing or invalid API key', 'errors')
@@ -92,12 +92,7 @@ function retrieveActiveProcess () {
                     addMsg(response["stage"]);
                     if (progressBarPercentage.innerHTML === ""){
                         if (response["percent"].includes(' ')) {
-                            let progressVal = response["percent"].split(" ");
-                            let currentFile = Number(progressVal[0]);
-                            let fileAmount =  Number(progressVal[1]);
-
-                            progressBar.style.width = (Number(currentFile / fileAmount).toFixed(2) * 100) + "%";
-                            progressBarPercentage.innerHTML = (currentFile+1) + " of " + fileAmount;
+                            showTakeoutProgress(response["percent"]);
                         } else {
                             progressBar.style.width = response["percent"] + "%";
                             progressBarPercentage.innerHTML = response["percent"] + "%";
@@ -150,6 +145,20 @@ let onEventStats = function(event) {
         msgString += "Total timestamps: " +
             msgJSON["timestamps"] + "<br>";
     }
+    if (msgJSON.hasOwnProperty("days_to_refresh")) {
+        if (msgJSON["records_due"] === 0) {
+            msgString += "All records are up to date<br>";
+        } else if (msgJSON["days_to_refresh"] === 0) {
+            msgString += "Records left to update: " + msgJSON["records_due"] +
+                ", within today's API quota budget<br>";
+        } else if (msgJSON["days_to_refresh"] !== null) {
+            msgString += "Records left to update: " + msgJSON["records_due"] +
+                ", all of them updated in " + msgJSON["days_to_refresh"] +
+                " day(s) at the current API quota budget<br>";
+        }
+        msgString += "API quota units used today: " + msgJSON["quota_used_today"] +
+            " of " + msgJSON["daily_budget"] + "<br>";
+    }
     msgString += "Total video records: " + msgJSON["records_in_db"];
     if (msgJSON["records_in_db"] > 0 && dbState === false) {
         dbState = true;
@@ -179,12 +188,34 @@ let onEventWarning = function(event) {
     addMsg(event.data, 'red');
 };
 
-let onEventTakeoutProgress = function (event) {
-    let progressVal = event.data.split(" ");
+function formatSeconds(seconds) {
+    let minutes = Math.floor(seconds / 60);
+    return (minutes ? minutes + "m " : "") + (seconds % 60) + "s";
+}
+
+function showTakeoutProgress(data) {
+    // "file_ind files bytes_read bytes_total entries entries_per_second eta",
+    // with - for unknown values
+    let progressVal = data.split(" ");
     let currentFile = Number(progressVal[0]);
     let fileAmount =  Number(progressVal[1]);
-    progressBar.style.width = (Number(currentFile / fileAmount).toFixed(2) * 100) + "%";
-    progressBarPercentage.innerHTML = (currentFile+1) + " of " + fileAmount;
+    let progressText = (currentFile+1) + " of " + fileAmount;
+    let fraction = currentFile / fileAmount;
+    if (progressVal.length > 2) {
+        if (progressVal[3] !== "-" && Number(progressVal[3]) > 0) {
+            fraction = Math.min(Number(progressVal[2]) / Number(progressVal[3]), 1);
+        }
+        progressText += ", " + progressVal[4] + " entries (" + progressVal[5] + "/s)";
+        if (progressVal[6] !== "-") {
+            progressText += ", ETA " + formatSeconds(Number(progressVal[6]));
+        }
+    }
+    progressBar.style.width = (Number(fraction).toFixed(2) * 100) + "%";
+    progressBarPercentage.innerHTML = progressText;
+}
+
+let onEventTakeoutProgress = function (event) {
+    showTakeoutProgress(event.data);
 };
 
 let onEventMsg = function (event) {
@@ -243,7 +274,11 @@ function processTakeout(event) {
     anAJAX.setRequestHeader("Content-type", "application/x-www-form-urlencoded");
     if (idOfElementActedOn === "takeout-form") {
         let takeoutDirectoryVal = document.querySelector("#takeout-input").value;
-        anAJAX.send("takeout-dir=" + takeoutDirectoryVal + "&logging-verbosity-level=" + logging_verbosity);
+        let forceReingest = document.querySelector("#force-reingest").checked;
+        let pipelined = document.querySelector("#pipelined").checked;
+        let newerOnly = document.querySelector("#newer-only").checked;
+        anAJAX.send("takeout-dir=" + takeoutDirectoryVal + "&logging-verbosity-level=" + logging_verbosity +
+            "&force-reingest=" + forceReingest + "&pipelined=" + pipelined + "&newer-only=" + newerOnly);
     } else {
         let updateCutoff = document.querySelector("#update-form input[name='update-cutoff']").value;
         let updateCutoffDenomination = document.querySelector("#update-cutoff-periods").value;
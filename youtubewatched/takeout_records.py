@@ -0,0 +1,332 @@
+import json
+import struct
+import sys
+import time
+from array import array
+from collections import Counter
+from collections.abc import Mapping
+
+import numpy as np
+
+from youtubewatched.config import MAX_TIME_DIFFERENCE
+from youtubewatched.utils.gen import (epoch_to_datetime, guess_utc_epoch,
+                                      remove_known_timestamps)
+
+MAX_SECONDS_DIFFERENCE = int(MAX_TIME_DIFFERENCE.total_seconds())
+# stands in for a UTC offset that isn't known, in the arrays of offsets
+NO_OFFSET = -2 ** 63
+# dedup keys pack a record's slot together with a timestamp's UTC epoch into
+# one int: slot * _SLOT_RANGE + UTC epoch
+_SLOT_RANGE = 2 ** 40
+
+_missing = object()
+_section_length = struct.Struct('<Q')
+
+
+def write_section(file, data: bytes):
+    """Writes a length-prefixed chunk of bytes, to be read by read_section"""
+    file.write(_section_length.pack(len(data)))
+    file.write(data)
+
+
+def read_section(file) -> bytes:
+    length = _section_length.unpack(file.read(_section_length.size))[0]
+    data = file.read(length)
+    if len(data) != length:
+        raise ValueError('Truncated section')
+    return data
+
+
+def _local_key(slot: int, epoch: int) -> int:
+    """
+    Packs a record's slot together with the parts of a local time that must
+    match for it to be a duplicate (see TimestampIndex) into one int:
+    ((slot * 10000 + year) * 13 + month) * 3600 + minute * 60 + second
+    """
+    ts = time.gmtime(epoch)
+    return (((slot * 10000 + ts.tm_year) * 13 + ts.tm_mon) * 3600 +
+            ts.tm_min * 60 + ts.tm_sec)
+
+
+class TakeoutRecords(Mapping):
+    """
+    Dict-like collection of the records parsed from Takeout, keyed on video ID.
+    Each record is a dict of timestamps (a sorted list of local datetimes, once
+    finalize has been called), utc_offsets (their offsets from UTC in seconds,
+    None where the time zone isn't known) and whichever of title, channel_id
+    and channel_title are known, same as they used to be in a plain dict.
+
+    Rather than a dict per video with a list of datetimes, the values are kept
+    in columns, with channel IDs/titles interned and timestamps stored in
+    arrays of epoch seconds (naive datetimes treated as UTC). Record dicts
+    are only built when retrieved, which cuts the memory taken by a few
+    hundred thousand timestamps several-fold.
+
+    Timestamps are duplicates if they're at the same UTC time, which is
+    checked with a set of packed int keys that's dropped by finalize. Where
+    the time zone isn't known, it's assumed to be this machine's, and since
+    that's only a guess, local times are matched as a fallback, the same way
+    WatchTimes does it. The records that have such timestamps are indexed on
+    their local times for that, in packed keys as well.
+    """
+
+    value_keys = ('title', 'channel_id', 'channel_title')
+
+    def __init__(self):
+        self._slots = {}
+        self._values = {key: [] for key in self.value_keys}
+        self._timestamps = []
+        self._offsets = []
+        self._seen = set()
+        # {local key: [index of the timestamp, ...]}, see _local_key
+        self._local = {}
+        self._local_slots = set()  # the slots that are in self._local
+
+    def _get_slot(self, video_id: str) -> int:
+        slot = self._slots.get(video_id)
+        if slot is None:
+            slot = len(self._timestamps)
+            self._slots[sys.intern(video_id)] = slot
+            for column in self._values.values():
+                column.append(None)
+            self._timestamps.append(array('q'))
+            self._offsets.append(array('q'))
+        return slot
+
+    def add(self, video_id: str, values: dict, watched_at: int = None,
+            utc_offset: int = None):
+        """
+        Adds a record or fills in the values it's missing, and adds the
+        timestamp (local time in epoch seconds, see datetime_to_epoch, and its
+        offset from UTC in seconds, if known) to it, unless it's a duplicate of
+        one it already has
+        """
+        slot = self._get_slot(video_id)
+        for key, value in values.items():
+            # checks if the newer record has some data that the one
+            # that's already set doesn't. Sets it if so
+            column = self._values[key]
+            if not column[slot]:
+                column[slot] = (value if key == 'title' or value is None
+                                else sys.intern(value))
+        if watched_at is not None:
+            self._add_timestamp(slot, watched_at, NO_OFFSET if utc_offset is
+                                None else utc_offset)
+
+    def _add_timestamp(self, slot: int, epoch: int, offset: int) -> bool:
+        guessed = offset == NO_OFFSET
+        key = slot * _SLOT_RANGE + (guess_utc_epoch(epoch) if guessed
+                                    else epoch - offset)
+        if key in self._seen:
+            return False
+        timestamps = self._timestamps[slot]
+        if guessed and slot not in self._local_slots:
+            self._local_slots.add(slot)
+            for ind, incumbent in enumerate(timestamps):
+                self._local.setdefault(_local_key(slot, incumbent),
+                                       []).append(ind)
+        if slot in self._local_slots:
+            # a guessed UTC time is compared to all local times, the rest
+            # only to the guessed ones'
+            offsets = self._offsets[slot]
+            same_local = self._local.setdefault(_local_key(slot, epoch), [])
+            for ind in same_local:
+                if (abs(timestamps[ind] - epoch) <= MAX_SECONDS_DIFFERENCE and
+                        (guessed or offsets[ind] == NO_OFFSET)):
+                    return False
+            same_local.append(len(timestamps))
+        self._seen.add(key)
+        timestamps.append(epoch)
+        self._offsets[slot].append(offset)
+        return True
+
+    def merge(self, other: 'TakeoutRecords'):
+        """
+        Adds the records from another instance, as if their timestamps were
+        added to this one in the order they were added to the other
+        """
+        for video_id, other_slot in other._slots.items():
+            self.add(video_id, other._get_values(other_slot))
+            slot = self._slots[video_id]
+            for epoch, offset in zip(other._timestamps[other_slot],
+                                     other._offsets[other_slot]):
+                self._add_timestamp(slot, epoch, offset)
+
+    def finalize(self):
+        """
+        Removes unknown timestamps that turn out to be the same as those of
+        known videos, sorts all timestamps and drops the dedup index. Nothing
+        else can be added afterwards
+        """
+        unk_slot = self._slots.get('unknown')
+        if unk_slot is not None and self._timestamps[unk_slot]:
+            remaining = self._get_unknown_remaining(unk_slot)
+            for columns in (self._timestamps, self._offsets):
+                column = array('q')
+                column.frombytes(np.frombuffer(
+                    columns[unk_slot], dtype=np.int64)[remaining].tobytes())
+                columns[unk_slot] = column
+
+        self.drop_dedup_index()
+        for slot in self._slots.values():
+            if len(self._timestamps[slot]) > 1:
+                timestamps = sorted(zip(self._timestamps[slot],
+                                        self._offsets[slot]))
+                self._timestamps[slot] = array(
+                    'q', [epoch for epoch, _ in timestamps])
+                self._offsets[slot] = array(
+                    'q', [offset for _, offset in timestamps])
+
+    def _get_unknown_remaining(self, unk_slot: int) -> np.ndarray:
+        """
+        Returns a mask of the unknown timestamps that aren't duplicates of
+        known videos' ones: those at the same UTC times are, and so are those
+        whose local times match (see remove_known_timestamps) where either
+        UTC time is guessed, each known timestamp matching no more than one
+        """
+        known_slots = [slot for slot in self._slots.values()
+                       if slot != unk_slot]
+        if not known_slots:
+            return np.ones(len(self._timestamps[unk_slot]), dtype=bool)
+        remaining = ~np.isin(
+            self._get_utc_epochs(unk_slot),
+            np.concatenate([self._get_utc_epochs(slot)
+                            for slot in known_slots]))
+        known_local = np.concatenate([
+            np.frombuffer(self._timestamps[slot], dtype=np.int64)
+            for slot in known_slots])
+        known_guessed = np.concatenate([
+            np.frombuffer(self._offsets[slot], dtype=np.int64) == NO_OFFSET
+            for slot in known_slots])
+        unk_local = np.frombuffer(self._timestamps[unk_slot], dtype=np.int64)
+        unk_guessed = (np.frombuffer(self._offsets[unk_slot], dtype=np.int64)
+                       == NO_OFFSET)
+        # guessed UTC times are compared to all local times, the rest only to
+        # the guessed ones'
+        for guessed, known in ((True, known_local),
+                               (False, known_local[known_guessed])):
+            candidates = np.flatnonzero(remaining & (unk_guessed == guessed))
+            if not len(candidates) or not len(known):
+                continue
+            remaining_epochs = Counter(remove_known_timestamps(
+                unk_local[candidates], known).tolist())
+            for ind, epoch in zip(candidates.tolist(),
+                                  unk_local[candidates].tolist()):
+                if remaining_epochs[epoch]:
+                    remaining_epochs[epoch] -= 1
+                else:
+                    remaining[ind] = False
+        return remaining
+
+    def _get_utc_epochs(self, slot: int) -> np.ndarray:
+        epochs = np.frombuffer(self._timestamps[slot], dtype=np.int64)
+        offsets = np.frombuffer(self._offsets[slot], dtype=np.int64)
+        unknown = offsets == NO_OFFSET
+        utc_epochs = epochs - np.where(unknown, 0, offsets)
+        for ind in np.flatnonzero(unknown).tolist():
+            utc_epochs[ind] = guess_utc_epoch(int(epochs[ind]))
+        return utc_epochs
+
+    def drop_dedup_index(self):
+        """
+        Frees the memory taken by the dedup index, ex. before sending an
+        instance to another process to be merged. Nothing else can be added
+        afterwards
+        """
+        self._seen = set()
+        self._local = {}
+        self._local_slots = set()
+
+    def dump(self, file):
+        """
+        Writes the records to a binary file: a JSON section with video IDs and
+        value columns, followed by the amount of timestamps per video and then
+        all of the timestamps and all of their UTC offsets, as int64 arrays
+        in the machine's byte order. The dedup index isn't written
+        """
+        slots = list(self._slots.values())
+        columns = {key: [column[slot] for slot in slots]
+                   for key, column in self._values.items()}
+        columns['video_id'] = list(self._slots)
+        write_section(file, json.dumps(
+            columns, ensure_ascii=False).encode('utf-8'))
+        write_section(file, array(
+            'q', [len(self._timestamps[slot]) for slot in slots]).tobytes())
+        for columns in (self._timestamps, self._offsets):
+            all_values = array('q')
+            for slot in slots:
+                all_values.extend(columns[slot])
+            write_section(file, all_values.tobytes())
+
+    @classmethod
+    def load(cls, file) -> 'TakeoutRecords':
+        """
+        Reads records written by dump. Like ones that have had their dedup
+        index dropped, they can only be merged into other instances
+        """
+        records = cls()
+        columns = json.loads(read_section(file).decode('utf-8'))
+        counts = array('q')
+        counts.frombytes(read_section(file))
+        all_timestamps = array('q')
+        all_timestamps.frombytes(read_section(file))
+        all_offsets = array('q')
+        all_offsets.frombytes(read_section(file))
+        records._slots = {sys.intern(video_id): slot for slot, video_id
+                          in enumerate(columns.pop('video_id'))}
+        for key in cls.value_keys:
+            column = columns[key]
+            if key != 'title':
+                column = [value if value is None else sys.intern(value)
+                          for value in column]
+            records._values[key] = column
+        start = 0
+        for count in counts:
+            records._timestamps.append(all_timestamps[start:start + count])
+            records._offsets.append(all_offsets[start:start + count])
+            start += count
+        if start != len(all_timestamps) or start != len(all_offsets):
+            raise ValueError('Timestamp counts do not add up')
+        return records
+
+    def total_timestamps(self) -> int:
+        return sum(len(self._timestamps[slot])
+                   for slot in self._slots.values())
+
+    def _get_values(self, slot: int) -> dict:
+        values = {}
+        for key, column in self._values.items():
+            if column[slot] is not None:
+                values[key] = column[slot]
+        return values
+
+    def __getitem__(self, video_id: str) -> dict:
+        slot = self._slots[video_id]
+        record = {'timestamps': [epoch_to_datetime(epoch)
+                                 for epoch in self._timestamps[slot]],
+                  'utc_offsets': [None if offset == NO_OFFSET else offset
+                                  for offset in self._offsets[slot]]}
+        record.update(self._get_values(slot))
+        return record
+
+    def __iter__(self):
+        return iter(self._slots)
+
+    def __len__(self) -> int:
+        return len(self._slots)
+
+    def __contains__(self, video_id) -> bool:
+        return video_id in self._slots
+
+    def pop(self, video_id: str, default=_missing):
+        if video_id not in self._slots:
+            if default is _missing:
+                raise KeyError(video_id)
+            return default
+        record = self[video_id]
+        slot = self._slots.pop(video_id)
+        for column in self._values.values():
+            column[slot] = None
+        self._timestamps[slot] = array('q')
+        self._offsets[slot] = array('q')
+        return record
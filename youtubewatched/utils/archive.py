@@ -0,0 +1,166 @@
+import io
+import os
+import tarfile
+import zipfile
+from contextlib import contextmanager
+
+archive_extensions = ('.zip', '.tgz', '.tar.gz')
+
+
+def is_archive(path: str) -> bool:
+    return path.endswith(archive_extensions) and os.path.isfile(path)
+
+
+def split_archive_path(path: str):
+    """
+    Splits a path pointing to a file inside an archive, ex.
+    <root dir>/takeout-20181120T163352Z-001.zip/Takeout/YouTube/history/
+    watch-history.html, into the archive's path and the member's name.
+    Returns None for regular paths
+    """
+    for extension in archive_extensions:
+        start = 0
+        while True:
+            ind = path.find(extension + '/', start)
+            if ind == -1:
+                break
+            archive_path = path[:ind + len(extension)]
+            if os.path.isfile(archive_path):
+                return archive_path, path[ind + len(extension) + 1:]
+            start = ind + 1
+
+
+def find_archive_members(archive_path: str, is_wanted) -> list:
+    """
+    Returns paths (see split_archive_path) to the files in an archive whose
+    names is_wanted returns True for. Nothing gets extracted
+    """
+    if archive_path.endswith('.zip'):
+        with zipfile.ZipFile(archive_path) as archive:
+            names = [member.filename for member in archive.infolist()
+                     if not member.is_dir()]
+    else:
+        with tarfile.open(archive_path, 'r:gz') as archive:
+            names = [member.name for member in archive if member.isfile()]
+    return [archive_path + '/' + name for name in names if is_wanted(name)]
+
+
+class ReadCounter:
+    """
+    Keeps count of the bytes read from a file opened with it (see
+    open_binary), adding them to content_hash as well, if it's passed
+    """
+
+    def __init__(self, content_hash=None):
+        self.bytes_read = 0
+        self.content_hash = content_hash
+
+    def update(self, data: bytes):
+        self.bytes_read += len(data)
+        if self.content_hash is not None:
+            self.content_hash.update(data)
+
+
+class _CountedFile(io.RawIOBase):
+    """Reads a binary file, reporting everything read to a ReadCounter"""
+
+    def __init__(self, file, counter: ReadCounter):
+        self._file = file
+        self._counter = counter
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        data = self._file.read(len(buffer))
+        buffer[:len(data)] = data
+        self._counter.update(data)
+        return len(data)
+
+
+def _read_rest(file, counter: ReadCounter, chunk_size: int = 2 ** 20):
+    for chunk in iter(lambda: file.read(chunk_size), b''):
+        counter.update(chunk)
+
+
+@contextmanager
+def _open_binary(path: str):
+    split_path = split_archive_path(path)
+    if split_path is None:
+        with open(path, 'rb') as file:
+            yield file
+        return
+
+    archive_path, member_name = split_path
+    if archive_path.endswith('.zip'):
+        with zipfile.ZipFile(archive_path) as archive:
+            with archive.open(member_name) as file:
+                yield file
+    else:
+        with tarfile.open(archive_path, 'r:gz') as archive:
+            file = archive.extractfile(member_name)
+            if file is None:
+                raise FileNotFoundError(path)
+            with file:
+                yield file
+
+
+@contextmanager
+def open_binary(path: str, counter: ReadCounter = None):
+    """
+    Opens a regular file or one inside an archive (see split_archive_path) for
+    reading in binary mode. Archive members are decompressed as they're read,
+    without being extracted to disk.
+
+    If counter is passed, the bytes read are reported to it. If it has a
+    content_hash, whatever's left unread is read into it once the file is
+    done with (unless that's due to an error), so the hash covers the whole
+    file without it having to be read, and decompressed, once again
+    """
+    with _open_binary(path) as file:
+        if counter is None:
+            yield file
+            return
+        try:
+            yield io.BufferedReader(_CountedFile(file, counter))
+        except GeneratorExit:  # closed by a generator that stopped early
+            if counter.content_hash is not None:
+                _read_rest(file, counter)
+            raise
+        if counter.content_hash is not None:
+            _read_rest(file, counter)
+
+
+@contextmanager
+def open_text(path: str, encoding: str = 'utf-8',
+              counter: ReadCounter = None):
+    """The text mode counterpart of open_binary"""
+    with open_binary(path, counter) as file:
+        with io.TextIOWrapper(file, encoding=encoding) as text_file:
+            yield text_file
+
+
+def get_size_and_mtime(path: str) -> tuple:
+    """
+    Returns a file's size and mtime. For archive members, those of the archive
+    itself are returned, which is enough to tell if the member is unchanged,
+    without having to look through the archive
+    """
+    split_path = split_archive_path(path)
+    stat = os.stat(path if split_path is None else split_path[0])
+    return stat.st_size, stat.st_mtime
+
+
+def get_uncompressed_size(path: str):
+    """
+    Returns a file's size, or the uncompressed size of a .zip archive member.
+    Returns None for members of .tgz archives, as finding out their size means
+    decompressing the archive up to them
+    """
+    split_path = split_archive_path(path)
+    if split_path is None:
+        return os.path.getsize(path)
+    archive_path, member_name = split_path
+    if archive_path.endswith('.zip'):
+        with zipfile.ZipFile(archive_path) as archive:
+            return archive.getinfo(member_name).file_size
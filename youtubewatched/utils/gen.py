@@ -1,9 +1,14 @@
-import bisect
+import calendar
 import logging
+import queue
 import sys
-from datetime import datetime
+import threading
+import time
+from datetime import datetime, timedelta
 from logging import handlers
 
+import numpy as np
+
 from youtubewatched.config import MAX_TIME_DIFFERENCE
 
 
@@ -71,52 +76,344 @@ def logging_config(log_file_path: str,
     return app_logger
 
 
-def are_different_timestamps(ts1: datetime,
-                             ts2: datetime) -> bool:
-    """Since each archive could potentially have timestamps in a
-    different timezone, the same ones from different files could
-    show as multiple unique timestamps due to different day/hour
+EPOCH = datetime(1970, 1, 1)
 
-    This function doesn't attempt to make timestamps accurate, and it may
-    block an extremely small number of legitimate ones from being
-    entered. Mostly, it will block the duplicates, however"""
-    if ts1.replace(day=1, hour=0) == ts2.replace(day=1, hour=0):
-        return False
-    return True
-
-
-def remove_timestamps_from_one_list_from_another(filter_, filteree):
-    """Useful for when Takeouts are added out of order and/or for
-    when stories show up as normal videos in newer Takeouts"""
-    for timestamp in filter_:
-        start = bisect.bisect_left(filteree,
-                                   timestamp - MAX_TIME_DIFFERENCE)
-        end = bisect.bisect_right(filteree,
-                                  timestamp + MAX_TIME_DIFFERENCE)
-        if start != end:
-            for potential_duplicate in range(start, end):
-                if not are_different_timestamps(timestamp,
-                                                filteree[potential_duplicate]):
-                    filteree.pop(potential_duplicate)
-                    break
-
-
-def timestamp_is_unique_in_list(candidate, timestamps, insert=False):
-    start = bisect.bisect_left(timestamps,
-                               candidate - MAX_TIME_DIFFERENCE)
-    end = bisect.bisect_right(timestamps,
-                              candidate + MAX_TIME_DIFFERENCE)
-    if start == end and start == 0:  # no similar records found
-        if insert:
-            bisect.insort_left(timestamps, candidate)
-    else:
-        for incumbent in range(start, end):
-            if not are_different_timestamps(candidate, timestamps[incumbent]):
+
+def datetime_to_epoch(timestamp: datetime) -> int:
+    """Treats a naive datetime as if it were UTC, for a lossless round trip
+    with epoch_to_datetime (to the second)"""
+    return calendar.timegm(timestamp.timetuple())
+
+
+def epoch_to_datetime(epoch: int) -> datetime:
+    return EPOCH + timedelta(seconds=epoch)
+
+
+def guess_utc_epoch(epoch: int) -> int:
+    """
+    Converts a local time whose time zone isn't known, in epoch seconds (see
+    datetime_to_epoch), to an actual UTC epoch by assuming it's in this
+    machine's time zone
+    """
+    return int(time.mktime(time.gmtime(epoch)[:8] + (-1,)))
+
+
+# larger than the range of epochs this deals with, for packing sort keys
+_EPOCH_RANGE = 2 ** 36
+
+
+class TimestampIndex:
+    """
+    A collection of timestamps in which ones whose year, month, minute and
+    second match and are no more than MAX_TIME_DIFFERENCE apart are treated as
+    duplicates. Since each archive could be in a different time zone, the
+    same timestamps from different files could otherwise show up as several
+    unique ones, differing by day/hour.
+
+    Timestamps are kept in buckets keyed on the parts that must match for them
+    to be duplicates (year, month, minute, second), so lookups, insertions and
+    removals only ever look at the handful of timestamps in a single bucket,
+    instead of scanning a window of a sorted list.
+    """
+
+    __slots__ = ('_buckets', '_len')
+
+    def __init__(self, timestamps=()):
+        self._buckets = {}
+        self._len = 0
+        for timestamp in timestamps:
+            self.add(timestamp)
+
+    @staticmethod
+    def _key(timestamp: datetime) -> tuple:
+        return (timestamp.year, timestamp.month, timestamp.minute,
+                timestamp.second, timestamp.microsecond)
+
+    def find(self, timestamp: datetime):
+        """Returns the timestamp's duplicate from the index, if there's one"""
+        for incumbent in self._buckets.get(self._key(timestamp), ()):
+            if abs(incumbent - timestamp) <= MAX_TIME_DIFFERENCE:
+                return incumbent
+
+    def __contains__(self, timestamp: datetime) -> bool:
+        return self.find(timestamp) is not None
+
+    def add(self, timestamp: datetime) -> bool:
+        """Adds the timestamp if it's unique; returns whether it was"""
+        bucket = self._buckets.setdefault(self._key(timestamp), [])
+        for incumbent in bucket:
+            if abs(incumbent - timestamp) <= MAX_TIME_DIFFERENCE:
                 return False
+        bucket.append(timestamp)
+        self._len += 1
+        return True
+
+    def insert(self, timestamp: datetime):
+        """Adds the timestamp even if the index already has a duplicate of
+        it"""
+        self._buckets.setdefault(self._key(timestamp), []).append(timestamp)
+        self._len += 1
+
+    def discard(self, timestamp: datetime):
+        """Removes the timestamp itself (not a duplicate of it), if present"""
+        key = self._key(timestamp)
+        bucket = self._buckets.get(key, ())
+        if timestamp in bucket:
+            bucket.remove(timestamp)
+            if not bucket:
+                del self._buckets[key]
+            self._len -= 1
+
+    def remove_duplicate(self, timestamp: datetime):
+        """Removes and returns the timestamp's duplicate, if there's one"""
+        key = self._key(timestamp)
+        bucket = self._buckets.get(key, ())
+        for ind, incumbent in enumerate(bucket):
+            if abs(incumbent - timestamp) <= MAX_TIME_DIFFERENCE:
+                bucket.pop(ind)
+                if not bucket:
+                    del self._buckets[key]
+                self._len -= 1
+                return incumbent
+
+    def __len__(self) -> int:
+        return self._len
+
+    def __iter__(self):
+        for bucket in self._buckets.values():
+            yield from bucket
+
+    def sorted(self) -> list:
+        return sorted(self)
+
+
+class WatchTimes:
+    """
+    A video's timestamps as stored in the DB, by their UTC epoch seconds,
+    along with their local times (as they appear in Takeout). Where the time
+    zone wasn't known, the UTC time is only a guess (see guess_utc_epoch), ex.
+    for timestamps inserted before UTC times were stored.
+
+    Timestamps with known time zones are duplicates only if they're at the
+    exact same UTC time, which is a plain dict lookup. A guessed one may be
+    off by the difference between time zones, so for it, as well as for
+    anything compared to it, TimestampIndex's matching on local times is used
+    as a fallback
+    """
+
+    __slots__ = ('_times', '_by_local', '_guessed', '_local')
+
+    def __init__(self):
+        self._times = {}  # UTC epoch: (local time, whether UTC is guessed)
+        self._by_local = {}  # local time: [UTC epoch, ...]
+        self._guessed = TimestampIndex()  # local times with guessed UTC
+        # all local times, only built once a guessed timestamp is looked up
+        self._local = None
+
+    def find(self, local: datetime, utc: int, guessed: bool):
+        """Returns the UTC epoch of the timestamp's duplicate, if there's
+        one"""
+        if utc in self._times:
+            return utc
+        if guessed:
+            if self._local is None:
+                self._local = TimestampIndex()
+                for incumbent in self._by_local:
+                    self._local.insert(incumbent)
+            incumbent = self._local.find(local)
+        elif self._guessed:
+            incumbent = self._guessed.find(local)
         else:
-            if insert:
-                bisect.insort_left(timestamps, candidate)
-    return True
+            return
+        if incumbent is not None:
+            for incumbent_utc in self._by_local[incumbent]:
+                if guessed or self._times[incumbent_utc][1]:
+                    return incumbent_utc
+
+    def add(self, local: datetime, utc: int, guessed: bool) -> bool:
+        """Adds the timestamp if it's unique; returns whether it was"""
+        if self.find(local, utc, guessed) is not None:
+            return False
+        self._times[utc] = (local, guessed)
+        same_local = self._by_local.setdefault(local, [])
+        same_local.append(utc)
+        if guessed:
+            self._guessed.insert(local)
+        if self._local is not None and len(same_local) == 1:
+            self._local.insert(local)
+        return True
+
+    def remove_duplicate(self, local: datetime, utc: int, guessed: bool):
+        """Removes the timestamp's duplicate and returns its UTC epoch, if
+        there's one"""
+        incumbent_utc = self.find(local, utc, guessed)
+        if incumbent_utc is None:
+            return
+        incumbent, incumbent_guessed = self._times.pop(incumbent_utc)
+        same_local = self._by_local[incumbent]
+        same_local.remove(incumbent_utc)
+        if not same_local:
+            del self._by_local[incumbent]
+            if self._local is not None:
+                self._local.discard(incumbent)
+        if incumbent_guessed:
+            self._guessed.discard(incumbent)
+        return incumbent_utc
+
+    def __len__(self) -> int:
+        return len(self._times)
+
+    def __iter__(self):
+        """Yields (local time, UTC epoch, whether it's guessed) tuples"""
+        for utc, (local, guessed) in self._times.items():
+            yield local, utc, guessed
+
+
+def remove_known_timestamps(unknown, known) -> np.ndarray:
+    """
+    Removes the duplicates (same as TimestampIndex treats them) of known
+    timestamps from unknown ones, each known one removing no more than one,
+    and returns the remaining unknown ones, sorted. Both are sequences of epoch
+    seconds, see datetime_to_epoch.
+
+    Rather than looking each known timestamp up separately, all of them are
+    matched at once: both are sorted on the parts that have to be the same for
+    timestamps to be duplicates and then on time, so every known timestamp's
+    earliest candidate can be found with a single searchsorted. The earliest
+    known timestamp in each group of them that could have the same candidates
+    takes its one, and the rest of the group gets another go in the next
+    round, which only takes as many rounds as there are known timestamps in
+    the largest group that still have candidates, usually a few
+    """
+    unknown = np.asarray(unknown, dtype=np.int64)
+    known = np.asarray(known, dtype=np.int64)
+    if not len(unknown) or not len(known):
+        return np.sort(unknown)
+
+    max_difference = int(MAX_TIME_DIFFERENCE.total_seconds())
+    # minute and second of the hour first, then the time itself. Timestamps in
+    # the same month with the same minute and second are contiguous, so the
+    # candidates for each known timestamp are a single range
+    offset = min(unknown.min(), known.min())
+    unknown = np.sort(unknown % 3600 * _EPOCH_RANGE + (unknown - offset))
+    known = known[np.argsort(known % 3600 * _EPOCH_RANGE + known,
+                             kind='stable')]
+    known_base = known % 3600 * _EPOCH_RANGE - offset
+    months = known.astype('datetime64[s]').astype('datetime64[M]')
+    month_start = months.astype('datetime64[s]').astype(np.int64)
+    month_end = (months + 1).astype('datetime64[s]').astype(np.int64) - 1
+    groups = known_base + month_start
+    lower = known_base + np.maximum(known - max_difference, month_start)
+    upper = known_base + np.minimum(known + max_difference, month_end)
+
+    remaining = np.ones(len(unknown), dtype=bool)
+    pending = np.arange(len(known))
+    while len(pending):
+        remaining_ind = np.flatnonzero(remaining)
+        remaining_keys = unknown[remaining_ind]
+        candidates = np.searchsorted(remaining_keys, lower[pending])
+        found = candidates < len(remaining_keys)
+        found[found] = (remaining_keys[candidates[found]] <=
+                        upper[pending[found]])
+        pending, candidates = pending[found], candidates[found]
+        first = np.ones(len(pending), dtype=bool)
+        first[1:] = groups[pending[1:]] != groups[pending[:-1]]
+        remaining[remaining_ind[candidates[first]]] = False
+        pending = pending[~first]
+    return np.sort(unknown[remaining] % _EPOCH_RANGE + offset)
+
+
+def iter_in_thread(iterable, max_queued: int):
+    """
+    Runs through an iterable in a background thread and yields its items in
+    the same order, as they come. No more than max_queued items are kept
+    waiting at a time; the thread is blocked until some are taken. Exceptions
+    raised by the iterable are raised here, and closing this generator, ex.
+    by breaking out of a for loop over it, stops the thread
+    """
+    items = queue.Queue(max_queued)
+    stop = threading.Event()
+    done = object()
+
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        iterator = iter(iterable)
+        try:
+            for item in iterator:
+                if not put((item, None)):
+                    return
+            put((done, None))
+        except BaseException as e:
+            put((done, e))
+        finally:
+            if hasattr(iterator, 'close'):
+                iterator.close()
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = items.get()
+            if item is done:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+class TokenBucket:
+    """
+    A rate limiter that can be shared between threads. acquire blocks until a
+    token is available, tokens being added at rate per second, up to capacity.
+
+    back_off halves the rate, down to min_rate, for when the server reports
+    it's being exceeded, and every acquire after that brings it back up by
+    a twentieth of the initial rate, up to it (additive increase,
+    multiplicative decrease).
+
+    acquired counts the tokens taken so far, i.e. the requests made
+    """
+
+    def __init__(self, rate: float, capacity: float = None,
+                 min_rate: float = 0.5):
+        self.max_rate = self.rate = rate
+        self.capacity = capacity or rate
+        self.min_rate = min_rate
+        self._tokens = self.capacity
+        self.acquired = 0
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens +
+                               (now - self._updated) * self.rate)
+            self._updated = now
+            # a token is taken right away, even if it's yet to be added, so
+            # that waiting threads get them in the order they asked
+            self._tokens -= 1
+            self.acquired += 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+        if wait:
+            time.sleep(wait)
+
+    def back_off(self):
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self._tokens = min(self._tokens, 0)
 
 
 def load_file(path: str):
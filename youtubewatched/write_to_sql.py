@@ -1,22 +1,24 @@
-import bisect
 import json
 import logging
-import itertools
 import sqlite3
 import time
-from datetime import datetime
-from typing import Union
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from itertools import chain, count, islice, repeat
 
 from youtubewatched import youtube
-from youtubewatched.config import video_keys_and_columns, MAX_TIME_DIFFERENCE
+from youtubewatched.config import (API_DAILY_UPDATE_BUDGET, API_FETCHERS,
+                                   API_REQUESTS_PER_SECOND,
+                                   API_UNITS_PER_VIDEOS_REQUEST,
+                                   video_keys_and_columns, video_keys_parts)
 from youtubewatched.topics import topics
 from youtubewatched.utils.sql import execute_query
 from youtubewatched.utils.sql import (generate_insert_query,
                                       generate_unconditional_update_query)
-from youtubewatched.utils.gen import (
-    are_different_timestamps,
-    timestamp_is_unique_in_list,
-    remove_timestamps_from_one_list_from_another)
+from youtubewatched.utils.gen import (TokenBucket, WatchTimes,
+                                     datetime_to_epoch, epoch_to_datetime,
+                                     guess_utc_epoch, remove_known_timestamps)
 
 logger = logging.getLogger(__name__)
 
@@ -60,6 +62,7 @@ TABLE_SCHEMAS = {
     dislike_count integer,
     comment_count integer,
     stream text,
+    etag text,
     foreign key (channel_id) references channels (id)
     on update cascade on delete cascade
     );''',
@@ -82,10 +85,15 @@ TABLE_SCHEMAS = {
     on update cascade on delete cascade
     );''',
     
+    # watched_at is the local time, as it appears in Takeout; utc_offset is
+    # null where the time zone isn't known and watched_at_utc is a guess, see
+    # WatchTimes
     'videos_timestamps': '''videos_timestamps (
     video_id text,
     watched_at timestamp,
-    unique(video_id, watched_at),
+    watched_at_utc integer,
+    utc_offset integer,
+    unique(video_id, watched_at_utc),
     foreign key (video_id) references videos (id)
     on update cascade on delete cascade
     );''',
@@ -94,6 +102,23 @@ TABLE_SCHEMAS = {
     # minimal identifying data, such as title
     'dead_videos_ids': '''dead_videos_ids (
     id text primary key
+    );''',
+
+    # Takeout files whose records have been fully inserted, so they can be
+    # skipped when the same files are added again
+    'takeout_files': '''takeout_files (
+    path text primary key,
+    size integer,
+    mtime real,
+    hash text,
+    ingested_at timestamp
+    );''',
+
+    # API quota units spent on each day, as counted by the quota's own
+    # calendar; see get_quota_day
+    'api_quota_usage': '''api_quota_usage (
+    day text primary key,
+    units integer
     );'''
 }
 
@@ -104,8 +129,10 @@ TOPICS_COLUMNS = ['id', 'topic']
 TAGS_COLUMNS = ['tag']  # id column value is added implicitly by SQLite
 VIDEOS_TAGS_COLUMNS = ['video_id', 'tag_id']
 VIDEOS_TOPICS_COLUMNS = ['video_id', 'topic_id']
-VIDEOS_TIMESTAMPS_COLUMNS = ['video_id', 'watched_at']
+VIDEOS_TIMESTAMPS_COLUMNS = ['video_id', 'watched_at', 'watched_at_utc',
+                             'utc_offset']
 DEAD_VIDEOS_IDS_COLUMNS = ['id']
+TAKEOUT_FILES_COLUMNS = ['path', 'size', 'mtime', 'hash', 'ingested_at']
 
 # below are rigid insert queries, ones whose amount of columns will not change
 # between records
@@ -119,81 +146,21 @@ add_time_to_video_query = generate_insert_query(
     'videos_timestamps',
     columns=VIDEOS_TIMESTAMPS_COLUMNS)
 delete_time_query = '''DELETE FROM videos_timestamps
-                       WHERE video_id = ? AND watched_at = ?'''
+                       WHERE video_id = ? AND watched_at_utc = ?'''
+touch_video_query = 'UPDATE videos SET last_updated = ? WHERE id = ?'
 add_dead_video_query = generate_insert_query('dead_videos_ids',
                                              columns=DEAD_VIDEOS_IDS_COLUMNS,
                                              on_conflict_ignore=True)
-
-
-def get_final_key_paths(
-        obj: Union[dict, list, tuple], cur_path: str = '',
-        append_values: bool = False,
-        paths: list = None, black_list: list = None,
-        final_keys_only: bool = False):
-    """
-    Returns paths to terminating keys as strings
-
-    :param obj:
-    :param cur_path: name of the variable that's being passed as the obj can be
-    passed here to create eval ready key paths, for whatever reason
-    :param append_values: return corresponding key values along with the keys
-    :param paths: the list that will contain all the found key paths, no need
-    to pass anything
-    :param black_list: keys to ignore (single keys anywhere in the path); if a
-    blacklisted key is encountered, it's considered a dead end even if its value
-    is another dictionary
-    :param final_keys_only: return only the terminating keys instead of full
-    paths
-    :return:
-    """
-    if paths is None:
-        paths = []
-
-    if isinstance(obj, (dict, list, tuple)):
-        if isinstance(obj, dict):
-            for key in obj:
-                new_path = cur_path + f'[\'{key}\']'
-                if isinstance(obj[key], dict):
-                    if black_list is not None and key in black_list:
-                        continue
-                    get_final_key_paths(
-                        obj[key], new_path, append_values, paths, black_list,
-                        final_keys_only)
-                elif isinstance(obj[key], (list, tuple)):
-                    get_final_key_paths(
-                        obj[key], new_path, append_values, paths, black_list,
-                        final_keys_only)
-                else:
-                    if final_keys_only:
-                        last_bracket = new_path.rfind('[\'')
-                        new_path = new_path[
-                                   last_bracket+2:new_path.rfind('\'')]
-                    if append_values:
-                        to_append = [new_path, obj[key]]
-                    else:
-                        to_append = new_path
-                    paths.append(to_append)
-        else:
-            key_added = False
-            for i in range(len(obj)):
-                if isinstance(obj[i], (dict, tuple, list)):
-                    get_final_key_paths(
-                        obj[i], cur_path + f'[{i}]', append_values,
-                        paths, black_list, final_keys_only)
-                else:
-                    if not key_added:
-                        if final_keys_only:
-                            last_bracket = cur_path.rfind('[\'')
-                            cur_path = cur_path[
-                                       last_bracket+2:cur_path.rfind('\'')]
-                        if append_values:
-                            to_append = [cur_path, obj]
-                        else:
-                            to_append = cur_path
-                        paths.append(to_append)
-                        key_added = True
-
-    return paths
+add_takeout_file_query = generate_insert_query(
+    'takeout_files',
+    columns=TAKEOUT_FILES_COLUMNS).replace('INSERT', 'INSERT OR REPLACE', 1)
+
+# video_keys_and_columns' camelCase converted to underscores
+_video_columns = {
+    key: ''.join('_' + letter.lower() if letter.isupper() else letter
+                 for letter in key)
+    for key in video_keys_and_columns
+}
 
 
 def get_record_id_and_title(record_dict: dict):
@@ -255,34 +222,32 @@ def calculate_commit_interval(sub_percent: int):
 
 def wrangle_video_record(json_obj: dict):
     """
-    Extracts the keys deemed necessary from a Youtube API response, converts
-    some of them to the right types and returns them in a dict
+    Extracts video_keys_and_columns from a Youtube API video resource, looking
+    them up in their parts (see config.video_keys_parts), converts some of
+    them to the right types and returns them in a dict
     """
     entry_dict = {}
-    for key, value in get_final_key_paths(
-            json_obj, '', True, black_list=['localized', 'thumbnails'],
-            final_keys_only=True):
-        if key in video_keys_and_columns:  # converting camelCase to underscore
-            new_key = []
-            for letter in key:
-                if letter.isupper():
-                    new_key.append('_' + letter.lower())
-                else:
-                    new_key.append(letter)
-            key = ''.join(new_key)
-            if key == 'relevant_topic_ids':
-                value = list(set(value))  # due to duplicate parent topic ids
-            elif key == 'duration':
-                value = convert_duration(value)
-            elif key == 'published_at':
-                value = value.replace('T', ' ')
-            elif key == 'actual_start_time':
-                key = 'stream'
-                value = 'true'
-            elif key in ['view_count', 'dislike_count', 'like_count',
-                         'comment_count']:
-                value = int(value)
-            entry_dict[key] = value
+    for key in video_keys_and_columns:
+        part = video_keys_parts[key]
+        value = (json_obj if part is None else
+                 json_obj.get(part) or {}).get(key)
+        if value is None or value == []:
+            continue
+        # converting camelCase to underscore
+        key = _video_columns[key]
+        if key == 'relevant_topic_ids':
+            value = list(set(value))  # due to duplicate parent topic ids
+        elif key == 'duration':
+            value = convert_duration(value)
+        elif key == 'published_at':
+            value = value.replace('T', ' ')
+        elif key == 'actual_start_time':
+            key = 'stream'
+            value = 'true'
+        elif key in ['view_count', 'dislike_count', 'like_count',
+                     'comment_count']:
+            value = int(value)
+        entry_dict[key] = value
 
     return entry_dict
 
@@ -336,6 +301,15 @@ def update_video(conn: sqlite3.Connection, cols_vals: dict, verbose=False):
         return True
 
 
+def touch_video(conn: sqlite3.Connection, video_id: str, verbose=False):
+    """Only sets last_updated, for a video that hasn't changed"""
+    if execute_query(conn, touch_video_query,
+                     (datetime.utcnow().replace(microsecond=0), video_id)):
+        if verbose:
+            logger.info(f'Video {video_id!r} is unchanged')
+        return True
+
+
 def add_tag(conn: sqlite3.Connection, tag: str, verbose=False):
     if execute_query(conn, add_tag_query, (tag,)):
         if verbose:
@@ -390,20 +364,23 @@ def add_topic_to_video(conn: sqlite3.Connection, topic: str, video_id: str,
         return True
 
 
-def add_time(conn: sqlite3.Connection, watched_at: str, video_id: str,
-             verbose=False):
+def add_time(conn: sqlite3.Connection, watched_at: datetime, video_id: str,
+             watched_at_utc: int, utc_offset: int = None, verbose=False):
     if execute_query(
-            conn, add_time_to_video_query, (video_id, watched_at), False):
+            conn, add_time_to_video_query,
+            (video_id, watched_at, watched_at_utc, utc_offset), False):
         if verbose:
             logger.info(f'Added timestamp {watched_at} to {video_id!r}')
         return True
 
 
-def delete_time(conn: sqlite3.Connection, watched_at: str, video_id: str,
+def delete_time(conn: sqlite3.Connection, watched_at_utc: int, video_id: str,
                 verbose=False):
-    if execute_query(conn, delete_time_query, (video_id, watched_at)):
+    if execute_query(conn, delete_time_query, (video_id, watched_at_utc)):
         if verbose:
-            logger.info(f'Removed timestamp {watched_at} from {video_id!r}')
+            logger.info(f'Removed timestamp '
+                        f'{epoch_to_datetime(watched_at_utc)} UTC from '
+                        f'{video_id!r}')
         return True
 
 
@@ -420,6 +397,103 @@ def delete_dead_video(conn: sqlite3.Connection, video_id, verbose=False):
         return True
 
 
+def get_ingested_files(conn: sqlite3.Connection) -> dict:
+    """
+    Returns {path: (size, mtime, hash)} for the Takeout files that have already
+    been ingested; empty if the project predates the takeout_files table
+    """
+    cur = conn.cursor()
+    try:
+        cur.execute('SELECT path, size, mtime, hash FROM takeout_files')
+        return {row[0]: tuple(row[1:]) for row in cur.fetchall()}
+    except sqlite3.OperationalError:
+        return {}
+    finally:
+        cur.close()
+
+
+def get_quota_day() -> str:
+    """
+    Returns the date the API quota is currently being spent on. It's reset at
+    midnight Pacific Time; DST is ignored, which only makes the day start an
+    hour late during it
+    """
+    return (datetime.utcnow() - timedelta(hours=8)).strftime('%Y-%m-%d')
+
+
+def get_quota_used(conn: sqlite3.Connection, day: str = None) -> int:
+    """Returns the API quota units recorded as spent on a day, today's by
+    default"""
+    cur = conn.cursor()
+    try:
+        cur.execute('SELECT units FROM api_quota_usage WHERE day = ?',
+                    (day or get_quota_day(),))
+        row = cur.fetchone()
+        return row[0] if row else 0
+    except sqlite3.OperationalError:
+        return 0
+    finally:
+        cur.close()
+
+
+def add_quota_used(conn: sqlite3.Connection, units: int, day: str = None,
+                   at_least=False):
+    """
+    Adds units to the ones spent on a day, today by default. With at_least,
+    sets them to units instead, unless more have already been recorded
+    """
+    day = day or get_quota_day()
+    execute_query(conn, 'CREATE TABLE IF NOT EXISTS ' +
+                  TABLE_SCHEMAS['api_quota_usage'])
+    execute_query(conn, '''INSERT OR IGNORE INTO api_quota_usage (day, units)
+                           VALUES (?, 0)''', (day,))
+    if at_least:
+        query = 'UPDATE api_quota_usage SET units = max(units, ?) WHERE day = ?'
+    else:
+        query = 'UPDATE api_quota_usage SET units = units + ? WHERE day = ?'
+    execute_query(conn, query, (units, day))
+
+
+def _record_api_requests(conn: sqlite3.Connection, limiter: TokenBucket,
+                         recorded: int) -> int:
+    """
+    Adds the quota spent on the requests made through limiter since recorded
+    of them were, and returns how many have been recorded now
+    """
+    if limiter.acquired > recorded:
+        add_quota_used(conn, (limiter.acquired - recorded) *
+                       API_UNITS_PER_VIDEOS_REQUEST)
+    return limiter.acquired
+
+
+def get_newest_timestamp(conn: sqlite3.Connection):
+    """
+    Returns the newest timestamp in the DB, i.e. the point up to which Takeout
+    has been ingested, or None if there are none
+    """
+    newest = execute_query(
+        conn, 'SELECT max(watched_at) FROM videos_timestamps')
+    if newest and newest[0][0]:
+        return datetime.strptime(newest[0][0], '%Y-%m-%d %H:%M:%S')
+
+
+def add_ingested_files(conn: sqlite3.Connection, files: list, verbose=False):
+    """
+    Records Takeout files as ingested
+
+    :param conn:
+    :param files: (path, size, mtime, hash) tuples, as found under
+    'parsed_files' in convert_takeout.get_all_records' results
+    :param verbose:
+    """
+    ingested_at = datetime.utcnow().replace(microsecond=0)
+    for file in files:
+        if execute_query(conn, add_takeout_file_query, (*file, ingested_at)):
+            if verbose:
+                logger.info(f'Recorded {file[0]!r} as ingested')
+    conn.commit()
+
+
 def insert_or_refresh_categories(conn: sqlite3.Connection, api_auth,
                                  refresh: bool = True):
     """Gets the video categories info from YT API."""
@@ -450,10 +524,104 @@ def insert_topics(conn: sqlite3.Connection):
     conn.commit()
 
 
+def _local_epoch(watched_at: str) -> int:
+    return datetime_to_epoch(
+        datetime.strptime(watched_at[:19], '%Y-%m-%d %H:%M:%S'))
+
+
+def _guess_utc_epoch(watched_at: str) -> int:
+    return guess_utc_epoch(_local_epoch(watched_at))
+
+
+def _guess_free_utc_epoch(conn: sqlite3.Connection, video_id: str,
+                          watched_at: str) -> int:
+    """
+    Guesses the UTC epoch of a timestamp whose guess_utc_epoch is already
+    taken by another one of the video's, by applying the UTC offsets from a
+    day before and after it instead, which differ across a DST transition.
+    If those are taken too, the first free second after the guess is used
+    """
+    local = _local_epoch(watched_at)
+    guessed = guess_utc_epoch(local)
+    for utc in chain((local - time.localtime(guessed + shift).tm_gmtoff
+                      for shift in (-86400, 86400)), count(guessed + 1)):
+        if not execute_query(conn, """SELECT 1 FROM videos_timestamps
+                                      WHERE video_id = ?
+                                      AND watched_at_utc = ?""",
+                             (video_id, utc)):
+            return utc
+
+
+def add_utc_timestamps(conn: sqlite3.Connection):
+    """
+    One-time migration of videos_timestamps from before UTC times were stored.
+    The table is rebuilt with the watched_at_utc and utc_offset columns, and
+    unique on watched_at_utc rather than watched_at. The existing timestamps'
+    time zones aren't known, so their UTC times are guessed by assuming
+    they're in this machine's time zone, which is what they were converted to
+    when ingesting watch-history.json, and the likeliest one for
+    watch-history.html
+    """
+    cur = conn.cursor()
+    cur.execute('PRAGMA table_info(videos_timestamps)')
+    columns = [row[1] for row in cur.fetchall()]
+    cur.close()
+    if not columns or 'watched_at_utc' in columns:
+        return
+    logger.info('Adding UTC times to the timestamps in the DB...')
+    conn.create_function('guess_utc_epoch', 1, _guess_utc_epoch)
+    execute_query(conn, 'ALTER TABLE videos_timestamps '
+                        'RENAME TO videos_timestamps_old')
+    execute_query(conn, 'CREATE TABLE ' + TABLE_SCHEMAS['videos_timestamps'])
+    execute_query(conn, '''INSERT OR IGNORE INTO videos_timestamps
+                           (video_id, watched_at, watched_at_utc)
+                           SELECT video_id, watched_at,
+                           guess_utc_epoch(watched_at)
+                           FROM videos_timestamps_old''')
+    # distinct local times can be guessed to be at the same UTC time when DST
+    # starts, ex. 2:30 (which is skipped) and 3:30; the ones that were left
+    # out for that are added at another UTC time
+    collisions = execute_query(
+        conn, '''SELECT rowid, video_id, CAST(watched_at AS text)
+                 FROM videos_timestamps_old AS old
+                 WHERE NOT EXISTS (SELECT 1 FROM videos_timestamps
+                                   WHERE video_id = old.video_id
+                                   AND watched_at = old.watched_at)''')
+    for row_id, video_id, watched_at in collisions:
+        execute_query(conn, '''INSERT INTO videos_timestamps
+                               (video_id, watched_at, watched_at_utc)
+                               SELECT video_id, watched_at, ?
+                               FROM videos_timestamps_old WHERE rowid = ?''',
+                      (_guess_free_utc_epoch(conn, video_id, watched_at),
+                       row_id))
+    if collisions:
+        logger.info(f'Moved the guessed UTC times of {len(collisions)} '
+                    f'timestamps that coincided with others')
+    execute_query(conn, 'DROP TABLE videos_timestamps_old')
+    conn.commit()
+
+
+def add_video_etags(conn: sqlite3.Connection):
+    """
+    One-time migration of videos from before the API's ETags were stored.
+    They're left empty, to be filled in by the next update
+    """
+    cur = conn.cursor()
+    cur.execute('PRAGMA table_info(videos)')
+    columns = [row[1] for row in cur.fetchall()]
+    cur.close()
+    if not columns or 'etag' in columns:
+        return
+    execute_query(conn, 'ALTER TABLE videos ADD COLUMN etag text')
+    conn.commit()
+
+
 def setup_tables(conn: sqlite3.Connection, api_auth):
     for schema in TABLE_SCHEMAS:
         create_schema_ = 'CREATE TABLE IF NOT EXISTS ' + TABLE_SCHEMAS[schema]
         execute_query(conn, create_schema_)
+    add_utc_timestamps(conn)
+    add_video_etags(conn)
 
     insert_or_refresh_categories(conn, api_auth, True)
     insert_topics(conn)
@@ -461,26 +629,205 @@ def setup_tables(conn: sqlite3.Connection, api_auth):
     conn.commit()
 
 
-def insert_videos(conn, records: dict, api_auth, verbosity=1):
-    verbosity_level_1 = verbosity >= 1
-    verbosity_level_2 = verbosity >= 2
-    verbosity_level_3 = verbosity >= 3
-    records_passed, inserted, updated = 0, 0, 0
+def get_insert_state(conn: sqlite3.Connection) -> dict:
+    """
+    Loads what insert_videos checks records against from the DB. It's kept up
+    to date by insert_videos as records are inserted, so the same state can be
+    passed to several calls of it, to insert records in batches
+    """
     cur = conn.cursor()
     cur.execute("""SELECT id FROM videos;""")
-    video_ids = [row[0] for row in cur.fetchall()]
+    video_ids = {row[0] for row in cur.fetchall()}
     cur.execute("""SELECT id FROM channels;""")
-    channels = [row[0] for row in cur.fetchall()]
+    channels = {row[0] for row in cur.fetchall()}
     cur.execute("""SELECT * FROM tags;""")
     existing_tags = {v: k for k, v in cur.fetchall()}
-    cur.execute("""SELECT * FROM videos_timestamps;""")
+    cur.execute("""SELECT video_id, watched_at, watched_at_utc, utc_offset
+                   FROM videos_timestamps;""")
     db_timestamps = {}
-    for timestamp_record in cur.fetchall():
-        db_timestamps.setdefault(timestamp_record[0], [])
-        db_timestamps[timestamp_record[0]].append(timestamp_record[1])
+    for video_id, watched_at, watched_at_utc, utc_offset in cur.fetchall():
+        db_timestamps.setdefault(video_id, WatchTimes())
+        db_timestamps[video_id].add(watched_at, watched_at_utc,
+                                    utc_offset is None)
     cur.execute("""SELECT id FROM dead_videos_ids;""")
-    dead_videos_ids = [dead_video[0] for dead_video in cur.fetchall()]
+    dead_videos_ids = {dead_video[0] for dead_video in cur.fetchall()}
     cur.close()
+    return {'video_ids': video_ids,
+            'channels': channels,
+            'existing_tags': existing_tags,
+            'db_timestamps': db_timestamps,
+            'dead_videos_ids': dead_videos_ids,
+            # the timestamps of all known videos, built on first use, see
+            # _get_known_times
+            'known_times': None}
+
+
+def _get_known_times(state: dict) -> dict:
+    """
+    Returns the UTC epochs of the timestamps of all known videos, along with
+    the local times of all of them and of the ones whose UTC time is guessed,
+    in epoch seconds
+    """
+    if state['known_times'] is None:
+        state['known_times'] = {'utc': set(), 'local': [],
+                                'guessed_local': []}
+        for v_id, known_timestamps in state['db_timestamps'].items():
+            if v_id != 'unknown':
+                for timestamp in known_timestamps:
+                    _add_known_time(state, *timestamp)
+    return state['known_times']
+
+
+def _add_known_time(state: dict, local: datetime, utc: int, guessed: bool):
+    known_times = state['known_times']
+    if known_times is not None:
+        known_times['utc'].add(utc)
+        local = datetime_to_epoch(local)
+        known_times['local'].append(local)
+        if guessed:
+            known_times['guessed_local'].append(local)
+
+
+def _remove_known_times(state: dict, unknown_times: list) -> list:
+    """
+    Removes the duplicates of known videos' timestamps from unknown ones (see
+    _get_watch_times), the same way WatchTimes treats them, each known one
+    removing no more than one
+    """
+    known_times = _get_known_times(state)
+    unknown_times = [watch_time for watch_time in unknown_times
+                     if watch_time[1] not in known_times['utc']]
+    remaining = []
+    # guessed UTC times are compared to all local times, the rest only to the
+    # guessed ones'
+    for guessed, known_local in ((True, known_times['local']),
+                                 (False, known_times['guessed_local'])):
+        candidates = [watch_time for watch_time in unknown_times
+                      if (watch_time[2] is None) == guessed]
+        if not known_local:
+            remaining.extend(candidates)
+            continue
+        candidate_epochs = [datetime_to_epoch(watch_time[0])
+                            for watch_time in candidates]
+        remaining_epochs = Counter(remove_known_timestamps(
+            candidate_epochs, known_local).tolist())
+        for watch_time, epoch in zip(candidates, candidate_epochs):
+            if remaining_epochs[epoch]:
+                remaining_epochs[epoch] -= 1
+                remaining.append(watch_time)
+    return remaining
+
+
+def _get_watch_times(record: dict) -> list:
+    """
+    Pops a record's timestamps, returning (local time, UTC epoch, UTC offset)
+    tuples, with the UTC epoch guessed where the offset isn't known
+    """
+    watch_times = []
+    for timestamp, utc_offset in zip(
+            record.pop('timestamps'),
+            record.pop('utc_offsets', None) or repeat(None)):
+        epoch = datetime_to_epoch(timestamp)
+        watch_times.append((timestamp, guess_utc_epoch(epoch) if utc_offset
+                            is None else epoch - utc_offset, utc_offset))
+    return watch_times
+
+
+def _fetch_videos_info(video_ids: list, api_auth, limiter: TokenBucket):
+    """
+    Retrieves the info on video_ids from the API, attempting up to 5 times.
+    Returns a dict of video IDs and their info, with False for all of them
+    if every attempt failed
+    """
+    for attempt in range(1, 6):
+        limiter.acquire()
+        try:
+            api_response = youtube.get_videos_info(video_ids, api_auth)
+        except youtube.ApiRateLimitError:
+            if attempt == 5:
+                raise
+            limiter.back_off()
+            continue
+        if api_response is not False:
+            return api_response
+        time.sleep(0.01*attempt**attempt)
+    return dict.fromkeys(video_ids, False)
+
+
+def _iter_with_videos_info(video_ids, api_auth, needs_info=None,
+                           fetchers: int = API_FETCHERS,
+                           limiter: TokenBucket = None):
+    """
+    Yields a (video_id, info) tuple for each of video_ids, in the same order,
+    with the info on them retrieved from the API youtube.MAX_IDS_PER_REQUEST
+    at a time, each request attempted up to 5 times. info is the API's item
+    for the video, None if it wasn't returned, or False if the requests kept
+    failing.
+
+    Up to fetchers requests are made at once, in other threads, and no more
+    than API_REQUESTS_PER_SECOND are started (or as many as limiter allows),
+    slowing down if the API says its rate limit is exceeded. Only the API
+    calls happen in those threads; the yielded results are used from the
+    calling one, which thereby stays the only one writing to the DB.
+
+    If needs_info is passed, only the IDs it returns True for are requested,
+    with None yielded for the rest. It's called before each batch of IDs is
+    requested, which may be a few batches ahead of the one being yielded, so
+    IDs must be unique
+    """
+    video_ids = iter(video_ids)
+    limiter = limiter or TokenBucket(API_REQUESTS_PER_SECOND)
+    pending = deque()
+    with ThreadPoolExecutor(fetchers) as executor:
+        try:
+            while True:
+                # keeps the fetchers busy while the results of the earlier
+                # batches are being written
+                while len(pending) < fetchers * 2:
+                    batch = list(islice(video_ids,
+                                        youtube.MAX_IDS_PER_REQUEST))
+                    if not batch:
+                        break
+                    to_request = [video_id for video_id in batch
+                                  if needs_info is None or needs_info(video_id)]
+                    pending.append((batch, executor.submit(
+                        _fetch_videos_info, to_request, api_auth, limiter)
+                                    if to_request else None))
+                if not pending:
+                    return
+                batch, future = pending.popleft()
+                videos_info = future.result() if future else {}
+                for video_id in batch:
+                    yield video_id, videos_info.get(video_id)
+        finally:
+            # ex. the generator was closed, or the quota ran out
+            for _, future in pending:
+                if future:
+                    future.cancel()
+
+
+def insert_videos(conn, records: dict, api_auth, verbosity=1,
+                  state: dict = None):
+    """
+    Inserts Takeout records into the DB, along with the info on them from the
+    API, yielding (percent, records processed, records updated) tuples.
+
+    Records can be inserted in batches by passing the same state (see
+    get_insert_state) with each, in which case timestamps are deduplicated
+    against the ones inserted by the previous batches as well as the ones
+    that were in the DB to begin with
+    """
+    verbosity_level_1 = verbosity >= 1
+    verbosity_level_2 = verbosity >= 2
+    verbosity_level_3 = verbosity >= 3
+    records_passed, inserted, updated = 0, 0, 0
+    if state is None:
+        state = get_insert_state(conn)
+    video_ids = state['video_ids']
+    channels = state['channels']
+    existing_tags = state['existing_tags']
+    db_timestamps = state['db_timestamps']
+    dead_videos_ids = state['dead_videos_ids']
     if verbosity_level_1:
         logger.info(f'\nStarting records\' insertion...\n' + '-'*100)
 
@@ -489,84 +836,84 @@ def insert_videos(conn, records: dict, api_auth, verbosity=1):
 
     youtube_music_id = 'youtube_music'
     yt_music_record = records.pop(youtube_music_id, None)
-    yt_music_db_timestamps = db_timestamps.setdefault(youtube_music_id, [])
+    yt_music_db_timestamps = db_timestamps.setdefault(youtube_music_id,
+                                                      WatchTimes())
     if yt_music_record:
         yt_music_record['id'] = youtube_music_id
         yt_music_record['title'] = 'YouTube Music'
         yt_music_record['channel_id'] = youtube_music_id
         yt_music_record['status'] = 'active'
-        yt_music_timestamps = yt_music_record.pop('timestamps')
+        yt_music_timestamps = _get_watch_times(yt_music_record)
         # clean possible new unknowns of known ones already in the database
         if youtube_music_id not in channels:
             add_channel(conn, youtube_music_id, 'YouTube Music',
                         verbosity_level_2)
+            channels.add(youtube_music_id)
         if youtube_music_id not in video_ids:
             add_video(conn, yt_music_record, verbosity_level_2)
+            video_ids.add(youtube_music_id)
             inserted += 1
-        for candidate in yt_music_timestamps:
-            if timestamp_is_unique_in_list(candidate, yt_music_db_timestamps):
-                add_time(conn, candidate, youtube_music_id, verbosity_level_3)
+        for local, utc, utc_offset in yt_music_timestamps:
+            if yt_music_db_timestamps.add(local, utc, utc_offset is None):
+                add_time(conn, local, youtube_music_id, utc, utc_offset,
+                         verbosity_level_3)
 
     unknown_record = records.pop('unknown', None)
-    unk_db_timestamps = db_timestamps.setdefault('unknown', [])
+    unk_db_timestamps = db_timestamps.setdefault('unknown', WatchTimes())
     if unknown_record:
         unknown_record['id'] = 'unknown'
         unknown_record['title'] = 'unknown'
         unknown_record['channel_id'] = 'unknown'
         unknown_record['status'] = 'inactive'
-        unknown_timestamps = unknown_record.pop('timestamps')
+        unknown_timestamps = _get_watch_times(unknown_record)
         # clean possible new unknowns of known ones already in the database
-        all_known_timestamps_ids = list(db_timestamps.keys())
-        all_known_timestamps_ids.remove('unknown')
-        all_known_timestamps_lists = [i for i in
-                                      [db_timestamps[v_id]
-                                       for v_id in all_known_timestamps_ids]]
-        all_known_timestamps = list(itertools.chain.from_iterable(
-            all_known_timestamps_lists))
-        remove_timestamps_from_one_list_from_another(all_known_timestamps,
+        if unknown_timestamps:
+            unknown_timestamps = _remove_known_times(state,
                                                      unknown_timestamps)
         if 'unknown' not in channels:
             add_channel(conn, 'unknown', 'unknown', verbosity_level_2)
+            channels.add('unknown')
         if 'unknown' not in video_ids:
             add_video(conn, unknown_record, verbosity_level_2)
+            video_ids.add('unknown')
             inserted += 1
-        for candidate in unknown_timestamps:
-            if timestamp_is_unique_in_list(candidate, unk_db_timestamps):
-                add_time(conn, candidate, 'unknown', verbosity_level_3)
+        for local, utc, utc_offset in unknown_timestamps:
+            if unk_db_timestamps.add(local, utc, utc_offset is None):
+                add_time(conn, local, 'unknown', utc, utc_offset,
+                         verbosity_level_3)
 
     def add_known_timestamps_and_remove_from_unknown(new_timestamps):
-        db_timestamps.setdefault(video_id, [])
-        db_timestamps[video_id].sort()
+        video_db_timestamps = db_timestamps.setdefault(video_id,
+                                                       WatchTimes())
         added_timestamps = []
-        for new in new_timestamps:
-            if timestamp_is_unique_in_list(new,
-                                           db_timestamps[video_id]):
-                add_time(conn, new, video_id, verbosity_level_2)
-                added_timestamps.append(new)
+        for local, utc, utc_offset in new_timestamps:
+            guessed = utc_offset is None
+            if video_db_timestamps.add(local, utc, guessed):
+                add_time(conn, local, video_id, utc, utc_offset,
+                         verbosity_level_2)
+                added_timestamps.append((local, utc, guessed))
+                _add_known_time(state, local, utc, guessed)
         # clean db unknown timestamps of ones that are now known
         for db_incumbent in added_timestamps:
-            start = bisect.bisect_left(unk_db_timestamps,
-                                       db_incumbent - MAX_TIME_DIFFERENCE)
-            end = bisect.bisect_right(unk_db_timestamps,
-                                      db_incumbent + MAX_TIME_DIFFERENCE)
-            if start != end:
-                for unk_incumbent in range(start, end):
-                    if not are_different_timestamps(
-                            db_incumbent, unk_db_timestamps[unk_incumbent]):
-                        delete_time(conn,
-                                    unk_db_timestamps.pop(unk_incumbent),
-                                    'unknown', verbose=verbosity_level_1)
-                        break
+            unk_incumbent = unk_db_timestamps.remove_duplicate(*db_incumbent)
+            if unk_incumbent is not None:
+                delete_time(conn, unk_incumbent, 'unknown',
+                            verbose=verbosity_level_1)
 
     sub_percent, sub_percent_int = calculate_subpercentage(len(records))
     commit_interval = calculate_commit_interval(sub_percent_int)
     commit_interval_counter = 0
 
-    for video_id, record in records.items():
+    limiter = TokenBucket(API_REQUESTS_PER_SECOND)
+    requests_recorded = 0
+    for video_id, video_info in _iter_with_videos_info(
+            records, api_auth, lambda v_id: v_id not in video_ids,
+            limiter=limiter):
         records_passed += 1
         if records_passed % sub_percent_int == 0:
             yield ((records_passed // sub_percent) / 10, records_passed,
                    updated)
+        record = records[video_id]
         record['id'] = video_id
 
         if video_id not in video_ids:
@@ -585,7 +932,7 @@ def insert_videos(conn, records: dict, api_auth, verbosity=1):
                 generated, but was deleted by the time the newer Takeout was.
             '''
             add_known_timestamps_and_remove_from_unknown(
-                record.pop('timestamps'))
+                _get_watch_times(record))
 
             if (video_id in dead_videos_ids and
                     record.get('title', 'Deleted video') != 'Deleted video'):
@@ -602,35 +949,34 @@ def insert_videos(conn, records: dict, api_auth, verbosity=1):
                 ).replace(microsecond=0)
                 if update_video(conn, record, verbosity_level_2):
                     delete_dead_video(conn, video_id, verbosity_level_1)
+                    dead_videos_ids.discard(video_id)
                     updated += 1
             continue
 
-        for attempt in range(1, 6):
-            api_response = youtube.get_video_info(video_id, api_auth)
-            time.sleep(0.01*attempt**attempt)
-            if api_response:
-                if api_response['items']:
-                    api_video_data = wrangle_video_record(api_response['items'])
-                    if len(api_video_data) >= 7:
-                        record.update(api_video_data)
-                        record['status'] = 'active'
-                    else:
-                        record['status'] = 'deleted'
-                        if verbosity_level_1:
-                            logger.info(f'{get_record_id_and_title(record)}, '
-                                        f'is now deleted from YT')
+        if video_info is not False:
+            if video_info:
+                api_video_data = wrangle_video_record(video_info)
+                if len(api_video_data) >= 7:
+                    record.update(api_video_data)
+                    record['status'] = 'active'
+                    record['etag'] = video_info.get('etag')
                 else:
-                    record['status'] = 'inactive'
+                    record['status'] = 'deleted'
+                    if verbosity_level_1:
+                        logger.info(f'{get_record_id_and_title(record)}, '
+                                    f'is now deleted from YT')
+            else:
+                record['status'] = 'inactive'
 
-                record['last_updated'] = str(datetime.utcnow().replace(
-                    microsecond=0))
-                break
+            record['last_updated'] = str(datetime.utcnow().replace(
+                microsecond=0))
         else:
             record['status'] = 'inactive'
 
         if record.get('title', 'Deleted video') == 'Deleted video':
             record['title'] = 'unknown'
             add_dead_video(conn, video_id)
+            dead_videos_ids.add(video_id)
         if 'channel_id' not in record:
             record['channel_id'] = 'unknown'
 
@@ -643,7 +989,7 @@ def insert_videos(conn, records: dict, api_auth, verbosity=1):
         channel_id = record['channel_id']
 
         if add_channel(conn, channel_id, channel_title, verbosity_level_2):
-            channels.append(record['channel_id'])
+            channels.add(record['channel_id'])
         else:
             continue  # nothing else can/should be inserted without the
             # channel for it getting inserted first as channel_id is a foreign
@@ -653,10 +999,10 @@ def insert_videos(conn, records: dict, api_auth, verbosity=1):
         topics_list = record.pop('relevant_topic_ids', None)
         tags = record.pop('tags', None)
 
-        candidate_timestamps = record.pop('timestamps')
+        candidate_timestamps = _get_watch_times(record)
 
         if add_video(conn, record, verbosity_level_2):
-            video_ids.append(video_id)
+            video_ids.add(video_id)
             inserted += 1
 
         add_known_timestamps_and_remove_from_unknown(candidate_timestamps)
@@ -671,9 +1017,12 @@ def insert_videos(conn, records: dict, api_auth, verbosity=1):
 
         commit_interval_counter += 1
         if commit_interval_counter == commit_interval:
+            requests_recorded = _record_api_requests(conn, limiter,
+                                                     requests_recorded)
             conn.commit()
             commit_interval_counter = 0
 
+    _record_api_requests(conn, limiter, requests_recorded)
     conn.commit()
 
     results = {"records_processed": records_passed,
@@ -685,19 +1034,103 @@ def insert_videos(conn, records: dict, api_auth, verbosity=1):
         logger.info('\n' + '-'*100 + f'\nPopulating finished')
 
 
+def get_videos_due(conn: sqlite3.Connection,
+                   update_age_cutoff=86400) -> list:
+    """
+    Returns the IDs of the videos that haven't been updated for longer than
+    update_age_cutoff seconds, the stalest first. Videos last updated on the
+    same day, ex. all of those inserted together, are ordered by how many
+    times they've been watched, most first
+    """
+    now = datetime.utcnow()  # for determining if the record is old enough
+    dt_strp = datetime.strptime
+    dt_format = '%Y-%m-%d %H:%M:%S'
+    cur = conn.cursor()
+    cur.execute("""SELECT id, last_updated,
+                   (SELECT count(*) FROM videos_timestamps
+                   WHERE video_id = videos.id)
+                   FROM videos
+                   WHERE title NOT IN (?, ?) AND NOT status = ?;""",
+                ('unknown', 'YouTube Music', 'deleted'))
+    due = []
+    for video_id, last_updated, times_watched in cur.fetchall():
+        if ((now - dt_strp(last_updated, dt_format)).total_seconds() >
+                update_age_cutoff):
+            due.append((last_updated[:10], -times_watched, video_id))
+    cur.close()
+    due.sort()
+    return [video_id for *_, video_id in due]
+
+
+def get_update_schedule(conn: sqlite3.Connection, update_age_cutoff=86400,
+                        daily_budget: int = API_DAILY_UPDATE_BUDGET) -> dict:
+    """
+    Returns how many records are due for an update, how much of today's
+    quota budget has been spent, and in how many days all of them are
+    projected to be updated (0 meaning today), if update_videos is run with
+    the same arguments every day. Records that become due in the meantime
+    aren't accounted for
+    """
+    records_due = len(get_videos_due(conn, update_age_cutoff))
+    quota_used = get_quota_used(conn)
+    per_day = (daily_budget // API_UNITS_PER_VIDEOS_REQUEST *
+               youtube.MAX_IDS_PER_REQUEST)
+    left_today = (max(0, daily_budget - quota_used) //
+                  API_UNITS_PER_VIDEOS_REQUEST * youtube.MAX_IDS_PER_REQUEST)
+    if records_due <= left_today:
+        days_to_refresh = 0
+    elif per_day:
+        days_to_refresh = -(-(records_due - left_today) // per_day)
+    else:
+        days_to_refresh = None
+    return {'records_due': records_due,
+            'quota_used_today': quota_used,
+            'daily_budget': daily_budget,
+            'days_to_refresh': days_to_refresh}
+
+
 def update_videos(conn: sqlite3.Connection, api_auth,
-                  update_age_cutoff=86400, verbosity=1):
+                  update_age_cutoff=86400, verbosity=1,
+                  daily_budget: int = API_DAILY_UPDATE_BUDGET):
+    """
+    Refreshes the info on the videos that haven't been updated for longer
+    than update_age_cutoff seconds, yielding (percent, records processed,
+    records updated, newly inactive, newly active, deleted) tuples.
+
+    Only as many videos are requested as fit in what's left of today's
+    daily_budget of API quota units (None for no limit), in the order of
+    get_videos_due. Running out of quota ends the update early, rather than
+    raising ApiQuotaError. Either way, the videos that are left are the first
+    to be updated by the next run, see get_update_schedule.
+
+    Active videos whose ETag from the API is the same as the one stored
+    when they were last updated haven't changed since, so only their
+    last_updated is set. Their info is still downloaded: it's requested
+    youtube.MAX_IDS_PER_REQUEST videos at a time, and a conditional request
+    (If-None-Match) for such a list would only get a 304 if none of them
+    changed, so the ETags are compared per video instead
+    """
     verbosity_level_1 = verbosity >= 1
     verbosity_level_2 = verbosity >= 2
     verbosity_level_3 = verbosity >= 3
     records_passed, updated, newly_inactive, newly_active, deleted = [0] * 5
+    quota_exhausted = False
+    add_video_etags(conn)  # update_db doesn't go through setup_tables
+    due = get_videos_due(conn, update_age_cutoff)
+    to_update = due
+    if daily_budget is not None:
+        requests_left = (max(0, daily_budget - get_quota_used(conn)) //
+                         API_UNITS_PER_VIDEOS_REQUEST)
+        to_update = due[:requests_left * youtube.MAX_IDS_PER_REQUEST]
+        if verbosity_level_1 and len(to_update) < len(due):
+            logger.info(f'{len(due)} records are due for an update, '
+                        f'{len(to_update)} of them fit in today\'s API quota '
+                        f'budget')
     conn.row_factory = sqlite3.Row
     cur = conn.cursor()
-    cur.execute("""SELECT id, last_updated FROM videos
-                   WHERE title NOT IN (?, ?) AND NOT status = ?
-                   ORDER BY last_updated;""",
-                ('unknown', 'YouTube Music', 'deleted'))
-    records = {k: v for k, v in cur.fetchall()}
+    cur.execute("""SELECT id, etag FROM videos
+                   WHERE status = ? AND etag IS NOT NULL;""", ('active',))
+    etags = {k: v for k, v in cur.fetchall()}
     cur.execute("""SELECT * FROM channels WHERE title is not NULL;""")
     channels = {k: v for k, v in cur.fetchall()}
     cur.execute("""SELECT * FROM tags;""")
@@ -714,126 +1147,137 @@ def update_videos(conn: sqlite3.Connection, api_auth,
         existing_topics_tags[video_topic_entry[0]].append(video_topic_entry[1])
     cur.close()
 
-    now = datetime.utcnow()  # for determining if the record is old enough
-    dt_strp = datetime.strptime
-    dt_format = '%Y-%m-%d %H:%M:%S'
-    records_filtered_by_age = [
-        k for k, v in records.items() if
-        (now - dt_strp(v, dt_format)).total_seconds() > update_age_cutoff
-    ]
-    sub_percent, sub_percent_int = calculate_subpercentage(
-        len(records_filtered_by_age))
+    sub_percent, sub_percent_int = calculate_subpercentage(len(to_update))
     commit_interval = calculate_commit_interval(sub_percent_int)
     commit_interval_counter = 0
-    del records
 
     if verbosity_level_1:
         logger.info(f'\nStarting records\' updating...\n' + '-'*100)
-    for record in records_filtered_by_age:
-        records_passed += 1
-        if records_passed % sub_percent_int == 0:
-            yield ((records_passed // sub_percent)/10, records_passed, updated,
-                   newly_inactive, newly_active, deleted)
-        record = execute_query(conn, 'SELECT * FROM videos WHERE id = ?',
-                               (record,))
-        record = dict(record[0])
-        video_id = record['id']
-
-        for attempt in range(1, 6):
-            api_response = youtube.get_video_info(video_id, api_auth)
-            time.sleep(0.01*attempt**attempt)
-            if api_response:
-                if api_response['items']:
-                    api_video_data = wrangle_video_record(api_response['items'])
-                    if len(api_video_data) >= 7:
-                        # a record must have at least 7 fields after
-                        # going through wrangle_video_record, otherwise it's a
-                        # record of a deleted video with no valid data
-                        api_video_data.pop('published_at', None)
-                        if 'channel_title' not in api_video_data:
-                            # the video is somehow available through API
-                            # (though some data is missing), but not on YouTube
-                            pass
-                        else:
-                            if record['status'] == 'inactive':
-                                record['status'] = 'active'
-                                newly_active += 1
-                                if verbosity_level_1:
-                                    logger.info(
-                                        f'{get_record_id_and_title(record)}, '
-                                        f'is now active')
-                        record.update(api_video_data)
+    limiter = TokenBucket(API_REQUESTS_PER_SECOND)
+    requests_recorded = 0
+    try:
+        for video_id, video_info in _iter_with_videos_info(
+                to_update, api_auth, limiter=limiter):
+            records_passed += 1
+            if records_passed % sub_percent_int == 0:
+                yield ((records_passed // sub_percent)/10, records_passed,
+                       updated, newly_inactive, newly_active, deleted)
+            if video_info is False:
+                continue
+            commit_interval_counter += 1
+            if commit_interval_counter == commit_interval:
+                requests_recorded = _record_api_requests(conn, limiter,
+                                                         requests_recorded)
+                conn.commit()
+                commit_interval_counter = 0
+
+            if (video_info and video_id in etags and
+                    video_info.get('etag') == etags[video_id]):
+                if touch_video(conn, video_id, verbosity_level_3):
+                    updated += 1
+                continue
+
+            record = execute_query(conn, 'SELECT * FROM videos WHERE id = ?',
+                                   (video_id,))
+            record = dict(record[0])
+            # kept only for active videos, since a video coming back would
+            # otherwise look unchanged
+            record['etag'] = None
+
+            if video_info:
+                api_video_data = wrangle_video_record(video_info)
+                if len(api_video_data) >= 7:
+                    # a record must have at least 7 fields after
+                    # going through wrangle_video_record, otherwise it's a
+                    # record of a deleted video with no valid data
+                    api_video_data.pop('published_at', None)
+                    if 'channel_title' not in api_video_data:
+                        # the video is somehow available through API
+                        # (though some data is missing), but not on YouTube
+                        pass
                     else:
-                        record['status'] = 'deleted'
-                        deleted += 1
-                        if verbosity_level_1:
-                            logger.info(f'{get_record_id_and_title(record)}, '
-                                        f'is now deleted from YT')
+                        if record['status'] == 'inactive':
+                            record['status'] = 'active'
+                            newly_active += 1
+                            if verbosity_level_1:
+                                logger.info(
+                                    f'{get_record_id_and_title(record)}, '
+                                    f'is now active')
+                    record.update(api_video_data)
+                    record['etag'] = video_info.get('etag')
                 else:
-                    if record['status'] == 'active':
-                        record['status'] = 'inactive'
-                        newly_inactive += 1
-                        if verbosity_level_1:
-                            logger.info(f'{get_record_id_and_title(record)}, '
-                                        f'is now inactive')
-                record['last_updated'] = datetime.utcnow().replace(
-                    microsecond=0)
-                break
-        else:
-            continue
-
-        if 'tags' in record:
-            tags = record.pop('tags')
-            add_tags_to_table_and_videos(conn, tags, video_id, existing_tags,
-                                         existing_videos_tags,
-                                         verbosity_level_3)
-            # perhaps, the record should also be checked for tags that have
-            # been removed from the updated version and have them removed from
-            # the DB as well. However, keeping a fuller record, despite what
-            # the video's uploader/author might think about its accuracy,
-            # seems like a better option
-        channel_id = record['channel_id']
-        if 'channel_title' in record:
-            channel_title = record.pop('channel_title')
-            try:
-                if channel_title != channels[channel_id]:
-                    update_channel(
-                        conn, channel_id, channel_title,
-                        channels[channel_id], verbosity_level_1)
-                    channels[channel_id] = channel_title
-            except KeyError:
-                """The channel now has a different ID... it's a thing.
-                One possible reason for this is large channels, belonging to 
-                large media companies, getting split off into smaller
-                channels. That's what it looked like when I came across it.
+                    record['status'] = 'deleted'
+                    deleted += 1
+                    if verbosity_level_1:
+                        logger.info(f'{get_record_id_and_title(record)}, '
+                                    f'is now deleted from YT')
+            else:
+                if record['status'] == 'active':
+                    record['status'] = 'inactive'
+                    newly_inactive += 1
+                    if verbosity_level_1:
+                        logger.info(f'{get_record_id_and_title(record)}, '
+                                    f'is now inactive')
+            record['last_updated'] = datetime.utcnow().replace(microsecond=0)
+
+            if 'tags' in record:
+                tags = record.pop('tags')
+                add_tags_to_table_and_videos(conn, tags, video_id,
+                                             existing_tags,
+                                             existing_videos_tags,
+                                             verbosity_level_3)
+                # perhaps, the record should also be checked for tags that
+                # have been removed from the updated version and have them
+                # removed from the DB as well. However, keeping a fuller
+                # record, despite what the video's uploader/author might think
+                # about its accuracy, seems like a better option
+            channel_id = record['channel_id']
+            if 'channel_title' in record:
+                channel_title = record.pop('channel_title')
+                try:
+                    if channel_title != channels[channel_id]:
+                        update_channel(
+                            conn, channel_id, channel_title,
+                            channels[channel_id], verbosity_level_1)
+                        channels[channel_id] = channel_title
+                except KeyError:
+                    """The channel now has a different ID... it's a thing.
+                    One possible reason for this is large channels, belonging
+                    to large media companies, getting split off into smaller
+                    channels. That's what it looked like when I came across it.
                 
-                Only encountered this once in ~19k of my own records."""
-                add_channel(conn, channel_id, channel_title, verbosity_level_2)
-        else:
-            # Less than a handful of videos were not available on YouTube, but
-            # were available through API, with channel id, but no channel title.
-            # In Takeout, these had no channel title or id, but had regular
-            # title/id. Very strange.
-            if channel_id not in channels:
-                add_channel(conn, channel_id)
-
-        if 'relevant_topic_ids' in record:
-            topics_list = record.pop('relevant_topic_ids')
-            if existing_topics_tags.get(video_id):
-                for topic in topics_list:
-                    if topic not in existing_topics_tags[video_id]:
-                        add_topic_to_video(conn, topic,
-                                           video_id, verbosity_level_2)
-
-        if update_video(conn, record, verbosity_level_3):
-            updated += 1
-
-        commit_interval_counter += 1
-        if commit_interval_counter == commit_interval:
-            conn.commit()
-            commit_interval_counter = 0
+                    Only encountered this once in ~19k of my own records."""
+                    add_channel(conn, channel_id, channel_title,
+                                verbosity_level_2)
+            else:
+                # Less than a handful of videos were not available on YouTube,
+                # but were available through API, with channel id, but no
+                # channel title. In Takeout, these had no channel title or id,
+                # but had regular title/id. Very strange.
+                if channel_id not in channels:
+                    add_channel(conn, channel_id)
+
+            if 'relevant_topic_ids' in record:
+                topics_list = record.pop('relevant_topic_ids')
+                if existing_topics_tags.get(video_id):
+                    for topic in topics_list:
+                        if topic not in existing_topics_tags[video_id]:
+                            add_topic_to_video(conn, topic,
+                                               video_id, verbosity_level_2)
+
+            if update_video(conn, record, verbosity_level_3):
+                updated += 1
+    except youtube.ApiQuotaError as e:
+        # stops here, keeping what's been updated; the rest are the first to
+        # be updated by the next run
+        if not isinstance(e, youtube.ApiRateLimitError):
+            add_quota_used(conn, daily_budget or 0, at_least=True)
+        quota_exhausted = True
+        logger.warning(f'Updating stopped early: {e}')
+    finally:
+        _record_api_requests(conn, limiter, requests_recorded)
+        conn.commit()
 
-    conn.commit()
     execute_query(conn, 'VACUUM')
     conn.row_factory = None
 
@@ -841,7 +1285,11 @@ def update_videos(conn: sqlite3.Connection, api_auth,
                'records_updated': updated,
                'newly_inactive': newly_inactive,
                'newly_active': newly_active,
-               'deleted_from_youtube': deleted}
+               'deleted_from_youtube': deleted,
+               'quota_exhausted': quota_exhausted}
+    if daily_budget is not None:
+        results.update(get_update_schedule(conn, update_age_cutoff,
+                                           daily_budget))
     if verbosity_level_1:
         logger.info(json.dumps(results, indent=4))
         logger.info('\n' + '-'*100 + f'\nUpdating finished')
@@ -1,13 +1,47 @@
 import json
 import logging
-from googleapiclient.discovery import build
+import os
+import queue
+import threading
+from contextlib import contextmanager
+from urllib.parse import urljoin, urlsplit
+
+import httplib2
+from googleapiclient.discovery import DISCOVERY_URI, build_from_document
 from googleapiclient.errors import HttpError
-from youtubewatched.config import video_parts_to_get
+from youtubewatched.config import (API_BASE_URL, API_DISCOVERY_CACHE_DIR,
+                                   API_REQUEST_TIMEOUT, video_keys_and_columns,
+                                   video_keys_parts, video_parts_to_get)
 
 logger = logging.getLogger(__name__)
 
 YOUTUBE_API_VERSION = 'v3'
 YOUTUBE_API_SERVICE_NAME = 'youtube'
+# the most IDs videos().list accepts in a single request
+MAX_IDS_PER_REQUEST = 50
+
+
+def _get_video_fields() -> str:
+    """
+    Returns the partial response mask for videos().list, listing the items'
+    etag and their video_keys_and_columns, ex.
+    items(etag,id,snippet(publishedAt,...),contentDetails(duration),...)
+    """
+    top_level = ['etag']
+    parts = {}
+    for key in video_keys_and_columns:
+        part = video_keys_parts[key]
+        if part is None:
+            top_level.append(key)
+        else:
+            parts.setdefault(part, []).append(key)
+    return 'items({})'.format(','.join(
+        top_level + [f'{part}({",".join(keys)})'
+                     for part, keys in parts.items()]))
+
+
+# the API only sends what's stored, rather than the whole of each part
+VIDEO_FIELDS = _get_video_fields()
 
 
 class ApiKeyError(ValueError):
@@ -18,46 +52,160 @@ class ApiQuotaError(ValueError):
     pass
 
 
+class ApiRateLimitError(ApiQuotaError):
+    """The short-term rate limit was exceeded, rather than the daily quota;
+    requests should succeed again after slowing down"""
+    pass
+
+
+class HttpPool:
+    """
+    Hands out httplib2.Http instances, one per thread at a time, since they
+    aren't thread-safe. They're kept after being returned, along with their
+    keep-alive connections, so later requests, from any thread, don't have
+    to reconnect. httplib2 asks for and decompresses gzipped responses on
+    its own
+    """
+
+    def __init__(self, timeout: float = None):
+        self.timeout = timeout
+        # the most recently used ones are the likeliest to still be connected
+        self._idle = queue.LifoQueue()
+
+    @contextmanager
+    def connection(self) -> httplib2.Http:
+        try:
+            http = self._idle.get_nowait()
+        except queue.Empty:
+            http = httplib2.Http(timeout=self.timeout)
+        try:
+            yield http
+        finally:
+            self._idle.put(http)
+
+
+_http_pool = HttpPool(API_REQUEST_TIMEOUT)
+_discovery_documents = {}
+_discovery_lock = threading.Lock()
+
+
 def _handle_api_key_error(e):
     err_inf = json.loads(e.content)['error']
     reason = err_inf['errors'][0]['reason']
     if reason == 'keyInvalid':
         raise ApiKeyError(f'Invalid API key')
-    if reason in ['quotaExceeded', 'dailyLimitExceeded', 'rateLimitExceeded']:
+    if reason in ['rateLimitExceeded', 'userRateLimitExceeded']:
+        raise ApiRateLimitError(f'API rate limit exceeded')
+    if reason in ['quotaExceeded', 'dailyLimitExceeded']:
         raise ApiQuotaError(f'API quota/rate limit exceeded')
     return err_inf, reason
 
 
-def get_api_auth(developer_key):
+def _fetch_discovery_document(url: str) -> str:
+    with _http_pool.connection() as http:
+        resp, content = http.request(url)
+    if resp.status >= 400:
+        raise HttpError(resp, content, uri=url)
+    return content.decode('utf-8')
+
+
+def get_discovery_document(service: str = YOUTUBE_API_SERVICE_NAME,
+                           version: str = YOUTUBE_API_VERSION,
+                           cache_dir: str = API_DISCOVERY_CACHE_DIR) -> str:
+    """
+    Returns the discovery document describing an API, which the client is
+    built from. It's only downloaded the first time, then read from
+    cache_dir, and kept in memory for the rest of the process
+    """
+    with _discovery_lock:
+        document = _discovery_documents.get((service, version))
+        if document:
+            return document
+        path = os.path.join(cache_dir, f'{service}.{version}.json')
+        try:
+            with open(path, encoding='utf-8') as file:
+                document = file.read()
+            json.loads(document)
+        except (OSError, ValueError):
+            document = _fetch_discovery_document(
+                DISCOVERY_URI.format(api=service, apiVersion=version))
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+                with open(path, 'w', encoding='utf-8') as file:
+                    file.write(document)
+            except OSError as e:
+                logger.warning(f'Failed to cache the API discovery document '
+                               f'in {path}: {e}')
+        _discovery_documents[(service, version)] = document
+        return document
+
+
+def get_api_auth(developer_key, base_url: str = API_BASE_URL):
+    """
+    Returns the API client. With base_url, it's for another server that
+    implements the API, ex. benchmarks/fake_youtube_api.py, whose discovery
+    document is then retrieved from it, at the same path as Google's, and
+    not cached
+    """
     if not developer_key:
         raise ApiKeyError('Please provide an API key.\n'
                           'Create an api_key file in the project directory '
                           'and paste the key there.')
     try:
-        return build(YOUTUBE_API_SERVICE_NAME, YOUTUBE_API_VERSION,
-                     developerKey=developer_key)
+        if base_url:
+            document = _fetch_discovery_document(urljoin(
+                base_url, urlsplit(DISCOVERY_URI).path.format(
+                    api=YOUTUBE_API_SERVICE_NAME,
+                    apiVersion=YOUTUBE_API_VERSION)))
+        else:
+            document = get_discovery_document()
+        # the key is only checked by the first request made with it, since
+        # the discovery document is usually cached
+        return build_from_document(document,
+                                   developerKey=developer_key,
+                                   http=httplib2.Http(API_REQUEST_TIMEOUT))
     except HttpError as e:
         _handle_api_key_error(e)
+        raise
 
 
-def get_video_info(video_id, api_auth):
+def get_videos_info(video_ids: list, api_auth):
+    """
+    Requests the info on up to MAX_IDS_PER_REQUEST videos at once, for the same
+    quota cost as a single one. Returns the items keyed on their IDs; videos
+    that are missing from them weren't returned by the API. Returns False if
+    the request failed.
+
+    Only VIDEO_FIELDS are returned, including each item's etag, which tells
+    whether a video has changed since it was last requested (see
+    write_to_sql.update_videos). Can be called from multiple threads at once,
+    each using its own connection from the pool
+    """
     try:
-        results = api_auth.videos().list(id=video_id,
-                                         part=video_parts_to_get).execute()
-        return results
+        with _http_pool.connection() as http:
+            results = api_auth.videos().list(
+                id=','.join(video_ids), part=video_parts_to_get,
+                fields=VIDEO_FIELDS).execute(http=http)
+        return {item['id']: item for item in results.get('items', [])}
     except HttpError as e:
         err_inf, reason = _handle_api_key_error(e)
-        logger.error(f'API error: ID# {video_id} retrieval failed\n'
+        logger.error(f'API error: retrieval of {len(video_ids)} IDs starting '
+                     f'with {video_ids[0]} failed\n'
                      f'error code: ' + str(err_inf['code']) +
                      '\ndescription: ' + err_inf['message'] +
                      '\nreason: ' + reason)
         return False
+    except (OSError, httplib2.HttpLib2Error) as e:  # ex. timed out
+        logger.error(f'API error: retrieval of {len(video_ids)} IDs starting '
+                     f'with {video_ids[0]} failed: {e!r}')
+        return False
 
 
 def get_categories(api_auth):
     try:
-        return api_auth.videoCategories().list(part='snippet',
-                                               regionCode='US').execute()
+        with _http_pool.connection() as http:
+            return api_auth.videoCategories().list(
+                part='snippet', regionCode='US').execute(http=http)
     except HttpError as e:
         err_inf, reason = _handle_api_key_error(e)
         logger.error(f'Categories\' retrieval failed,\n'